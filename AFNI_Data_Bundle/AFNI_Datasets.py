@@ -0,0 +1,356 @@
+####################################################################################################################
+# ===AFNI Datasets=== #
+# Reads AFNI .HEAD/.BRIK datasets (gzipped or not) straight into NumPy, so that scripts do not need to launch an
+# AFNI program every time they want to look at the values inside a dataset. Also writes NumPy arrays out as AFNI
+# datasets (or NIfTI files) on the grid of an existing dataset, for the intermediate files the scripts used to make
+# with 3dcalc, 3dbucket or 3dAFNItoNIFTI.
+####################################################################################################################
+
+
+import os, re, gzip, numbers, struct, uuid
+import numpy
+import Gzip_Index
+import Run_Trace
+
+
+# AFNI BRICK_TYPES codes and the NumPy types they are stored as
+brick_dtypes = {0: 'u1',  # byte
+				1: 'i2',  # short
+				2: 'i4',  # int
+				3: 'f4',  # float
+				4: 'f8',  # double
+				5: 'c8'}  # complex
+
+# NIfTI-1 datatype codes of the NumPy types a NIfTI file can be written in
+nifti_datatypes = {'u1': 2, 'i2': 4, 'i4': 8, 'f4': 16, 'f8': 64, 'c8': 32}
+
+views = {0: "+orig", 1: "+acpc", 2: "+tlrc"}  # SCENE_DATA view codes
+
+attribute_pattern = re.compile(r"type\s*=\s*([\w-]+)\s+name\s*=\s*(\S+)\s+count\s*=\s*(\d+)")
+
+
+##########################################################
+# ===Header=== #
+##########################################################
+
+# Parses every attribute in a .HEAD file into a dict - string attributes become strings, numeric ones become lists
+def read_header(head_path):
+	with open(head_path, 'rb') as head_file:
+		text = head_file.read().decode('latin-1')
+
+	header = {}
+	match = attribute_pattern.search(text)
+	while match:
+		attribute_type, name, count = match.group(1), match.group(2), int(match.group(3))
+		position = match.end()
+		if attribute_type == 'string-attribute':
+			start = text.find("'", position) + 1
+			value = text[start:start + count]  # the count includes the closing '~'
+			if value.endswith("~"):
+				value = value[:-1]
+			header[name] = value
+			match = attribute_pattern.search(text, start + count)
+		else:
+			match = attribute_pattern.search(text, position)
+			end = match.start() if match else len(text)
+			values = text[position:end].split()
+			if attribute_type == 'integer-attribute':
+				header[name] = [int(value) for value in values]
+			else:
+				header[name] = [float(value) for value in values]
+	return header
+
+
+# Splits a path to a dataset ('stats+tlrc', 'stats+tlrc.HEAD', 'stats+tlrc.BRIK.gz'...) into its .HEAD and .BRIK files
+def dataset_files(dataset_path):
+	prefix = dataset_path
+	for extension in ['.HEAD', '.BRIK.gz', '.BRIK']:
+		if prefix.endswith(extension):
+			prefix = prefix[:-len(extension)]
+			break
+	if prefix.endswith("."):
+		prefix = prefix[:-1]
+	head_path = prefix + ".HEAD"
+	brik_path = prefix + ".BRIK"
+	if not os.path.exists(brik_path) and os.path.exists(brik_path + ".gz"):
+		brik_path = brik_path + ".gz"
+	return prefix, head_path, brik_path
+
+
+# Reads the header of a dataset and collects the information needed to find any sub-brick inside the .BRIK file
+def open_dataset(dataset_path):
+	prefix, head_path, brik_path = dataset_files(dataset_path)
+	if not os.path.exists(head_path):
+		raise IOError("AFNI header not found: %s" % head_path)
+	header = read_header(head_path)
+
+	dims = tuple(header['DATASET_DIMENSIONS'][:3])
+	nvals = header['DATASET_RANK'][1]
+	types = header.get('BRICK_TYPES', [3] * nvals)
+	facs = header.get('BRICK_FLOAT_FACS', [0.0] * nvals)
+	labels = header.get('BRICK_LABS', "").split("~")
+	labels = labels + ["#%s" % i for i in range(len(labels), nvals)]  # AFNI's default label for unlabeled sub-bricks
+	if header.get('BYTEORDER_STRING', "LSB_FIRST") == "MSB_FIRST":
+		byteorder = '>'
+	else:
+		byteorder = '<'
+
+	nvox = dims[0] * dims[1] * dims[2]
+	brick_bytes = [nvox * numpy.dtype(brick_dtypes[brick_type]).itemsize for brick_type in types]
+	offsets = [sum(brick_bytes[:i]) for i in range(nvals)]
+
+	return {'prefix': prefix,
+			'head_path': head_path,
+			'brik_path': brik_path,
+			'header': header,
+			'dims': dims,
+			'nvox': nvox,
+			'nvals': nvals,
+			'types': types,
+			'facs': facs,
+			'labels': labels[:nvals],
+			'byteorder': byteorder,
+			'offsets': offsets}
+
+
+##########################################################
+# ===Data=== #
+##########################################################
+
+# Memory-maps an uncompressed .BRIK file as raw bytes (once per dataset), so nothing is read until it is used
+def brik_memmap(dataset):
+	if dataset.get('memmap') is None:
+		dataset['memmap'] = numpy.memmap(dataset['brik_path'], dtype=numpy.uint8, mode='r')
+	return dataset['memmap']
+
+
+# Returns one sub-brick exactly as it is stored on disk (unscaled, in its BRICK_TYPES type)
+# For an uncompressed .BRIK this is a zero-copy view into the memory-mapped file, so only the pages that are
+# actually used get read from disk. For a .BRIK.gz, only the part of the file holding this sub-brick is decompressed.
+def subbrick_view(dataset, index):
+	dtype = numpy.dtype(brick_dtypes[dataset['types'][index]]).newbyteorder(dataset['byteorder'])
+	if dataset['brik_path'].endswith(".gz"):
+		raw = Gzip_Index.read_range(dataset['brik_path'], dataset['offsets'][index], dataset['nvox'] * dtype.itemsize)
+		Run_Trace.count('bytes_read', len(raw))
+		return numpy.frombuffer(raw, dtype=dtype, count=dataset['nvox'])
+	raw = brik_memmap(dataset)
+	return numpy.frombuffer(raw, dtype=dtype, count=dataset['nvox'], offset=dataset['offsets'][index])
+
+
+# Returns every sub-brick of an uncompressed dataset as one (sub-bricks, voxels) array viewing the memory-mapped .BRIK
+# (as stored, unscaled), or None for a .BRIK.gz or a dataset whose sub-bricks are stored in different types
+# Slicing it gives views, not copies: brik_array(stats)[1::2] is every other sub-brick (e.g. the coefficients of an
+# interleaved Coef/Tstat stats file) without reading or copying anything.
+def brik_array(dataset):
+	if dataset['brik_path'].endswith(".gz") or len(set(dataset['types'])) != 1:
+		return None
+	dtype = numpy.dtype(brick_dtypes[dataset['types'][0]]).newbyteorder(dataset['byteorder'])
+	return numpy.ndarray((dataset['nvals'], dataset['nvox']), dtype=dtype, buffer=brik_memmap(dataset))
+
+
+# Returns the requested sub-bricks as one (sub-bricks, voxels) view of the memory-mapped .BRIK when their indices are
+# evenly spaced (e.g. range(1, nvals, 2)), so nothing is copied; None when that is not possible (see brik_array)
+def strided_view(dataset, indices):
+	array = brik_array(dataset)
+	indices = list(indices)
+	if array is None or not indices:
+		return None
+	step = indices[1] - indices[0] if len(indices) > 1 else 1
+	if step < 1 or indices != list(range(indices[0], indices[0] + step * len(indices), step)):
+		return None
+	return array[indices[0]:indices[-1] + 1:step]
+
+
+# Returns one sub-brick as float32, with its BRICK_FLOAT_FACS scaling applied on access
+# If voxels (flat voxel indices) is given, only those voxels are read.
+def subbrick(dataset, index, voxels=None):
+	values = subbrick_view(dataset, index)
+	if voxels is not None:
+		values = values[voxels]
+	if not dataset['brik_path'].endswith(".gz"):
+		Run_Trace.count('bytes_read', values.nbytes)  # only the voxels used are read from a memory-mapped file
+	values = values.astype(numpy.float32, copy=False)
+	if dataset['facs'][index]:
+		values = values * numpy.float32(dataset['facs'][index])
+	return values
+
+
+# Returns the requested sub-bricks (all of them by default) as a float32 array shaped (sub-bricks, voxels),
+# with the BRICK_FLOAT_FACS scaling applied. Voxels are in AFNI's order (x fastest, then y, then z).
+# If voxels (flat voxel indices) is given, only those voxels are read and returned.
+def load_subbricks(dataset, indices=None, voxels=None):
+	if indices is None:
+		indices = range(dataset['nvals'])
+	indices = list(indices)
+	if voxels is None:
+		voxel_count = dataset['nvox']
+	else:
+		voxel_count = len(voxels)
+
+	view = strided_view(dataset, indices)
+	if view is not None:  # every sub-brick is gathered from the memory-mapped file at once
+		if voxels is not None:
+			view = view[:, voxels]
+		Run_Trace.count('bytes_read', view.nbytes)
+		data = view.astype(numpy.float32)
+		facs = numpy.array([dataset['facs'][index] for index in indices], dtype=numpy.float32)
+		if facs.any():
+			data *= numpy.where(facs != 0, facs, numpy.float32(1))[:, numpy.newaxis]
+		return data
+
+	data = numpy.empty((len(indices), voxel_count), dtype=numpy.float32)
+	for row, index in enumerate(indices):
+		data[row] = subbrick(dataset, index, voxels)
+	return data
+
+
+##########################################################
+# ===Writing=== #
+##########################################################
+
+# Returns one attribute of a .HEAD file as text (values is a string, or a list of ints or of floats)
+def head_attribute(name, values):
+	if not isinstance(values, (list, tuple, numpy.ndarray)):
+		return "type = string-attribute\nname = %s\ncount = %s\n'%s~\n\n" % (name, len(values) + 1, values)
+	if all(isinstance(value, numbers.Integral) for value in values):
+		kind = "integer"
+		values = ["%d" % value for value in values]
+	else:
+		kind = "float"
+		values = ["%.9g" % value for value in values]
+	lines = [" ".join(values[i:i + 5]) for i in range(0, len(values), 5)]  # 5 values per line, as AFNI writes them
+	return "type = %s-attribute\nname = %s\ncount = %s\n %s\n\n" % (kind, name, len(values), "\n ".join(lines))
+
+
+# Writes sub-bricks as a new AFNI dataset on the grid of like (a dataset from open_dataset, or a header with at least
+# DATASET_DIMENSIONS, ORIENT_SPECIFIC, ORIGIN and DELTA), like 3dcalc or 3dbucket would, and returns it opened
+# subbricks is an array shaped (sub-bricks, voxels), or any sequence of flat sub-bricks in AFNI's voxel order; they are
+# written one at a time, so a generator of sub-brick views never holds more than one sub-brick in memory.
+# brick_types is an AFNI type code (0 byte, 1 short, 3 float...) for every sub-brick, or a list of one per sub-brick;
+# facs are BRICK_FLOAT_FACS scale factors for the values as given (e.g. when copying stored short sub-bricks).
+# attributes holds any other .HEAD attributes to write ({name: value}). The view (+tlrc...) is added to dataset_path if
+# it has none, and an existing dataset is never overwritten.
+def write_dataset(dataset_path, subbricks, like, labels=None, brick_types=3, facs=None, attributes=None, gz=False):
+	header = like.get('header', like)
+	prefix = dataset_files(dataset_path)[0]
+	view = views.get(header.get('SCENE_DATA', [2])[0], "+tlrc")
+	if re.search(r"\+(orig|acpc|tlrc)$", prefix):
+		view = prefix[-5:]
+	else:
+		prefix = prefix + view
+	head_path = prefix + ".HEAD"
+	brik_path = prefix + ".BRIK" + (".gz" if gz else "")
+	if any(os.path.exists(x) for x in [head_path, prefix + ".BRIK", prefix + ".BRIK.gz"]):
+		raise IOError("AFNI dataset already exists: %s" % prefix)
+	dims = [int(x) for x in header['DATASET_DIMENSIONS'][:3]]
+	nvox = dims[0] * dims[1] * dims[2]
+
+	types = []
+	statistics = []
+	if gz:
+		brik_file = gzip.open(brik_path, 'wb', 6)
+	else:
+		brik_file = open(brik_path, 'wb')
+	with brik_file:
+		for values in subbricks:
+			brick_type = brick_types[len(types)] if isinstance(brick_types, list) else brick_types
+			values = numpy.asarray(values).ravel()
+			if values.size != nvox:
+				raise ValueError("sub-brick %s has %s voxels, but the grid has %s" % (len(types), values.size, nvox))
+			stored = values.astype(numpy.dtype(brick_dtypes[brick_type]).newbyteorder('<'), copy=False)
+			brik_file.write(stored.tobytes())
+			fac = facs[len(types)] if facs else 0.0
+			if stored.dtype.kind == 'c' or not stored.size:
+				statistics += [0.0, 0.0]
+			else:
+				statistics += [float(stored.min()) * (fac or 1.0), float(stored.max()) * (fac or 1.0)]
+			types.append(brick_type)
+	nvals = len(types)
+	if labels is None:
+		labels = ["#%s" % i for i in range(nvals)]
+
+	text = [head_attribute("TYPESTRING", "3DIM_HEAD_FUNC"),
+			head_attribute("SCENE_DATA", [[code for code in views if views[code] == view][0], 11, 1]),  # a functional bucket, like 3dbucket/3dcalc output
+			head_attribute("IDCODE_STRING", "PYA_" + uuid.uuid4().hex[:22]),
+			head_attribute("DATASET_RANK", [3, nvals, 0, 0, 0, 0, 0, 0]),
+			head_attribute("DATASET_DIMENSIONS", dims + [0, 0])]
+	for name in ['ORIENT_SPECIFIC', 'ORIGIN', 'DELTA', 'IJK_TO_DICOM', 'IJK_TO_DICOM_REAL', 'TEMPLATE_SPACE']:
+		if name in header:
+			text.append(head_attribute(name, header[name]))
+	text += [head_attribute("BRICK_TYPES", types),
+			 head_attribute("BRICK_STATS", statistics),
+			 head_attribute("BRICK_FLOAT_FACS", [float(x) for x in (facs or [0.0] * nvals)]),
+			 head_attribute("BRICK_LABS", "~".join(labels)),
+			 head_attribute("BYTEORDER_STRING", "LSB_FIRST")]
+	for name, value in sorted((attributes or {}).items()):
+		text.append(head_attribute(name, value))
+	with open(head_path, 'w') as head_file:
+		head_file.write("\n" + "".join(text))
+	return open_dataset(head_path)
+
+
+# Copies sub-bricks of a dataset into a new dataset, as they are stored (types, scale factors and labels kept), like
+# 3dbucket -prefix dataset_path 'dataset[indices]'
+def copy_subbricks(dataset, indices, dataset_path, gz=False):
+	indices = list(indices)
+	return write_dataset(dataset_path, (subbrick_view(dataset, index) for index in indices), dataset,
+						 labels=[dataset['labels'][index] for index in indices], brick_types=[dataset['types'][index] for index in indices],
+						 facs=[dataset['facs'][index] for index in indices], gz=gz)
+
+
+# Returns the 4x4 matrix that takes voxel indices (i, j, k, 1) of a dataset's grid to RAS+ millimeter coordinates,
+# as NIfTI stores it (AFNI's coordinates are DICOM order, RAI+, so x and y change sign)
+def grid_affine(header):
+	affine = numpy.eye(4)
+	if 'IJK_TO_DICOM_REAL' in header:
+		affine[:3] = numpy.array(header['IJK_TO_DICOM_REAL'][:12]).reshape(3, 4)
+	else:
+		affine[:3] = 0.0
+		for axis in range(3):
+			dicom_axis = header['ORIENT_SPECIFIC'][axis] // 2  # 0,1 = x (R/L), 2,3 = y (A/P), 4,5 = z (I/S)
+			affine[dicom_axis, axis] = header['DELTA'][axis]
+			affine[dicom_axis, 3] = header['ORIGIN'][axis]
+	affine[:2] *= -1
+	return affine
+
+
+# Writes sub-bricks (see write_dataset) as a NIfTI-1 file (.nii, or .nii.gz) on the grid of like, like 3dAFNItoNIFTI
+# More than one sub-brick makes a 4D file. Values are stored as float32 unless dtype says otherwise.
+def write_nifti(nifti_path, subbricks, like, dtype='f4'):
+	header = like.get('header', like)
+	dims = [int(x) for x in header['DATASET_DIMENSIONS'][:3]]
+	data = numpy.asarray(subbricks)
+	if data.ndim == 1:
+		data = data.reshape(1, -1)
+	dtype = numpy.dtype(dtype).newbyteorder('<')
+	affine = grid_affine(header)
+
+	view = header.get('SCENE_DATA', [0])[0]
+	if view == 2 and header.get('TEMPLATE_SPACE', "").startswith("MNI"):
+		space_code = 4  # MNI_152
+	elif view == 2:
+		space_code = 3  # Talairach
+	else:
+		space_code = 1  # scanner
+	if len(data) > 1:
+		shape = [4] + dims + [len(data), 1, 1, 1]
+	else:
+		shape = [3] + dims + [1, 1, 1, 1]
+	voxel_sizes = [1.0] + [float(abs(x)) for x in header['DELTA'][:3]] + [1.0, 1.0, 1.0, 1.0]
+	fields = ([348, b"", b"", 0, 0, 114, 0]  # sizeof_hdr, unused ANALYZE fields, regular = 'r', dim_info
+			  + shape + [0.0, 0.0, 0.0, 0, nifti_datatypes[dtype.str[1:]], dtype.itemsize * 8, 0]  # dim, intent, datatype, bitpix
+			  + voxel_sizes + [352.0, 1.0, 0.0, 0, 0, 2]  # pixdim, vox_offset, scl_slope/inter, slice info, units = mm
+			  + [0.0, 0.0, 0.0, 0.0, 0, 0, b"AFNI_Datasets", b""]  # cal_max/min, slice_duration, toffset, glmax/min, descrip
+			  + [0, space_code, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]  # the grid is given by the sform only
+			  + list(affine[0]) + list(affine[1]) + list(affine[2]) + [b"", b"n+1\x00"])
+	nifti_header = struct.pack('<i10s18sihbb8h3fhhhh8ffffhbbffffii80s24shh6f4f4f4f16s4s', *fields)
+
+	if nifti_path.endswith(".gz"):
+		nifti_file = gzip.open(nifti_path, 'wb', 6)
+	else:
+		nifti_file = open(nifti_path, 'wb')
+	with nifti_file:
+		nifti_file.write(nifti_header + b"\x00" * 4)  # no header extensions
+		for values in data:
+			nifti_file.write(values.astype(dtype, copy=False).tobytes())
+	return nifti_path
@@ -0,0 +1,129 @@
+####################################################################################################################
+# ===Command Runner=== #
+# Runs the AFNI programs (and other shell commands) that the scripts in this package still need. Independent commands
+# run at the same time on a pool of threads (a thread only waits on its own process, so the commands really do run in
+# parallel), with an optional timeout for each command. stdout can be captured straight from a pipe instead of a
+# temporary file, and every command's wall time is recorded, so a script can show where its time went.
+#
+# A job given to run_commands is either one command, or a list of commands that must run one after another (e.g. a
+# command followed by the "mv" of its output); the jobs themselves run concurrently.
+# When a run is being traced (Run_Trace), every command is also saved as a span, and its time is counted towards the
+# stage that ran it.
+####################################################################################################################
+
+
+import os, signal, subprocess, threading, time
+from multiprocessing.pool import ThreadPool
+import Run_Trace
+
+
+FNULL = open(os.devnull, 'w')  # used to suppress terminal command output
+
+command_log = []  # every finished command (see run_command), in the order they finished
+log_lock = threading.Lock()
+
+
+# Runs one shell command, and returns {'command', 'cwd', 'returncode', 'stdout', 'seconds', 'timed_out'}
+# cwd is the folder to run it in (instead of "cd folder && ..."). With capture=True, stdout is returned as a string;
+# otherwise it goes to the terminal, or nowhere if quiet=True (stderr too). A command still running after timeout
+# seconds is killed, along with anything it started, and returns with timed_out set to True.
+def run_command(command, cwd=None, timeout=None, capture=False, quiet=False):
+	if capture:
+		stdout = subprocess.PIPE
+	elif quiet:
+		stdout = FNULL
+	else:
+		stdout = None
+	with Run_Trace.waiting():
+		result = run_process(command, cwd, timeout, stdout, quiet)
+	if Run_Trace.enabled():
+		Run_Trace.count('subprocess_seconds', result['seconds'])
+		Run_Trace.add_event(command.split()[0] if command.split() else command, 'command', result['starttime'], result['seconds'],
+							{'command': command, 'returncode': result['returncode'], 'timed_out': result['timed_out'],
+							 'subprocess_seconds': result['seconds']})
+	del result['starttime']
+	with log_lock:
+		command_log.append(result)
+	if result['timed_out']:
+		print("Warning: command stopped after %s seconds: %s" % (timeout, command))
+	return result
+
+
+# Starts a command and waits for it (see run_command), killing its process group after timeout seconds
+def run_process(command, cwd, timeout, stdout, quiet):
+	starttime = time.time()
+	process = subprocess.Popen(command, shell=True, cwd=cwd, stdout=stdout, stderr=FNULL if quiet else None,
+							   preexec_fn=os.setsid)  # own process group, so a timeout can stop the whole command
+
+	timed_out = []
+	timer = None
+	if timeout:
+		def stop():
+			timed_out.append(True)
+			try:
+				os.killpg(process.pid, signal.SIGKILL)
+			except OSError:  # already finished
+				pass
+		timer = threading.Timer(timeout, stop)
+		timer.start()
+	try:
+		output = process.communicate()[0]
+	finally:
+		if timer is not None:
+			timer.cancel()
+
+	if output is not None and not isinstance(output, str):
+		output = output.decode('utf-8', 'replace')
+	return {'command': command,
+			'cwd': cwd,
+			'returncode': process.returncode,
+			'stdout': output,
+			'starttime': starttime,
+			'seconds': time.time() - starttime,
+			'timed_out': bool(timed_out)}
+
+
+# Runs a list of jobs on workers threads, and returns their results in the same order as the jobs
+# A job is a command string, a (command, cwd) pair, or a list of these to run one after another (its result is then a
+# list of results). The other options are passed to run_command for every command.
+def run_commands(jobs, workers=4, timeout=None, capture=False, quiet=False):
+	def run_job(job):
+		if isinstance(job, list):
+			return [run_job(step) for step in job]
+		if isinstance(job, tuple):
+			return run_command(job[0], cwd=job[1], timeout=timeout, capture=capture, quiet=quiet)
+		return run_command(job, timeout=timeout, capture=capture, quiet=quiet)
+
+	jobs = list(jobs)
+	if not jobs:
+		return []
+	if workers <= 1 or len(jobs) == 1:
+		return [run_job(job) for job in jobs]
+
+	spans = list(Run_Trace.open_spans())
+	def run_traced_job(job):
+		with Run_Trace.inherit(spans):
+			return run_job(job)
+
+	pool = ThreadPool(min(workers, len(jobs)))
+	try:
+		with Run_Trace.waiting():
+			return pool.map(run_traced_job, jobs)
+	finally:
+		pool.close()
+		pool.join()
+
+
+# Prints how many commands were run, their total wall time, and the slowest ones (from command_log)
+def print_command_times(slowest=5):
+	with log_lock:
+		log = list(command_log)
+	if not log:
+		return
+	total = sum(result['seconds'] for result in log)
+	print("\n%s commands run, %.1f seconds of command time in total" % (len(log), total))
+	for result in sorted(log, key=lambda x: -x['seconds'])[:slowest]:
+		print("  %8.1f s  %s" % (result['seconds'], result['command'][:150]))
+	failed = [result for result in log if result['returncode'] != 0]
+	if failed:
+		print("%s command(s) failed or were stopped, e.g.: %s" % (len(failed), failed[0]['command'][:150]))
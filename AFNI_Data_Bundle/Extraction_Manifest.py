@@ -0,0 +1,109 @@
+####################################################################################################################
+# ===Extraction Manifest=== #
+# Remembers every ROI value extracted so far, so that a rerun (after a crash, or with an added subject or ROI) only
+# extracts what is missing or out of date. For each subject/GLM/condition/ROI, the manifest records the dataset the
+# value came from (size, mtime and a hash of its .HEAD), a hash of the ROI definition, and the value itself.
+# A value is reused only if the dataset's size, mtime and header hash and the ROI hash are all unchanged, so a dataset
+# rewritten in place (even with the same header and size) is extracted again. Copying a results tree without keeping
+# mtimes (cp -p and rsync -a keep them) also makes the next run extract everything again.
+# Masks and atlases are small, so their hash covers their whole contents (.HEAD and .BRIK): a mask redrawn in place
+# on the same grid gets a new hash, and its values are extracted again.
+####################################################################################################################
+
+
+import os, json, hashlib
+import AFNI_Datasets
+
+
+# Returns {'size', 'mtime', 'hash'} for a dataset - the size and mtime of its .BRIK(.gz), and the SHA-1 of its .HEAD
+def dataset_signature(dataset_path):
+	prefix, head_path, brik_path = AFNI_Datasets.dataset_files(dataset_path)
+	with open(head_path, 'rb') as head_file:
+		head_hash = hashlib.sha1(head_file.read()).hexdigest()
+	stat = os.stat(brik_path)
+	return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': head_hash}
+
+
+# Returns a hash identifying a mask dataset's contents - the SHA-1 of its .HEAD and every byte of its .BRIK(.gz)
+def mask_hash(mask_path):
+	prefix, head_path, brik_path = AFNI_Datasets.dataset_files(mask_path)
+	content_hash = hashlib.sha1()
+	for file_path in [head_path, brik_path]:
+		with open(file_path, 'rb') as mask_file:
+			for block in iter(lambda: mask_file.read(1 << 20), b""):
+				content_hash.update(block)
+	return content_hash.hexdigest()
+
+
+# Returns a hash identifying one label of an atlas, from the atlas's mask_hash and the label value
+def atlas_label_hash(atlas_hash, label_value):
+	return hashlib.sha1(("%s_%s" % (atlas_hash, label_value)).encode('utf-8')).hexdigest()
+
+
+# Returns a hash identifying a sphere (center, radius and the order its coordinates are given in)
+def sphere_hash(center, radius, coord_order):
+	description = "%s_r%s_%s" % ("_".join("%g" % x for x in center), radius, coord_order.upper())
+	return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+##########################################################
+# ===Entries=== #
+##########################################################
+
+# Returns a manifest entry for the values of one ROI/condition in a dataset (and any other statistics of the ROI,
+# {column: values})
+def new_entry(dataset_file, signature, ROI_hash, values, voxel_count, statistics=None):
+	return {'dataset': dataset_file,
+			'size': signature['size'],
+			'mtime': signature['mtime'],
+			'hash': signature['hash'],
+			'mask': ROI_hash,
+			'values': [float(x) for x in values],
+			'voxels': int(voxel_count),
+			'statistics': dict((column, [float(x) for x in statistics[column]]) for column in statistics or {})}
+
+
+# True if an entry from an earlier run can be reused for a dataset with this signature and an ROI with this hash
+# (and has every statistic column in statistics)
+def is_current(entry, signature, ROI_hash, statistics=()):
+	if entry is None:
+		return False
+	if any(column not in entry.get('statistics', {}) for column in statistics):
+		return False
+	return (entry['size'] == signature['size'] and entry.get('mtime') == signature['mtime'] and entry['hash'] == signature['hash']
+			and entry['mask'] == ROI_hash)
+
+
+##########################################################
+# ===Manifest file=== #
+##########################################################
+
+# Loads a manifest ({subject: {GLM: {condition: {ROI: entry}}}}), or returns an empty one
+def load_manifest(manifest_path):
+	if not os.path.exists(manifest_path):
+		return {}
+	with open(manifest_path, 'r') as manifest_file:
+		return json.load(manifest_file)
+
+
+# Saves a manifest (written to a temporary file first, so that a crash never leaves a half-written manifest)
+def save_manifest(manifest_path, manifest):
+	if not os.path.exists(os.path.dirname(manifest_path)):
+		os.makedirs(os.path.dirname(manifest_path))
+	temp_path = manifest_path + ".%s.tmp" % os.getpid()
+	with open(temp_path, 'w') as manifest_file:
+		json.dump(manifest, manifest_file)
+	os.rename(temp_path, manifest_path)
+
+
+# Returns the entries recorded for one subject's GLM folder ({condition: {ROI: entry}})
+def unit_entries(manifest, subject, GLM):
+	return manifest.get(subject, {}).get(GLM, {})
+
+
+# Adds the entries of one subject's GLM folder ({condition: {ROI: entry}}) to a manifest
+def update_manifest(manifest, subject, GLM, entries):
+	GLM_entries = manifest.setdefault(subject, {}).setdefault(GLM, {})
+	for condition in entries:
+		GLM_entries.setdefault(condition, {}).update(entries[condition])
+	return manifest
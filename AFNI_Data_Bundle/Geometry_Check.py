@@ -0,0 +1,109 @@
+####################################################################################################################
+# ===Geometry Check=== #
+# Checks the grid of many datasets at once, straight from their .HEAD files (no 3dinfo calls): orientation
+# (ORIENT_SPECIFIC), dimensions, voxel spacing (DELTA) and origin (ORIGIN). Headers are read by a pool of threads,
+# and what was read is saved to a cache file keyed by each header's size and mtime, so reruns only read new or
+# changed headers. Every problem is collected into one list, so it can be reported before any extraction starts.
+####################################################################################################################
+
+
+import os, json
+from multiprocessing.pool import ThreadPool
+import AFNI_Datasets
+import Sphere_Masks
+
+
+# Returns the grid of a dataset from its header: {'orient': "RAI", 'dims': [x, y, z], 'delta': [...], 'origin': [...]}
+def head_geometry(dataset_path):
+	prefix, head_path, brik_path = AFNI_Datasets.dataset_files(dataset_path)
+	header = AFNI_Datasets.read_header(head_path)
+	orient = header.get('ORIENT_SPECIFIC', [0, 3, 4])
+	return {'orient': "".join(Sphere_Masks.orient_codes[code] for code in orient[:3]),
+			'dims': header['DATASET_DIMENSIONS'][:3],
+			'delta': header.get('DELTA', [1.0, 1.0, 1.0]),
+			'origin': header.get('ORIGIN', [0.0, 0.0, 0.0])}
+
+
+# Returns (size, mtime) of a dataset's .HEAD, used to tell whether a cached geometry is still valid
+def head_stamp(dataset_path):
+	stat = os.stat(AFNI_Datasets.dataset_files(dataset_path)[1])
+	return [stat.st_size, stat.st_mtime]
+
+
+# Returns {dataset path: geometry} for every dataset, reading headers in threads threads
+# If cache_path is given, geometries read by earlier runs are reused as long as their header has not changed.
+def scan_geometry(dataset_paths, cache_path=None, threads=8):
+	cache = {}
+	if cache_path and os.path.exists(cache_path):
+		with open(cache_path, 'r') as cache_file:
+			cache = json.load(cache_file)
+
+	def read_geometry(dataset_path):
+		stamp = head_stamp(dataset_path)
+		if dataset_path in cache and cache[dataset_path]['stamp'] == stamp:
+			return dataset_path, cache[dataset_path]
+		geometry = head_geometry(dataset_path)
+		geometry['stamp'] = stamp
+		return dataset_path, geometry
+
+	dataset_paths = sorted(set(dataset_paths))
+	pool = ThreadPool(max(1, min(threads, len(dataset_paths))))
+	try:
+		geometries = dict(pool.map(read_geometry, dataset_paths))
+	finally:
+		pool.close()
+		pool.join()
+
+	if cache_path:
+		cache.update(geometries)
+		temp_path = cache_path + ".%s.tmp" % os.getpid()
+		with open(temp_path, 'w') as cache_file:
+			json.dump(cache, cache_file)
+		os.rename(temp_path, cache_path)
+	return geometries
+
+
+##########################################################
+# ===Checks=== #
+##########################################################
+
+# Returns a message for every dataset whose orientation does not match the coordinate system of the ROIs
+def orientation_mismatches(geometries, coord_system):
+	mismatches = []
+	for dataset_path in sorted(geometries):
+		if geometries[dataset_path]['orient'] != coord_system:
+			mismatches.append("%s: file is %s, coordinates are %s" % (dataset_path, geometries[dataset_path]['orient'], coord_system))
+	return mismatches
+
+
+# True if two geometries have the same voxels - the same dimensions and voxel spacing, so that voxel indices line up
+# (they may still differ in orientation or origin)
+def same_voxels(geometry, other_geometry):
+	if list(geometry['dims']) != list(other_geometry['dims']):
+		return False
+	return all(abs(a - b) <= 1e-3 for a, b in zip(geometry['delta'], other_geometry['delta']))
+
+
+# True if two geometries describe the same grid
+def same_grid(geometry, other_geometry):
+	if geometry['orient'] != other_geometry['orient'] or not same_voxels(geometry, other_geometry):
+		return False
+	return all(abs(a - b) <= 1e-3 for a, b in zip(geometry['origin'], other_geometry['origin']))
+
+
+# Returns (mismatches, fatal) - a message for every dataset whose grid does not match the grid of a mask it will be used
+# with. Messages for datasets whose dimensions or voxel spacing differ from a mask are also in fatal: the mask cannot be
+# used with them at all, while a different orientation or origin only shifts where the ROI lands.
+def grid_mismatches(geometries, mask_geometries):
+	mismatches = []
+	fatal = []
+	for dataset_path in sorted(geometries):
+		for mask_path in sorted(mask_geometries):
+			if not same_grid(geometries[dataset_path], mask_geometries[mask_path]):
+				message = "%s: grid (%s, %s) does not match mask %s (%s, %s)" % (
+					dataset_path, "x".join(str(x) for x in geometries[dataset_path]['dims']), geometries[dataset_path]['orient'],
+					mask_path, "x".join(str(x) for x in mask_geometries[mask_path]['dims']), mask_geometries[mask_path]['orient'])
+				mismatches.append(message)
+				if not same_voxels(geometries[dataset_path], mask_geometries[mask_path]):
+					fatal.append(message)
+	return mismatches, fatal
@@ -0,0 +1,26 @@
+####################################################################################################################
+# ===Group Averages=== #
+# Averages ROI values across subjects. Values are held in one dense array shaped (ROI, condition, subject, timepoint)
+# together with a mask of which entries actually exist (a subject may be missing a GLM, a condition, or timepoints),
+# so the count, mean and SEM of every ROI/condition/timepoint are each computed in a single NumPy reduction.
+####################################################################################################################
+
+
+import numpy
+
+
+# Returns an empty (ROI, condition, subject, timepoint) array of values, and the mask saying which ones are present
+def empty_group_array(ROI_count, condition_count, subject_count, timepoint_count):
+	shape = (ROI_count, condition_count, subject_count, timepoint_count)
+	return numpy.zeros(shape, dtype=numpy.float64), numpy.zeros(shape, dtype=bool)
+
+
+# Returns the (count, mean, SEM) across subjects for every ROI/condition/timepoint, each shaped (ROI, condition, timepoint)
+# The SEM uses ddof=1 like scipy.stats.sem, so it is NaN wherever only one subject is present.
+def group_statistics(data, present):
+	count = present.sum(axis=2)
+	with numpy.errstate(invalid='ignore', divide='ignore'):
+		mean = numpy.where(present, data, 0.0).sum(axis=2) / count
+		deviations = numpy.where(present, data - mean[:, :, None, :], 0.0)
+		sem = numpy.sqrt((deviations ** 2).sum(axis=2) / (count - 1)) / numpy.sqrt(count)
+	return count, mean, sem
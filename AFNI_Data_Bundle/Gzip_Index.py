@@ -0,0 +1,130 @@
+####################################################################################################################
+# ===Gzip Index=== #
+# Random access into gzipped .BRIK files. The first time a file is read, a set of seek points (checkpoints) is built
+# while streaming through it once; after that, any byte range can be read by starting from the nearest checkpoint
+# instead of decompressing the file from the beginning.
+#
+# If the indexed_gzip module is installed (pip install indexed_gzip), its zran-style index is used and saved next to
+# the data as a sidecar file (<file>.BRIK.gz.gzidx), so that later runs can skip building it. Otherwise, checkpoints
+# are kept in memory for as long as the script runs.
+####################################################################################################################
+
+
+import os, zlib
+
+try:
+	import indexed_gzip
+except ImportError:
+	indexed_gzip = None
+
+
+checkpoint_spacing = 4 * 1024 * 1024  # uncompressed bytes between checkpoints
+chunk_size = 64 * 1024  # compressed bytes read from disk at a time
+
+gzip_indexes = {}  # gzipped file path -> index, for every file read so far
+
+
+# Path of the sidecar index file saved next to a gzipped file
+def index_path(gz_path):
+	return gz_path + ".gzidx"
+
+
+##########################################################
+# ===indexed_gzip seek points (saved to disk)=== #
+##########################################################
+
+# Opens a gzipped file with indexed_gzip, importing its sidecar index if it is up to date, or building and saving one
+def indexed_gzip_reader(gz_path):
+	reader = indexed_gzip.IndexedGzipFile(gz_path, spacing=checkpoint_spacing)
+	sidecar = index_path(gz_path)
+	if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(gz_path):
+		reader.import_index(sidecar)
+	else:
+		reader.build_full_index()
+		try:
+			reader.export_index(sidecar)
+		except (IOError, OSError):  # e.g. a read-only results folder - the index is still used for this run
+			pass
+	return reader
+
+
+##########################################################
+# ===In-memory checkpoints (no extra modules needed)=== #
+##########################################################
+
+# Streams through a gzipped file once, keeping a copy of the decompressor state every checkpoint_spacing bytes
+# Each checkpoint is (uncompressed offset, compressed offset, decompressor).
+def build_checkpoints(gz_path):
+	decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	checkpoints = [(0, 0, decompressor.copy())]
+	uncompressed_offset = 0
+	compressed_offset = 0
+	with open(gz_path, 'rb') as gz_file:
+		while True:
+			chunk = gz_file.read(chunk_size)
+			if not chunk:
+				break
+			compressed_offset += len(chunk)
+			uncompressed_offset += len(decompressor.decompress(chunk))
+			if decompressor.unused_data:  # AFNI writes a single gzip member; anything after it is ignored
+				break
+			if uncompressed_offset - checkpoints[-1][0] >= checkpoint_spacing:
+				checkpoints.append((uncompressed_offset, compressed_offset, decompressor.copy()))
+	return {'checkpoints': checkpoints, 'size': uncompressed_offset}
+
+
+# Reads length bytes starting at offset, decompressing from the last checkpoint before offset
+def read_from_checkpoints(gz_path, index, offset, length):
+	checkpoints = index['checkpoints']
+	start = 0
+	for i in range(len(checkpoints)):
+		if checkpoints[i][0] > offset:
+			break
+		start = i
+	uncompressed_offset, compressed_offset, decompressor = checkpoints[start]
+	decompressor = decompressor.copy()  # keep the checkpoint itself untouched for later reads
+
+	pieces = []
+	collected = 0
+	with open(gz_path, 'rb') as gz_file:
+		gz_file.seek(compressed_offset)
+		while collected < length:
+			chunk = gz_file.read(chunk_size)
+			if not chunk:
+				break
+			data = decompressor.decompress(chunk)
+			if uncompressed_offset + len(data) > offset:
+				piece = data[max(0, offset - uncompressed_offset):]
+				pieces.append(piece[:length - collected])
+				collected += len(pieces[-1])
+			uncompressed_offset += len(data)
+			if decompressor.unused_data:
+				break
+	return b"".join(pieces)
+
+
+##########################################################
+# ===Reading=== #
+##########################################################
+
+# Returns the index for a gzipped file, building it on the first read (or if the file has changed since)
+def open_index(gz_path):
+	stat = os.stat(gz_path)
+	key = (stat.st_size, stat.st_mtime)
+	if gz_path not in gzip_indexes or gzip_indexes[gz_path]['key'] != key:
+		if indexed_gzip is not None:
+			gzip_indexes[gz_path] = {'key': key, 'reader': indexed_gzip_reader(gz_path)}
+		else:
+			index = build_checkpoints(gz_path)
+			index['key'] = key
+			gzip_indexes[gz_path] = index
+	return gzip_indexes[gz_path]
+
+
+# Returns length bytes of the uncompressed data in a gzipped file, starting at offset
+def read_range(gz_path, offset, length):
+	index = open_index(gz_path)
+	if 'reader' in index:
+		index['reader'].seek(offset)
+		return index['reader'].read(length)
+	return read_from_checkpoints(gz_path, index, offset, length)
@@ -0,0 +1,93 @@
+####################################################################################################################
+# ===Job Scheduler=== #
+# Runs independent units of work (e.g. one subject's GLM folder) either one after another, or across a pool of
+# worker processes. Units must not share any files they write to.
+####################################################################################################################
+
+
+import sys
+import collections
+import multiprocessing
+
+
+# Raised in the parent for a unit that stopped its worker with sys.exit (or another exception that is not an
+# Exception, e.g. KeyboardInterrupt). These would otherwise kill the worker process and lose its task, leaving the
+# pool waiting for it forever.
+class UnitStopped(Exception):
+	def __init__(self, message, exit=False):
+		Exception.__init__(self, message)
+		self.exit = exit
+
+
+# Runs a single unit inside a worker process (module-level so that it can be sent to the pool)
+def call_unit(function_and_unit):
+	function, unit = function_and_unit
+	try:
+		return unit, function(unit)
+	except Exception:
+		raise
+	except SystemExit as error:
+		raise UnitStopped(error.code if error.code is not None else "", exit=True)
+	except BaseException as error:
+		raise UnitStopped("%s: %s" % (type(error).__name__, error))
+
+
+# Stops the script with the message of a unit that called sys.exit (once its pool is terminated), so that it ends
+# with the same message as when the unit runs in this process
+def stop_for(error):
+	if isinstance(error, UnitStopped) and error.exit:
+		sys.exit(error.args[0])
+
+
+# Runs function(unit) for every unit, yielding (unit, result) as each one finishes
+# With processes=1 the units run in this process, in order; otherwise they are spread across a process pool, and
+# come back in the order they finish.
+def run_units(function, units, processes=1):
+	units = list(units)
+	if processes <= 1 or len(units) <= 1:
+		for unit in units:
+			yield unit, function(unit)
+		return
+
+	pool = multiprocessing.Pool(min(processes, len(units)))
+	try:
+		for unit, result in pool.imap_unordered(call_unit, [(function, unit) for unit in units]):
+			yield unit, result
+	except BaseException as error:
+		pool.terminate()
+		stop_for(error)
+		raise
+	else:
+		pool.close()
+	finally:
+		pool.join()
+
+
+# Runs function(unit) for every unit like run_units, but yields (unit, result) in the order of units
+# At most window units (by default two per process) are handed to the pool ahead of the next one to be yielded, so
+# results that finish early wait in memory for a slower unit before them only up to that many at a time.
+def run_units_in_order(function, units, processes=1, window=None):
+	units = list(units)
+	if processes <= 1 or len(units) <= 1:
+		for unit in units:
+			yield unit, function(unit)
+		return
+
+	window = window or 2 * processes
+	pool = multiprocessing.Pool(min(processes, len(units)))
+	try:
+		pending = collections.deque()
+		for unit in units:
+			pending.append(pool.apply_async(call_unit, [(function, unit)]))
+			if len(pending) >= window:
+				yield pending.popleft().get()
+		while pending:
+			yield pending.popleft().get()
+	except BaseException as error:
+		pool.terminate()
+		stop_for(error)
+		raise
+	else:
+		pool.close()
+	finally:
+		pool.join()
@@ -0,0 +1,60 @@
+####################################################################################################################
+# ===Label Index=== #
+# Finds sub-bricks by their exact label (from the BRICK_LABS header attribute), instead of running 3dinfo -label and
+# searching the labels for substrings. Each distinct set of labels is indexed once, and the index is shared by every
+# dataset with the same labels (e.g. the stats files of every subject run through the same GLM).
+# The same goes for the trial layout of a single-trial (LME) stats file: which sub-bricks hold the trial coefficients,
+# and where their t-statistics are, read from the labels instead of from 3dinfo output saved to a temporary file.
+####################################################################################################################
+
+
+import fnmatch
+
+
+label_indexes = {}  # BRICK_LABS -> {label: sub-brick index}
+trial_schemas = {}  # (BRICK_LABS, pattern) -> trial schema
+
+
+# Returns {label: sub-brick index} for a dataset opened with AFNI_Datasets.open_dataset
+# If a label is used more than once, it points to the first sub-brick with that label.
+def label_index(dataset):
+	key = "~".join(dataset['labels'])
+	if key not in label_indexes:
+		index = {}
+		for position, label in enumerate(dataset['labels']):
+			if label not in index:
+				index[label] = position
+		label_indexes[key] = index
+	return label_indexes[key]
+
+
+# Returns the conditions of a 3dDeconvolve stats dataset - the labels of its coefficient sub-bricks ("hit#0_Coef"),
+# without the "#0_Coef"
+def coefficient_conditions(dataset):
+	return [label[:-7] for label in dataset['labels'] if label.endswith("#0_Coef")]
+
+
+# Returns the trial layout of a stats dataset with one coefficient per trial (3dDeconvolve -stim_times_IM), from its
+# labels: the coefficient sub-bricks are those whose label matches pattern ("Trial#0_Coef", "Trial#1_Coef"...)
+# Returns {'indices': coefficient sub-bricks, 'labels': their labels, 'tstat_indices': the sub-brick of each one's
+# "_Tstat" (None if it has none), 'step': the spacing of evenly spaced coefficients (e.g. 2 when every coefficient is
+# followed by its t-statistic, None otherwise), 'tstat_offset': the distance from every coefficient to its t-statistic
+# when it is the same for all of them (None otherwise)}
+def trial_schema(dataset, pattern="*#*_Coef"):
+	key = ("~".join(dataset['labels']), pattern)
+	if key not in trial_schemas:
+		indices = [position for position, label in enumerate(dataset['labels']) if fnmatch.fnmatch(label, pattern)]
+		labels = [dataset['labels'][position] for position in indices]
+		index = label_index(dataset)
+		tstat_indices = [index.get(label[:-len("_Coef")] + "_Tstat") if label.endswith("_Coef") else None for label in labels]
+
+		steps = set(second - first for first, second in zip(indices, indices[1:]))
+		step = steps.pop() if len(steps) == 1 else None
+		offsets = set(tstat - coefficient if tstat is not None else None for coefficient, tstat in zip(indices, tstat_indices))
+		tstat_offset = offsets.pop() if len(offsets) == 1 else None
+		trial_schemas[key] = {'indices': indices,
+							  'labels': labels,
+							  'tstat_indices': tstat_indices,
+							  'step': step,
+							  'tstat_offset': tstat_offset}
+	return trial_schemas[key]
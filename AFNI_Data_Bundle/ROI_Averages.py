@@ -0,0 +1,84 @@
+####################################################################################################################
+# ===ROI Averages=== #
+# Averages dataset values within ROI masks, in place of calling 3dmaskave once per ROI and per sub-brick.
+# A dataset is read once, and every requested sub-brick is averaged within a mask in a single NumPy operation.
+# Several datasets on the same grid (e.g. all iresp files of a GLM) can be stacked into one array, so that every ROI
+# of every sub-brick of every dataset is averaged by a single sparse matrix product (ROI weights x voxel data), using
+# the weight matrix of a mask library from ROI_Masks. Other ROI statistics (see ROI_Reducers) can be computed from the
+# same stacked array.
+####################################################################################################################
+
+
+import numpy
+import AFNI_Datasets
+import ROI_Masks
+import ROI_Reducers
+
+
+# Averages the requested sub-bricks of several datasets on the same grid within every ROI of a mask library (see
+# ROI_Masks), in one sparse product. indices holds the sub-bricks to use for each dataset (None for all of them).
+# Only the voxels inside the ROIs are read; the sub-bricks of all the datasets are stacked into one
+# (sub-bricks x voxels) array, and multiplied by the library's weight matrix.
+# statistics lists other ROI statistics to compute from the same array (column names from ROI_Reducers.reducer_columns).
+# Returns {ROI name: (list with an array of averages for each dataset, number of voxels, {statistic: list of arrays})}
+def stacked_roi_averages(datasets, indices, library, statistics=None):
+	ROI_voxels, weights = ROI_Masks.library_columns(library)
+	data = numpy.concatenate([AFNI_Datasets.load_subbricks(dataset, dataset_indices, ROI_voxels) for dataset, dataset_indices in zip(datasets, indices)])
+	means = numpy.asarray(weights.dot(data.T.astype(numpy.float64)))  # (ROIs, stacked sub-bricks)
+	return split_averages(datasets, indices, library, means, block_statistics(data, library, statistics))
+
+
+# Averages the requested sub-bricks of a dataset within every ROI of a mask library, and returns them as one
+# (sub-bricks x ROIs) array, in the order of library['names'] (e.g. every trial beta of a subject within every ROI)
+# The sub-bricks are read once, as a (sub-bricks x voxels) array of the voxels inside the ROIs, and multiplied by the
+# library's (voxels x ROIs) weights. ROIs without any voxels are NaN.
+def roi_matrix(dataset, indices, library):
+	ROI_voxels, weights = ROI_Masks.library_columns(library)
+	data = AFNI_Datasets.load_subbricks(dataset, indices, ROI_voxels)
+	matrix = numpy.asarray(weights.dot(data.T.astype(numpy.float64))).T
+	matrix[:, numpy.asarray(library['voxels']) == 0] = numpy.nan
+	return matrix
+
+
+# Averages the requested sub-bricks of several datasets on the same grid within every label of an atlas library (see
+# ROI_Masks.atlas_library) - each sub-brick is summed per label by one numpy.bincount over its labeled voxels
+# Returns the same {ROI name: (averages for each dataset, number of voxels, {statistic: values for each dataset})} as
+# stacked_roi_averages
+def stacked_label_averages(datasets, indices, library, statistics=None):
+	voxels = library['atlas_voxels']
+	data = numpy.concatenate([AFNI_Datasets.load_subbricks(dataset, dataset_indices, voxels) for dataset, dataset_indices in zip(datasets, indices)])
+	label_count = len(library['names'])
+
+	sums = numpy.empty((label_count, data.shape[0]))
+	for row in range(data.shape[0]):
+		sums[:, row] = numpy.bincount(library['atlas_rows'], weights=data[row].astype(numpy.float64), minlength=label_count)
+	means = sums / numpy.maximum(library['voxels'], 1)[:, numpy.newaxis]  # (ROIs, stacked sub-bricks)
+	return split_averages(datasets, indices, library, means, block_statistics(data, library, statistics))
+
+
+# Computes the statistics (ROI_Reducers column names) of every ROI of a library from data, the stacked sub-bricks of
+# the library's voxels (in the order of ROI_Masks.library_columns)
+# Returns one {statistic: array with a value per stacked sub-brick} for each ROI (all empty if statistics is empty)
+def block_statistics(data, library, statistics):
+	if not statistics:
+		return [{} for ROI in library['names']]
+	weights = ROI_Masks.library_columns(library)[1]
+	ROI_statistics = []
+	for row in range(len(library['names'])):
+		positions = weights.indices[weights.indptr[row]:weights.indptr[row + 1]]
+		ROI_statistics.append(ROI_Reducers.reduce_block(data[:, positions], statistics))
+	return ROI_statistics
+
+
+# Splits (ROIs, stacked sub-bricks) averages and statistics back into the sub-bricks of each dataset
+# Returns {ROI name: (list with an array of averages for each dataset, number of voxels, {statistic: list of arrays})}
+def split_averages(datasets, indices, library, means, ROI_statistics):
+	ends = numpy.cumsum([len(list(dataset_indices)) if dataset_indices is not None else dataset['nvals'] for dataset, dataset_indices in zip(datasets, indices)])
+	averages = {}
+	for row, ROI in enumerate(library['names']):
+		if library['voxels'][row] == 0:
+			averages[ROI] = ([numpy.array([]) for dataset in datasets], 0, {})
+			continue
+		statistics = dict((column, numpy.split(ROI_statistics[row][column], ends[:-1])) for column in ROI_statistics[row])
+		averages[ROI] = (numpy.split(means[row], ends[:-1]), int(library['voxels'][row]), statistics)
+	return averages
@@ -0,0 +1,157 @@
+####################################################################################################################
+# ===ROI Masks=== #
+# Turns a set of ROIs into a "mask library": one sparse ROIs x voxels matrix (scipy.sparse CSR), so that the mean of
+# every ROI in a sub-brick is a single sparse matrix-vector product, instead of one 3dmaskave pass per ROI.
+# Three kinds of masks are supported:
+#   binary - every nonzero voxel of a mask counts equally (what 3dmaskave -mask does)
+#   probabilistic - every voxel is weighted by its value in the mask (e.g. a probability map)
+#   atlas - a single integer-labeled dataset, where every label value is its own ROI
+# Each row of the matrix sums to 1, so multiplying it by voxel data gives (weighted) ROI means.
+####################################################################################################################
+
+
+import os, re, sys
+import numpy
+import scipy.sparse
+import AFNI_Datasets
+
+
+label_table_pattern = re.compile(r'"(-?\d+)"\s+"([^"]*)"')  # one entry of an AFNI VALUE_LABEL_DTABLE
+
+
+# Returns the first sub-brick of a mask dataset (flat, in AFNI's voxel order)
+# If dims is given and the mask is on another grid, a ValueError is raised, as the mask would point to the wrong voxels.
+def read_mask(mask_path, dims=None):
+	mask_dataset = AFNI_Datasets.open_dataset(mask_path)
+	if dims is not None and tuple(mask_dataset['dims']) != tuple(dims):
+		raise ValueError("The mask %s (%s) is not on the same grid as the data it is used with (%s)." % (
+			mask_dataset['prefix'], "x".join(str(x) for x in mask_dataset['dims']), "x".join(str(x) for x in dims)))
+	return mask_dataset, AFNI_Datasets.load_subbricks(mask_dataset, [0])[0]
+
+
+##########################################################
+# ===Libraries=== #
+##########################################################
+
+# Returns a mask library from the nonzero entries of the ROIs x voxels matrix (rows, columns and weights)
+# names holds one name per row. Every row is divided by its sum; rows without any voxels stay empty.
+# A library is {'names': [ROI names], 'weights': CSR matrix, 'voxels': voxel count of each ROI, 'dims': grid}
+def library_from_rows(names, rows, columns, weights, dims):
+	rows = numpy.asarray(rows, dtype=numpy.int64)
+	columns = numpy.asarray(columns, dtype=numpy.int64)
+	weights = numpy.asarray(weights, dtype=numpy.float64)
+	row_sums = numpy.bincount(rows, weights=weights, minlength=len(names))
+	counts = numpy.bincount(rows, minlength=len(names))
+	if len(rows):
+		weights = weights / row_sums[rows]
+	nvox = int(dims[0]) * int(dims[1]) * int(dims[2])
+	matrix = scipy.sparse.csr_matrix((weights, (rows, columns)), shape=(len(names), nvox))
+	return {'names': list(names),
+			'weights': matrix,
+			'voxels': counts,
+			'dims': tuple(dims)}
+
+
+# Returns a mask library from {ROI name: (voxel indices, voxel weights)}, with one row per ROI in sorted order
+def weighted_library(ROI_voxels, dims):
+	names = sorted(ROI_voxels)
+	rows = []
+	columns = []
+	weights = []
+	for row, ROI in enumerate(names):
+		voxels, voxel_weights = ROI_voxels[ROI]
+		rows.append(numpy.full(len(voxels), row, dtype=numpy.int64))
+		columns.append(numpy.asarray(voxels, dtype=numpy.int64))
+		weights.append(numpy.asarray(voxel_weights, dtype=numpy.float64))
+	empty = [numpy.zeros(0, dtype=numpy.int64)]
+	return library_from_rows(names, numpy.concatenate(rows + empty), numpy.concatenate(columns + empty),
+							 numpy.concatenate(weights + [numpy.zeros(0)]), dims)
+
+
+# Returns a binary mask library from {ROI name: voxel indices} (e.g. spheres from Sphere_Masks)
+def voxel_set_library(masks, dims):
+	return weighted_library(dict((ROI, (masks[ROI], numpy.ones(len(masks[ROI])))) for ROI in masks), dims)
+
+
+# Returns a binary mask library from {ROI name: mask dataset path} - every nonzero voxel of a mask is in its ROI
+def binary_library(mask_paths, dims=None):
+	ROI_voxels = {}
+	for ROI in mask_paths:
+		mask_dataset, values = read_mask(mask_paths[ROI], dims)
+		dims = mask_dataset['dims']
+		voxels = numpy.flatnonzero(values)
+		ROI_voxels[ROI] = (voxels, numpy.ones(len(voxels)))
+	return weighted_library(ROI_voxels, dims)
+
+
+# Returns a probabilistic mask library from {ROI name: mask dataset path} - every voxel above 0 is in its ROI, weighted
+# by its value, so the ROI value is a weighted mean
+def probabilistic_library(mask_paths, dims=None):
+	ROI_voxels = {}
+	for ROI in mask_paths:
+		mask_dataset, values = read_mask(mask_paths[ROI], dims)
+		dims = mask_dataset['dims']
+		voxels = numpy.flatnonzero(values > 0)
+		ROI_voxels[ROI] = (voxels, values[voxels])
+	return weighted_library(ROI_voxels, dims)
+
+
+# Returns a mask library from an integer-labeled atlas, with one row per label value above 0 (in increasing order)
+# ROI names come from label_table ({value: name}), then from the atlas's own label table, then from the value itself.
+# Besides the weight matrix, the library keeps the labeled voxels and the row of each one ('atlas_voxels' and
+# 'atlas_rows'), so that ROI_Averages can average every label with numpy.bincount.
+def atlas_library(atlas_path, label_table=None, dims=None):
+	atlas_dataset, values = read_mask(atlas_path, dims)
+	labels = numpy.rint(values).astype(numpy.int64)
+	voxels = numpy.flatnonzero(labels > 0)
+	label_values, rows = numpy.unique(labels[voxels], return_inverse=True)
+
+	if label_table is None:
+		label_table = header_label_table(atlas_dataset['header'])
+	names = [label_table.get(int(value), str(value)) for value in label_values]
+	library = library_from_rows(names, rows, voxels, numpy.ones(len(voxels)), atlas_dataset['dims'])
+	library['labels'] = label_values
+	library['atlas_voxels'] = voxels
+	library['atlas_rows'] = rows
+	return library
+
+
+# Returns (voxels, weights) - the sorted voxel indices used by at least one ROI of a library, and the library's matrix
+# restricted to those voxels, so that only the voxels inside the ROIs need to be read from a dataset
+def library_columns(library):
+	if library.get('columns') is None:
+		voxels = numpy.unique(library['weights'].indices)
+		library['columns'] = (voxels, library['weights'][:, voxels].tocsr())
+	return library['columns']
+
+
+##########################################################
+# ===Label tables=== #
+##########################################################
+
+# Returns {value: name} from the VALUE_LABEL_DTABLE attribute AFNI stores in the header of an atlas ({} if none)
+def header_label_table(header):
+	return dict((int(value), name) for value, name in label_table_pattern.findall(header.get('VALUE_LABEL_DTABLE', "")))
+
+
+# Reads a label table from a text file with one "value name" pair per line (e.g. "12 Left_Hippocampus")
+# Blank lines and lines starting with # are skipped.
+def read_label_table(label_table_path):
+	if not os.path.exists(label_table_path):
+		sys.exit("XXXXX\nLabel table not found: %s\nXXXXX" % label_table_path)
+	label_table = {}
+	with open(label_table_path, 'r') as label_file:
+		for line in label_file:
+			line = line.strip()
+			if not line or line.startswith("#"):
+				continue
+			splits = line.split(None, 1)
+			try:
+				value = int(splits[0])
+			except ValueError:
+				sys.exit("XXXXX\nEvery line of the label table %s should start with an integer label value:\n%s\nXXXXX" % (label_table_path, line))
+			if len(splits) > 1:
+				label_table[value] = splits[1].strip()
+			else:
+				label_table[value] = splits[0]
+	return label_table
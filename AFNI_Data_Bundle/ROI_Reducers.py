@@ -0,0 +1,95 @@
+####################################################################################################################
+# ===ROI Reducers=== #
+# Summary statistics of the voxels inside an ROI, besides the mean that 3dmaskave prints. Every requested statistic
+# ("reducer") is computed from the same block of voxel values (sub-bricks x ROI voxels) that is already loaded for the
+# mean, so asking for more of them does not mean another pass over the data. The voxels are sorted once per ROI, and
+# the median, trimmed mean, peak and top-N% mean are all read from that sorted block.
+#
+# Reducers are given as strings, with an optional percentage after a colon:
+#   mean, median, sd (across voxels, ddof=1), count (number of voxels), peak (highest voxel value),
+#   trimmed_mean:P (mean without the lowest and highest P% of voxels, default 10),
+#   top:P (mean of the highest P% of voxels, default 10)
+# Voxels are not weighted: in a probabilistic mask, every voxel above 0 counts the same for these statistics.
+####################################################################################################################
+
+
+import sys
+import numpy
+
+
+reducer_names = ['mean', 'median', 'trimmed_mean', 'sd', 'count', 'peak', 'top']
+default_percentages = {'trimmed_mean': 10.0, 'top': 10.0}
+
+
+# Splits a reducer string into its name and percentage ('top:5' -> ('top', 5.0)); the script stops if it is unknown
+def parse_reducer(reducer):
+	splits = str(reducer).lower().split(":")
+	name = splits[0].strip()
+	if name not in reducer_names or len(splits) > 2 or (len(splits) == 2 and name not in default_percentages):
+		sys.exit("XXXXX\nUnknown ROI statistic '%s'. Choose from: %s\n(trimmed_mean and top may be followed by a percentage, e.g. 'top:5')\nXXXXX" % (reducer, ", ".join(reducer_names)))
+	percentage = default_percentages.get(name)
+	if len(splits) == 2:
+		try:
+			percentage = float(splits[1])
+		except ValueError:
+			percentage = -1
+		if not 0 < percentage < (50 if name == 'trimmed_mean' else 100.000001):
+			sys.exit("XXXXX\nPlease give a valid percentage for the ROI statistic '%s'.\nXXXXX" % reducer)
+	return name, percentage
+
+
+# Returns the column name a reducer's values are saved under ('median', 'trimmed_mean10', 'top5'...)
+def reducer_column(reducer):
+	name, percentage = parse_reducer(reducer)
+	if percentage is None:
+		return name
+	return "%s%g" % (name, percentage)
+
+
+# Returns the column names of a list of reducers, without duplicates and without the mean (which every run saves)
+def reducer_columns(reducers):
+	columns = []
+	for reducer in reducers or []:
+		column = reducer_column(reducer)
+		if column != 'mean' and column not in columns:
+			columns.append(column)
+	return columns
+
+
+# Computes every reducer in columns (from reducer_columns) for a block of voxel values (sub-bricks x voxels)
+# Returns {column: array with one value per sub-brick}
+def reduce_block(block, columns):
+	block = numpy.asarray(block, dtype=numpy.float64)
+	voxel_count = block.shape[1]
+	statistics = {}
+	if not columns:
+		return statistics
+
+	ordered = None
+	if any(column != 'count' and column != 'sd' for column in columns):
+		ordered = numpy.sort(block, axis=1)  # shared by median, trimmed mean, peak and top-N%
+
+	for column in columns:
+		name = column.rstrip("0123456789.")
+		if voxel_count == 0:
+			statistics[column] = numpy.full(block.shape[0], numpy.nan)
+		elif name == 'mean':
+			statistics[column] = block.mean(axis=1)
+		elif name == 'count':
+			statistics[column] = numpy.full(block.shape[0], float(voxel_count))
+		elif name == 'sd':
+			if voxel_count > 1:
+				statistics[column] = block.std(axis=1, ddof=1)
+			else:
+				statistics[column] = numpy.full(block.shape[0], numpy.nan)
+		elif name == 'median':
+			statistics[column] = numpy.median(ordered, axis=1)
+		elif name == 'peak':
+			statistics[column] = ordered[:, -1]
+		elif name == 'trimmed_mean':
+			cut = int(voxel_count * float(column[len(name):]) / 100.0)  # same cut as scipy.stats.trim_mean
+			statistics[column] = ordered[:, cut:voxel_count - cut].mean(axis=1)
+		elif name == 'top':
+			keep = max(1, int(numpy.ceil(voxel_count * float(column[len(name):]) / 100.0)))
+			statistics[column] = ordered[:, voxel_count - keep:].mean(axis=1)
+	return statistics
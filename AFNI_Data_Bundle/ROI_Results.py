@@ -0,0 +1,168 @@
+####################################################################################################################
+# ===ROI Results=== #
+# Holds extracted ROI values as one table with a column per field (subject, GLM, condition, ROI, timepoint, value,
+# voxels), in place of thousands of small "<ROI>.ave.<subject>.<condition>.txt" files. Each worker builds the rows for
+# its own unit and hands them back, the parent appends them, and the whole run is saved as a single .npz file (plus
+# a .parquet file if pandas and pyarrow/fastparquet are installed, or else a .csv.gz file), which NumPy, pandas or R
+# can read directly.
+# Other ROI statistics besides the mean (median, sd... see ROI_Reducers) are added as one more column each.
+# Tables too large to hold in memory (e.g. every trial of every subject in every parcel) can instead be streamed to a
+# file one block of rows at a time (open_table / write_rows / close_table), as CSV or as a compressed Parquet file.
+####################################################################################################################
+
+
+import os, sys, csv, gzip
+import numpy
+
+try:
+	import pandas
+except ImportError:
+	pandas = None
+
+try:
+	import pyarrow
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+
+columns = ['subject', 'GLM', 'condition', 'ROI', 'timepoint', 'value', 'voxels']
+column_types = {'timepoint': numpy.int32, 'value': numpy.float64, 'voxels': numpy.int32}  # the others are strings
+
+
+# Returns an empty results table ({column: list of values})
+def new_results():
+	return dict((column, []) for column in columns)
+
+
+# Adds one ROI's averages to a results table - one row per average (sub-brick/timepoint), numbered from 1
+# statistics holds any other statistics of the ROI ({column: one value per average}).
+def add_averages(results, subject, GLM, condition, ROI, averages, voxel_count, statistics=None):
+	for timepoint, average in enumerate(averages):
+		results['subject'].append(subject)
+		results['GLM'].append(GLM)
+		results['condition'].append(condition)
+		results['ROI'].append(ROI)
+		results['timepoint'].append(timepoint + 1)
+		results['value'].append(float(average))
+		results['voxels'].append(int(voxel_count))
+	for column in statistics or {}:
+		results.setdefault(column, []).extend(float(x) for x in statistics[column])
+
+
+# Returns the statistic columns of a results table (every column besides the standard ones), in sorted order
+def statistic_columns(results):
+	return sorted(column for column in results if column not in columns)
+
+
+# Appends the rows of more_results to results
+def extend_results(results, more_results):
+	for column in columns + statistic_columns(more_results):
+		results.setdefault(column, []).extend(more_results[column])
+	return results
+
+
+# Returns a results table as {column: NumPy array}
+def results_arrays(results):
+	arrays = {}
+	for column in columns + statistic_columns(results):
+		if column not in columns:
+			arrays[column] = numpy.array(results[column], dtype=numpy.float64)
+		elif column in column_types:
+			arrays[column] = numpy.array(results[column], dtype=column_types[column])
+		else:
+			arrays[column] = numpy.array(results[column], dtype=str)
+	return arrays
+
+
+# Saves a results table as results_path (.npz), and beside it as a .parquet file when pandas can write one, or else
+# as a .csv.gz file (pandas is missing, or has no parquet engine). Returns the paths of the two files.
+def save_results(results_path, results):
+	arrays = results_arrays(results)
+	temp_path = results_path[:-4] + ".%s.tmp.npz" % os.getpid()
+	numpy.savez_compressed(temp_path, **arrays)
+	os.rename(temp_path, results_path)
+	table_columns = columns + statistic_columns(arrays)
+	if pandas is not None:
+		try:
+			pandas.DataFrame(arrays, columns=table_columns).to_parquet(results_path[:-4] + ".parquet", index=False)
+			return results_path, results_path[:-4] + ".parquet"
+		except ImportError:  # pandas is installed, but without a parquet engine
+			pass
+	table_types = {'timepoint': 'int32', 'voxels': 'int32'}
+	table = open_table(results_path[:-4] + ".csv.gz", [(column, table_types.get(column, 'float64' if arrays[column].dtype.kind == 'f' else 'str')) for column in table_columns])
+	write_rows(table, arrays)
+	return results_path, close_table(table)
+
+
+##########################################################
+# ===Streamed tables=== #
+##########################################################
+
+# Opens a table file to be written one block of rows at a time (e.g. one subject at a time), so that only one block
+# is ever held in memory. The format follows the extension of table_path:
+#   .csv / .csv.gz - one line per row, with a header line
+#   .parquet - a compressed columnar file, with one row group per block (needs pyarrow)
+# columns lists (name, type) - type is 'str', 'category' (strings stored once per row group, e.g. ROI names), 'int32'
+# or 'float64', which become the column types of a Parquet file (R and pandas read them back with those types).
+# Rows go to a temporary file, which only takes table_path's place once close_table is called.
+def open_table(table_path, columns):
+	table = {'path': table_path,
+			 'temp_path': "%s.%s.tmp" % (table_path, os.getpid()),
+			 'columns': list(columns),
+			 'rows': 0}
+	if table_path.endswith(".parquet"):
+		if pyarrow is None:
+			raise ImportError("pyarrow is needed to write %s" % table_path)
+		types = {'str': pyarrow.string(), 'category': pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+				 'int32': pyarrow.int32(), 'float64': pyarrow.float64()}
+		table['schema'] = pyarrow.schema([(name, types[column_type]) for name, column_type in table['columns']])
+		table['writer'] = pyarrow.parquet.ParquetWriter(table['temp_path'], table['schema'], compression='zstd')
+		return table
+
+	if table_path.endswith(".gz") and sys.version_info[0] >= 3:
+		table['file'] = gzip.open(table['temp_path'], 'wt', newline='')
+	elif table_path.endswith(".gz"):
+		table['file'] = gzip.open(table['temp_path'], 'wb')
+	else:
+		table['file'] = open(table['temp_path'], 'w')
+	table['writer'] = csv.writer(table['file'])
+	table['writer'].writerow([name for name, column_type in table['columns']])
+	return table
+
+
+# Writes a block of rows to a table opened by open_table - block is {column name: sequence of values}, with the same
+# number of values in every column
+def write_rows(table, block):
+	if 'schema' in table:
+		arrays = []
+		for (name, column_type), field in zip(table['columns'], table['schema']):
+			if column_type == 'category':
+				arrays.append(pyarrow.array(list(block[name]), pyarrow.string()).dictionary_encode().cast(field.type))
+			elif column_type == 'str':
+				arrays.append(pyarrow.array(list(block[name]), pyarrow.string()))
+			else:
+				arrays.append(pyarrow.array(numpy.asarray(block[name], dtype=column_type)))
+		batch = pyarrow.Table.from_arrays(arrays, schema=table['schema'])
+		table['writer'].write_table(batch)
+		table['rows'] += batch.num_rows
+		return
+
+	values = []
+	for name, column_type in table['columns']:
+		if column_type in ['int32', 'float64']:
+			values.append(numpy.asarray(block[name], dtype=column_type).tolist())
+		else:
+			values.append(list(block[name]))
+	table['writer'].writerows(zip(*values))
+	table['rows'] += len(values[0]) if values else 0
+
+
+# Finishes a table opened by open_table, moves it to its path, and returns the path
+def close_table(table):
+	if 'schema' in table:
+		table['writer'].close()
+	else:
+		table['file'].close()
+	os.rename(table['temp_path'], table['path'])
+	return table['path']
@@ -0,0 +1,266 @@
+####################################################################################################################
+# ===Run Trace=== #
+# Records where the time of a run goes, as nested spans: the whole run, each stage (geometry check, extraction,
+# aggregation...), and each subject/GLM unit inside them. Every span records its wall time, the time spent waiting
+# on external commands (Command_Runner) versus the time spent in Python, the summed run time of those commands, and
+# the bytes of voxel data read from datasets (AFNI_Datasets).
+#
+# Tracing is off unless a run is started with a trace path (or the AFNI_TRACE environment variable is set), so the
+# scripts pay nothing for it otherwise. Spans are written as they end, one JSON object per line, in the "complete
+# event" format of the Chrome trace viewer (chrome://tracing, or ui.perfetto.dev):
+#   trace path ending in .json - the lines are turned into one Chrome trace file when the run finishes
+#   any other trace path - the JSON lines are kept as they are (e.g. run_trace.jsonl)
+# Worker processes (Job_Scheduler) and scripts started by a traced script find the run through the AFNI_TRACE_EVENTS
+# environment variable, and append their spans to the same file.
+#
+# With profiling on (profile=True, or AFNI_PROFILE=1), every stage or unit span that is not already inside a profiled
+# span of the same thread is also run under cProfile, and its stats are saved in a "<trace path>.profiles" folder
+# (one .prof file per span, readable with pstats or snakeviz).
+####################################################################################################################
+
+
+import os, re, json, time, atexit, threading, cProfile
+from contextlib import contextmanager
+
+
+trace_variable = "AFNI_TRACE"  # trace path set by the user, for scripts without a trace setting of their own
+profile_variable = "AFNI_PROFILE"
+events_variable = "AFNI_TRACE_EVENTS"  # set by start(), so every process of a run writes to the same file
+profiles_variable = "AFNI_TRACE_PROFILES"
+
+thread_state = threading.local()  # the spans open on each thread
+event_lock = threading.Lock()
+run = {}  # the run started by this process: {'trace_path', 'events_path', 'span', 'owner'}
+profile_count = [0]
+
+
+# True if spans are being recorded
+def enabled():
+	return bool(os.environ.get(events_variable))
+
+
+# Returns the spans open on this thread, innermost last
+# (a worker process forked from a traced thread starts with none of the spans it inherited open)
+def open_spans():
+	if getattr(thread_state, 'pid', None) != os.getpid():
+		thread_state.pid = os.getpid()
+		thread_state.stack = []
+		thread_state.waiting = 0
+	return thread_state.stack
+
+
+##########################################################
+# ===Runs=== #
+##########################################################
+
+# Starts recording a run called name, if trace_path (or AFNI_TRACE) is given; otherwise does nothing
+# A script started by an already traced script (or a second run in the same process) adds its spans to that trace.
+def start(name, trace_path=None, profile=None):
+	if run:
+		finish()
+	owner = False
+	if not enabled():
+		trace_path = trace_path or os.environ.get(trace_variable)
+		if not trace_path:
+			return
+		trace_path = os.path.abspath(os.path.expanduser(trace_path))
+		if profile is None:
+			profile = os.environ.get(profile_variable, "").lower() in ["1", "true", "yes"]
+		if trace_path.endswith(".json"):
+			events_path = trace_path + ".events.jsonl"
+		else:
+			events_path = trace_path
+		open(events_path, 'w').close()
+		profiles_folder = ""
+		if profile:
+			profiles_folder = trace_path + ".profiles"
+			if not os.path.exists(profiles_folder):
+				os.makedirs(profiles_folder)
+		os.environ[events_variable] = events_path
+		os.environ[profiles_variable] = profiles_folder
+		owner = True
+	atexit.register(finish)  # also end the run if the script stops early
+	run.update({'trace_path': trace_path,
+				'events_path': os.environ[events_variable],
+				'owner': owner})
+	run['span'] = begin_span(name, 'run')
+
+
+# Ends the run started by start(): closes its span, and for the process that started the trace, writes the Chrome
+# trace file (for a .json trace path) and prints where the time went
+def finish():
+	if not run:
+		return
+	end_span(run['span'])
+	trace_path = run['trace_path']
+	events_path = run['events_path']
+	owner = run['owner']
+	run.clear()
+	if not owner:
+		return
+	del os.environ[events_variable]
+	del os.environ[profiles_variable]
+
+	events = read_events(events_path)
+	print_summary(events)
+	if trace_path.endswith(".json"):
+		with open(trace_path, 'w') as trace_file:
+			json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+		os.remove(events_path)
+	print("Run trace saved to: " + trace_path)
+
+
+##########################################################
+# ===Spans=== #
+##########################################################
+
+# Opens a span on this thread and returns it (None if tracing is off); args are saved with it (e.g. subject=...)
+def begin_span(name, category='stage', **args):
+	if not enabled():
+		return None
+	stack = open_spans()
+	span = {'name': name,
+			'category': category,
+			'args': args,
+			'start': time.time(),
+			'subprocess_seconds': 0.0,
+			'wait_seconds': 0.0,
+			'bytes_read': 0,
+			'profiler': None}
+	if os.environ.get(profiles_variable) and category != 'run' and not any(x['profiler'] for x in stack):
+		span['profiler'] = cProfile.Profile()
+		span['profiler'].enable()
+	stack.append(span)
+	return span
+
+
+# Closes a span opened by begin_span, and writes it to the trace
+def end_span(span):
+	if span is None:
+		return
+	seconds = time.time() - span['start']
+	stack = open_spans()
+	if span in stack:
+		stack.remove(span)
+	if span['profiler'] is not None:
+		span['profiler'].disable()
+		with event_lock:
+			profile_count[0] += 1
+			number = profile_count[0]
+		label = "_".join([span['name']] + [str(span['args'][key]) for key in sorted(span['args'])])
+		label = re.sub(r'[^A-Za-z0-9_.-]+', "_", label)
+		span['profiler'].dump_stats(os.path.join(os.environ[profiles_variable], "%s_%s_%s.prof" % (label, os.getpid(), number)))
+
+	args = dict(span['args'])
+	args.update({'seconds': round(seconds, 6),
+				 'python_seconds': round(max(0.0, seconds - span['wait_seconds']), 6),
+				 'wait_seconds': round(span['wait_seconds'], 6),
+				 'subprocess_seconds': round(span['subprocess_seconds'], 6),
+				 'bytes_read': span['bytes_read']})
+	add_event(span['name'], span['category'], span['start'], seconds, args)
+
+
+# Runs the code inside a "with" block as a span (see begin_span)
+@contextmanager
+def span(name, category='stage', **args):
+	opened = begin_span(name, category, **args)
+	try:
+		yield opened
+	finally:
+		end_span(opened)
+
+
+# Adds amount to a counter ('bytes_read', 'subprocess_seconds' or 'wait_seconds') of every span open on this thread
+def count(key, amount):
+	stack = open_spans()
+	if not stack:
+		return
+	with event_lock:
+		for open_span in stack:
+			open_span[key] += amount
+
+
+# Lets the code inside the "with" block (run on a worker thread) count towards spans opened by another thread,
+# e.g. the commands Command_Runner runs on its threads count towards the stage that asked for them
+@contextmanager
+def inherit(spans):
+	stack = open_spans()
+	waiting = thread_state.waiting
+	thread_state.stack = list(spans)
+	thread_state.waiting = 1  # the thread that opened the spans counts the waiting time
+	try:
+		yield
+	finally:
+		thread_state.stack = stack
+		thread_state.waiting = waiting
+
+
+# Counts the time inside the "with" block as time spent waiting on commands (once, even if these are nested)
+@contextmanager
+def waiting():
+	open_spans()
+	if thread_state.waiting or not thread_state.stack:
+		yield
+		return
+	thread_state.waiting = 1
+	starttime = time.time()
+	try:
+		yield
+	finally:
+		thread_state.waiting = 0
+		count('wait_seconds', time.time() - starttime)
+
+
+##########################################################
+# ===Events=== #
+##########################################################
+
+# Appends one Chrome trace "complete event" to the run's events file
+def add_event(name, category, starttime, seconds, args):
+	events_path = os.environ.get(events_variable)
+	if not events_path:
+		return
+	event = {'name': name,
+			 'cat': category,
+			 'ph': 'X',
+			 'ts': int(starttime * 1000000),
+			 'dur': int(seconds * 1000000),
+			 'pid': os.getpid(),
+			 'tid': threading.current_thread().ident,
+			 'args': args}
+	line = json.dumps(event) + "\n"
+	with event_lock:
+		with open(events_path, 'a') as events_file:
+			events_file.write(line)
+
+
+# Reads the events of a run from its JSON-lines file (a line cut short by a killed process is skipped)
+def read_events(events_path):
+	events = []
+	with open(events_path, 'r') as events_file:
+		for line in events_file:
+			try:
+				events.append(json.loads(line))
+			except ValueError:
+				pass
+	return events
+
+
+# Prints the total time of every stage and command from a run's events, longest first
+def print_summary(events):
+	totals = {}
+	for event in events:
+		if event['cat'] == 'run':
+			continue
+		key = (event['cat'], event['name'])
+		total = totals.setdefault(key, [0, 0.0, 0.0, 0.0, 0])
+		total[0] += 1
+		total[1] += event['dur'] / 1000000.0
+		total[2] += event['args'].get('python_seconds', 0.0)
+		total[3] += event['args'].get('subprocess_seconds', 0.0)
+		total[4] += event['args'].get('bytes_read', 0)
+	if not totals:
+		return
+	print("\n%-12s %-32s %7s %11s %11s %11s %11s" % ("kind", "span", "count", "seconds", "python", "commands", "MB read"))
+	for (category, name), total in sorted(totals.items(), key=lambda x: -x[1][1]):
+		print("%-12s %-32s %7s %11.1f %11.1f %11.1f %11.1f" % (category, name[:32], total[0], total[1], total[2], total[3], total[4] / 1048576.0))
@@ -0,0 +1,140 @@
+####################################################################################################################
+# ===Sphere Masks=== #
+# Builds spherical ROI masks (the equivalent of 3dUndump -srad -xyz) directly from a dataset's grid, and caches them.
+# A sphere only depends on its center, its radius and the grid it is drawn on, so each one is built once per unique
+# grid geometry (dimensions + IJK_TO_DICOM matrix + orientation) and reused for every subject, GLM and condition on
+# that grid. Spheres are stored as voxel index arrays, and saved to disk so that later runs can reuse them.
+####################################################################################################################
+
+
+import os, re, hashlib
+import numpy
+
+
+orient_codes = ['R', 'L', 'P', 'A', 'I', 'S']  # ORIENT_SPECIFIC codes 0-5 (the letter each axis starts from)
+
+sphere_cache = {}  # geometry key -> {sphere key: voxel indices}
+
+
+##########################################################
+# ===Grid geometry=== #
+##########################################################
+
+# Returns the grid of a dataset as (dimensions, 3x4 IJK_TO_DICOM matrix, orientation string like "RAI")
+def grid_geometry(dataset):
+	header = dataset['header']
+	orient = header.get('ORIENT_SPECIFIC', [0, 3, 4])
+	if 'IJK_TO_DICOM' in header:  # the cardinal grid AFNI programs like 3dUndump work on (not IJK_TO_DICOM_REAL)
+		matrix = numpy.array(header['IJK_TO_DICOM'], dtype=numpy.float64).reshape(3, 4)
+	else:  # older datasets: each axis runs along one DICOM axis, starting at ORIGIN and stepping by DELTA
+		matrix = numpy.zeros((3, 4))
+		for axis in range(3):
+			dicom_axis = orient[axis] // 2
+			matrix[dicom_axis, axis] = header['DELTA'][axis]
+			matrix[dicom_axis, 3] = header['ORIGIN'][axis]
+	orientation = "".join(orient_codes[code] for code in orient[:3])
+	return dataset['dims'], matrix, orientation
+
+
+# Returns a short string that is identical for any two datasets on the same grid
+def geometry_key(dataset):
+	dims, matrix, orientation = grid_geometry(dataset)
+	description = "%s_%s_%s" % ("x".join(str(x) for x in dims), " ".join("%.4f" % x for x in matrix.ravel()), orientation)
+	return hashlib.sha1(description.encode('utf-8')).hexdigest()[:16]
+
+
+##########################################################
+# ===Spheres=== #
+##########################################################
+
+# Reads the three coordinates from an ROI text file ("-5 42.5 21", "-5,42.5,21", "(-5, 42.5, 21)"...)
+def read_coordinates(coord_path):
+	with open(coord_path, 'r') as coord_file:
+		coordinate_values = coord_file.readline()
+	return tuple(float(value) for value in re.findall(r"[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?", coordinate_values)[:3])
+
+
+# Returns the flat voxel indices (x fastest, then y, then z) of every voxel within radius mm of a coordinate
+# Like 3dUndump, the coordinate is first moved to the nearest voxel, and the coordinate order is RAI (DICOM)
+# unless the AFNI_ORIENT environment variable says otherwise.
+def sphere_voxels(dims, matrix, center, radius, coord_order="RAI"):
+	dicom_center = numpy.zeros(3)
+	for position, letter in enumerate(coord_order.upper()):
+		dicom_axis = "RLPAIS".index(letter) // 2
+		if letter in "RAI":
+			dicom_center[dicom_axis] = center[position]
+		else:
+			dicom_center[dicom_axis] = -center[position]
+
+	rotation = matrix[:, :3]
+	center_ijk = numpy.rint(numpy.linalg.solve(rotation, dicom_center - matrix[:, 3])).astype(int)
+	if numpy.any(center_ijk < 0) or numpy.any(center_ijk >= numpy.array(dims)):
+		return numpy.zeros(0, dtype=numpy.int32)
+
+	voxel_sizes = numpy.sqrt((rotation ** 2).sum(axis=0))
+	reach = numpy.floor(radius / voxel_sizes + 1e-6).astype(int)
+	ranges = []
+	for axis in range(3):
+		ranges.append(numpy.arange(max(0, center_ijk[axis] - reach[axis]), min(dims[axis], center_ijk[axis] + reach[axis] + 1)))
+	i, j, k = numpy.meshgrid(ranges[0], ranges[1], ranges[2], indexing='ij')
+	steps = numpy.vstack([i.ravel(), j.ravel(), k.ravel()]) - center_ijk[:, None]
+	distances = numpy.sqrt(((rotation.dot(steps)) ** 2).sum(axis=0))
+	inside = distances <= radius + 1e-6
+	voxels = i.ravel()[inside] + dims[0] * (j.ravel()[inside] + dims[1] * k.ravel()[inside])
+	return numpy.sort(voxels).astype(numpy.int32)
+
+
+##########################################################
+# ===Cache=== #
+##########################################################
+
+# Path of the cache file for one grid geometry
+def cache_path(cache_folder, key):
+	return os.path.join(cache_folder, "spheres_%s.npz" % key)
+
+
+# Loads the spheres already saved for a grid geometry (if any) into memory
+def load_geometry_cache(cache_folder, key):
+	if key not in sphere_cache:
+		sphere_cache[key] = {}
+		if cache_folder and os.path.exists(cache_path(cache_folder, key)):
+			saved = numpy.load(cache_path(cache_folder, key))
+			for sphere_key in saved.files:
+				sphere_cache[key][sphere_key] = saved[sphere_key]
+	return sphere_cache[key]
+
+
+# Saves the spheres for a grid geometry (written to a temporary file first, so a half-written cache is never read)
+# Spheres another process saved for the same geometry since it was loaded are merged in first, so they are kept.
+def save_geometry_cache(cache_folder, key):
+	if not os.path.exists(cache_folder):
+		try:
+			os.makedirs(cache_folder)
+		except OSError:  # another process created it first
+			pass
+	if os.path.exists(cache_path(cache_folder, key)):
+		saved = numpy.load(cache_path(cache_folder, key))
+		for sphere_key in saved.files:
+			if sphere_key not in sphere_cache[key]:
+				sphere_cache[key][sphere_key] = saved[sphere_key]
+	temp_path = cache_path(cache_folder, key) + ".%s.tmp.npz" % os.getpid()
+	numpy.savez(temp_path, **sphere_cache[key])
+	os.rename(temp_path, cache_path(cache_folder, key))
+
+
+# Returns {name: voxel indices} of the spheres in centers ({name: center}) on a dataset's grid
+# Only the spheres this grid has not seen before are built, and the cache file is saved once, after all of them.
+def sphere_masks(dataset, centers, radius, cache_folder=None, coord_order=None):
+	if coord_order is None:
+		coord_order = os.environ.get('AFNI_ORIENT', "RAI")
+	key = geometry_key(dataset)
+	spheres = load_geometry_cache(cache_folder, key)
+	sphere_keys = dict((name, "%s_r%s_%s" % ("_".join("%g" % x for x in centers[name]), radius, coord_order.upper())) for name in centers)
+	missing = [name for name in centers if sphere_keys[name] not in spheres]
+	if missing:
+		dims, matrix, orientation = grid_geometry(dataset)
+		for name in missing:
+			spheres[sphere_keys[name]] = sphere_voxels(dims, matrix, centers[name], float(radius), coord_order)
+		if cache_folder:
+			save_geometry_cache(cache_folder, key)
+	return dict((name, spheres[sphere_keys[name]]) for name in centers)
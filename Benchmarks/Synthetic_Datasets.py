@@ -0,0 +1,194 @@
+####################################################################################################################
+# ===Synthetic Datasets=== #
+# Builds a fake study on disk for benchmark_pipeline.py, with no AFNI install: +tlrc HEAD/BRIK datasets written
+# straight from NumPy (with AFNI_Datasets.write_dataset), in the folder layout the scripts of this package expect:
+#
+#   <folder>/subject_results/subj.<n>/<n>.results/GLM_GAM/stats.<n>+tlrc        condition betas ("<cond>#0_Coef")
+#   <folder>/subject_results/subj.<n>/<n>.results/GLM_TENT/iresp_<cond>.<n>+tlrc  one timecourse per condition
+#   <folder>/subject_results/subj.<n>/<n>.results/GLM_LME/stats.<n>+tlrc        trial betas ("Trial#<t>_Coef")
+#   <folder>/ROIs/            sphere coordinate files (.txt) and binary masks (+tlrc)
+#   <folder>/atlas/           an integer-labeled atlas and its label table
+#   <folder>/ttests/          group t-test datasets with a -Clustsim table in their header
+#
+# Voxel values are noise (the benchmarks only measure speed); the grid is an LPI, MNI-centered box, so coordinates
+# near 0,0,0 are always inside it.
+####################################################################################################################
+
+
+import os, sys, json, shutil
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "AFNI_Data_Bundle"))
+import AFNI_Datasets
+
+
+noise_blocks = 8  # distinct noise volumes generated per grid; every sub-brick is one of them plus an offset
+
+
+##########################################################
+# ===Writing datasets=== #
+##########################################################
+
+# Returns the .HEAD attributes of the LPI grid used by every synthetic dataset (dims = (x, y, z), delta in mm)
+def grid_header(dims, delta):
+	return {'DATASET_DIMENSIONS': [int(dims[0]), int(dims[1]), int(dims[2]), 0, 0],
+			'SCENE_DATA': [2, 11, 1],
+			'ORIENT_SPECIFIC': [1, 2, 4],
+			'ORIGIN': [(dims[0] - 1) * delta / 2.0, (dims[1] - 1) * delta / 2.0, -(dims[2] - 1) * delta / 2.0],
+			'DELTA': [-float(delta), -float(delta), float(delta)]}
+
+
+# Yields count noise sub-bricks for a grid, cheaply (a few noise volumes, each shifted by the sub-brick number)
+def noise_subbricks(noise, count):
+	for index in range(count):
+		yield noise[index % len(noise)] + numpy.float32(index * 0.01)
+
+
+##########################################################
+# ===ROIs=== #
+##########################################################
+
+# Returns the flat voxel indices of the grid points within radius voxels of center (x, y, z voxel indices)
+def ball_voxels(dims, center, radius):
+	x, y, z = numpy.meshgrid(numpy.arange(dims[0]), numpy.arange(dims[1]), numpy.arange(dims[2]), indexing='ij')
+	inside = (x - center[0]) ** 2 + (y - center[1]) ** 2 + (z - center[2]) ** 2 <= radius ** 2
+	return numpy.flatnonzero(inside.transpose(2, 1, 0).ravel())  # AFNI's order: x fastest, then y, then z
+
+
+# Returns an integer atlas on the grid: an ellipsoid "brain" cut into label_count parcels (labels 1..label_count)
+def atlas_labels(dims, label_count, rng):
+	x, y, z = numpy.meshgrid(numpy.arange(dims[0]), numpy.arange(dims[1]), numpy.arange(dims[2]), indexing='ij')
+	center = [(d - 1) / 2.0 for d in dims]
+	inside = ((x - center[0]) / (dims[0] * 0.45)) ** 2 + ((y - center[1]) / (dims[1] * 0.45)) ** 2 + ((z - center[2]) / (dims[2] * 0.45)) ** 2 <= 1
+	seeds = numpy.array([rng.randint(0, d, label_count) for d in dims]).T  # every voxel joins its nearest seed
+	points = numpy.column_stack([x[inside], y[inside], z[inside]])
+	nearest = numpy.zeros(len(points), dtype=numpy.int64)
+	best = numpy.full(len(points), numpy.inf)
+	for label, seed in enumerate(seeds):
+		distance = ((points - seed) ** 2).sum(axis=1)
+		closer = distance < best
+		best[closer] = distance[closer]
+		nearest[closer] = label + 1
+	labels = numpy.zeros(dims, dtype=numpy.int16)
+	labels[inside] = nearest
+	return labels.transpose(2, 1, 0).ravel()
+
+
+# Returns the header attribute (name, text) 3dttest++ -Clustsim adds for NN_level and sided, with minimum cluster sizes that
+# shrink as p and alpha get stricter (the layout cluster_and_map_vol_to_surface.py reads)
+def clustsim_attribute(NN_level, sided, pthresholds, athresholds):
+	rows = []
+	for p in pthresholds:
+		rows.append(" " + " ".join("%.1f" % (4.0 / p ** 0.3 / a ** 0.2) for a in athresholds))
+	text = ("<3dClustSim_%s\n"
+			"  ni_type=\"%s*float\"\n"
+			"  ni_dimen=\"%s\"\n"
+			"  pthr=\"%s\"\n"
+			"  athr=\"%s\"\n"
+			"  mask_count=\"0\" >\n"
+			"%s\n"
+			"</3dClustSim_%s>") % (NN_level, len(athresholds), len(pthresholds), ",".join("%f" % p for p in pthresholds),
+								   ",".join("%g" % a for a in athresholds), "\n".join(rows), NN_level)
+	return "AFNI_CLUSTSIM_%s_%s" % (NN_level, sided), text
+
+
+##########################################################
+# ===Study=== #
+##########################################################
+
+# Returns the size in bytes of the study a spec describes (see make_study)
+def study_bytes(spec):
+	nvox = spec['grid'][0] * spec['grid'][1] * spec['grid'][2]
+	subbricks = 1 + 2 * spec['conditions'] + spec['conditions'] * spec['timepoints'] + 1 + 2 * spec['trials']
+	return nvox * 4 * (subbricks * spec['subjects'] + 2 * spec['cluster_files'])
+
+
+# Writes a synthetic study into folder, as described by spec:
+#   grid (x, y, z), delta (mm), subjects, conditions, timepoints (per TENT iresp file), trials (LME stats file),
+#   spheres (coordinate files), masks (binary masks), atlas_labels, cluster_files (t-test datasets), gz (gzipped BRIKs)
+# A folder already holding a study with the same spec is reused as it is. Returns the paths of the study:
+# {'subject_results', 'ROIs', 'atlas', 'label_table', 'ttests', 'subjects': [subject numbers], 'conditions': [...]}
+def make_study(folder, spec, seed=0):
+	spec_path = os.path.join(folder, "study_spec.json")
+	study = {'subject_results': os.path.join(folder, "subject_results"),
+			 'ROIs': os.path.join(folder, "ROIs"),
+			 'atlas': os.path.join(folder, "atlas", "atlas+tlrc.HEAD"),
+			 'label_table': os.path.join(folder, "atlas", "atlas_labels.txt"),
+			 'ttests': os.path.join(folder, "ttests"),
+			 'subjects': ["%02d" % (x + 1) for x in range(spec['subjects'])],
+			 'conditions': ["cond%s" % chr(ord('A') + x) for x in range(spec['conditions'])]}
+	if os.path.exists(spec_path):
+		with open(spec_path, 'r') as spec_file:
+			if json.load(spec_file) == json.loads(json.dumps(spec)):
+				return study
+	for old_folder in [study['subject_results'], study['ROIs'], os.path.dirname(study['atlas']), study['ttests']]:  # a study of another spec
+		if os.path.exists(old_folder):
+			shutil.rmtree(old_folder)
+
+	rng = numpy.random.RandomState(seed)
+	dims = tuple(spec['grid'])
+	grid = grid_header(dims, spec['delta'])
+	delta = spec['delta']
+	nvox = dims[0] * dims[1] * dims[2]
+	noise = [rng.standard_normal(nvox).astype(numpy.float32) for x in range(noise_blocks)]
+	gz = spec.get('gz', False)
+
+	for subject in study['subjects']:
+		results_folder = os.path.join(study['subject_results'], "subj." + subject, subject + ".results")
+		for GLM_folder in ["GLM_GAM", "GLM_TENT", "GLM_LME"]:
+			if not os.path.exists(os.path.join(results_folder, GLM_folder)):
+				os.makedirs(os.path.join(results_folder, GLM_folder))
+
+		labels = ["Full_Fstat"]
+		for condition in study['conditions']:
+			labels += [condition + "#0_Coef", condition + "#0_Tstat"]
+		AFNI_Datasets.write_dataset(os.path.join(results_folder, "GLM_GAM", "stats." + subject), noise_subbricks(noise, len(labels)), grid, labels, gz=gz)
+
+		for condition in study['conditions']:
+			labels = ["%s#%s" % (condition, x) for x in range(spec['timepoints'])]
+			AFNI_Datasets.write_dataset(os.path.join(results_folder, "GLM_TENT", "iresp_%s.%s" % (condition, subject)), noise_subbricks(noise, len(labels)), grid, labels, gz=gz)
+
+		labels = ["Full_Fstat"]
+		for trial in range(spec['trials']):
+			labels += ["Trial#%s_Coef" % trial, "Trial#%s_Tstat" % trial]
+		AFNI_Datasets.write_dataset(os.path.join(results_folder, "GLM_LME", "stats." + subject), noise_subbricks(noise, len(labels)), grid, labels, gz=gz)
+
+	# ROIs: sphere coordinates (LPI mm, within the middle of the grid) and binary masks (balls of voxels)
+	if not os.path.exists(study['ROIs']):
+		os.makedirs(study['ROIs'])
+	extent = [(d - 1) * delta / 2.0 * 0.5 for d in dims]
+	for number in range(spec['spheres']):
+		coordinates = [rng.uniform(-x, x) for x in extent]
+		with open(os.path.join(study['ROIs'], "sphere%02d.txt" % number), 'w') as coordinate_file:
+			coordinate_file.write("%.1f %.1f %.1f\n" % tuple(coordinates))
+	for number in range(spec['masks']):
+		center = [rng.randint(d // 4, 3 * d // 4) for d in dims]
+		mask = numpy.zeros(nvox, dtype=numpy.uint8)
+		mask[ball_voxels(dims, center, rng.randint(2, 5))] = 1
+		AFNI_Datasets.write_dataset(os.path.join(study['ROIs'], "mask%02d" % number), [mask], grid, ["mask"], brick_types=0)
+
+	# atlas, with its label table
+	if not os.path.exists(os.path.dirname(study['atlas'])):
+		os.makedirs(os.path.dirname(study['atlas']))
+	AFNI_Datasets.write_dataset(study['atlas'][:-10], [atlas_labels(dims, spec['atlas_labels'], rng)], grid, ["atlas"], brick_types=1)
+	with open(study['label_table'], 'w') as label_file:
+		for label in range(1, spec['atlas_labels'] + 1):
+			label_file.write("%s Parcel_%03d\n" % (label, label))
+
+	# group t-tests, with a -Clustsim table for every NN level and sidedness
+	if not os.path.exists(study['ttests']):
+		os.makedirs(study['ttests'])
+	pthresholds = [0.05, 0.02, 0.01, 0.005, 0.002, 0.001]
+	athresholds = [0.1, 0.05, 0.02, 0.01]
+	clustsim = dict(clustsim_attribute(NN_level, sided, pthresholds, athresholds) for NN_level in ["NN1", "NN2", "NN3"] for sided in ["1sided", "bisided"])
+	for number in range(spec['cluster_files']):
+		zscores = noise[number % len(noise)].copy()
+		# a few blobs of signal, so some clusters survive
+		for blob in range(6):
+			center = [rng.randint(d // 4, 3 * d // 4) for d in dims]
+			zscores[ball_voxels(dims, center, 3)] += 4.0
+		AFNI_Datasets.write_dataset(os.path.join(study['ttests'], "ttest%02d" % number), [zscores * 0.1, zscores], grid, ["SetA_mean", "SetA_Zscr"], attributes=clustsim)
+
+	with open(spec_path, 'w') as spec_file:
+		json.dump(spec, spec_file)
+	return study
@@ -0,0 +1,332 @@
+#!/usr/bin/python
+import os, sys, json, time, shutil, tempfile, platform, subprocess
+from datetime import datetime
+import numpy
+import scipy.ndimage
+import scipy.stats as st
+
+path = os.path.dirname(os.path.realpath(__file__))  # this script's directory path
+sys.path.append(os.path.join(os.path.dirname(path), "ROI_AFNI_tool"))
+sys.path.append(os.path.join(os.path.dirname(path), "Clustering_and_Vol_Surf_Convert"))
+import ROI_AFNI_batch
+from ROI_Extraction import AFNI_Datasets, ROI_Masks, ROI_Averages, Label_Index, Run_Trace
+import cluster_and_map_vol_to_surface
+import Synthetic_Datasets
+
+# This script times the pipelines of this package on a synthetic study (see Synthetic_Datasets.py), at one or more
+# scales, and prints throughput numbers that can be tracked over time. It needs no AFNI install:
+#
+# 1. ROI_AFNI_tool - the extraction that ROI_AFNI_tool.py and ROI_AFNI_batch.py run (geometry check, extraction,
+#    aggregation), for spheres, masks and an atlas, run once from scratch and once more reusing the ROI manifest
+# 2. LME_ROI_magnitudes - reading every trial beta of a participant and averaging it within every ROI mask
+# 3. cluster_and_map_vol_to_surface - reading the -Clustsim table, and masking the data with the cluster mask (the
+#    clustering itself is done by 3dclust, and the surface mapping needs Workbench, so neither is timed)
+# Only the ROI_AFNI_tool numbers come from running the script itself (through ROI_AFNI_batch). LME_ROI_magnitudes is a
+# GUI script, and cluster_and_map_vol_to_surface runs 3dclust, so for those two the library functions the scripts call
+# (Label_Index.trial_schema, ROI_Averages.roi_matrix, clustsim_table, masked_data) are timed instead. Their rows are
+# proxies: they leave out the rest of each script (e.g. 3dinfo calls and writing the results), and are marked as such
+# in the printed table and in the saved results ('proxy': true).
+
+
+usage = ("\n#########################\nThis script does the following:\n1. Writes a synthetic study (+tlrc datasets, ROI masks, coordinate files, an atlas and t-tests) at each scale\n"
+		 "2. Times each stage of the ROI extraction on it, and the library calls behind the LME trial averages and the\n"
+		 "   cluster correction (proxies for those two scripts, marked with * in the table)\n"
+		 "3. Prints the time and throughput of every stage (and optionally saves them, to compare runs over time)\n"
+		 "#########################\n\n"
+		 "Usage:  python benchmark_pipeline.py [arg=value ...]\n\n"
+		 "Command argument options (all optional):\n\n"
+		 "   scale		= one or more of: small, medium, large (e.g. scale=small,medium). Default is 'small'.\n"
+		 "		  small: 32x38x32 grid, 4 subjects, 40 trials | medium: 64x76x64 grid, 12 subjects, 100 trials\n"
+		 "		  large: 64x76x64 grid, 50 subjects, 200 trials (about 30 GB of data)\n\n"
+		 "   subjects, trials, conditions, timepoints, spheres, masks, atlas_labels, cluster_files\n"
+		 "		= override that setting of every scale (e.g. trials=1000)\n\n"
+		 "   grid		= override the grid of every scale, e.g. grid=64x76x64\n\n"
+		 "   gz		= true/false - write gzipped .BRIK.gz files. Default is 'false'.\n\n"
+		 "   benchmarks	= which pipelines to time: roi, lme, cluster (e.g. benchmarks=roi,lme). Default is all of them.\n\n"
+		 "   processes	= number of worker processes for the ROI extraction. Default is '1'.\n\n"
+		 "   folder	= where to write the synthetic study. It is kept, and reused by later runs with the same settings.\n"
+		 "		  Default is a temporary folder, deleted at the end.\n\n"
+		 "   results	= file to append the results to, as one JSON line per scale (e.g. results=benchmarks.jsonl).\n\n"
+		 "All arguments must be provided in the form arg=value. 'help' prints this message.\n")
+
+
+scales = {'small': {'grid': [32, 38, 32], 'delta': 3, 'subjects': 4, 'conditions': 4, 'timepoints': 10, 'trials': 40,
+					'spheres': 8, 'masks': 4, 'atlas_labels': 50, 'cluster_files': 2},
+		  'medium': {'grid': [64, 76, 64], 'delta': 3, 'subjects': 12, 'conditions': 6, 'timepoints': 12, 'trials': 100,
+					 'spheres': 20, 'masks': 10, 'atlas_labels': 200, 'cluster_files': 4},
+		  'large': {'grid': [64, 76, 64], 'delta': 3, 'subjects': 50, 'conditions': 8, 'timepoints': 15, 'trials': 200,
+					'spheres': 40, 'masks': 20, 'atlas_labels': 400, 'cluster_files': 8}}
+
+ROI_analyses = ["sphere magnitude", "sphere timecourse", "mask magnitude", "atlas magnitude"]
+
+
+# Runs function(*args) with its printed output (and that of its worker processes) hidden
+def quietly(function, *args):
+	sys.stdout.flush()
+	saved = os.dup(1)
+	devnull = os.open(os.devnull, os.O_WRONLY)
+	os.dup2(devnull, 1)
+	try:
+		return function(*args)
+	finally:
+		sys.stdout.flush()
+		os.dup2(saved, 1)
+		os.close(devnull)
+		os.close(saved)
+
+
+# Returns a benchmark result row
+# proxy marks the rows that time the library calls of a script, rather than the script itself.
+def result_row(pipeline, case, stage, seconds, amount=None, unit=None, megabytes=None, proxy=False):
+	row = {'pipeline': pipeline, 'case': case, 'stage': stage, 'seconds': round(seconds, 4)}
+	if proxy:
+		row['proxy'] = True
+	if amount is not None and seconds > 0:
+		row['per_second'] = round(amount / seconds, 2)
+		row['unit'] = unit
+	if megabytes is not None and seconds > 0:
+		row['MB_per_second'] = round(megabytes / seconds, 2)
+	return row
+
+
+##########################################################
+# ===ROI_AFNI_tool=== #
+##########################################################
+
+# Times the ROI extraction of every analysis, first from scratch and then again reusing the results of the first run
+def benchmark_ROI(study, spec, folder, processes):
+	rows = []
+	for analysis in ROI_analyses:
+		method_ROI = {"sphere": "spherical", "mask": "predefined_mask", "atlas": "atlas"}[analysis.split()[0]]
+		method_type = {"magnitude": "magnitudes", "timecourse": "timecourses"}[analysis.split()[1]]
+		# start from scratch: no earlier results, manifest, spheres or geometry cache
+		for cached in [os.path.join(study['subject_results'], "Average_%s_ROI_%s" % (method_ROI, method_type)),
+					   os.path.join(study['subject_results'], "ROI_sphere_cache")]:
+			if os.path.exists(cached):
+				shutil.rmtree(cached)
+		if os.path.exists(os.path.join(study['subject_results'], "ROI_geometry_cache.json")):
+			os.remove(os.path.join(study['subject_results'], "ROI_geometry_cache.json"))
+
+		if method_type == "magnitudes":
+			subbricks = spec['subjects'] * spec['conditions']
+		else:
+			subbricks = spec['subjects'] * spec['conditions'] * spec['timepoints']
+		if method_ROI == "atlas":
+			ROI_count = spec['atlas_labels']
+		elif method_ROI == "spherical":
+			ROI_count = spec['spheres']
+		else:
+			ROI_count = spec['masks']
+
+		for run in ["first run", "rerun"]:
+			trace_path = os.path.join(folder, "trace_%s.jsonl" % analysis.replace(" ", "_"))
+			config = {'subject_results': study['subject_results'],
+					  'masks_path': study['ROIs'],
+					  'analyses': [analysis],
+					  'coord_system': "LPI",
+					  'sphere_radius': 2 * spec['delta'],
+					  'atlas': study['atlas'],
+					  'label_table': study['label_table'],
+					  'processes': processes,
+					  'trace': trace_path}
+			if method_type == "magnitudes":
+				config['GAM_GLMs'] = {"GLM_GAM": "all"}
+			else:
+				config['TENT_GLMs'] = {"GLM_TENT": "all"}
+			starttime = time.time()
+			quietly(ROI_AFNI_batch.run_config, config)
+			total = time.time() - starttime
+
+			events = Run_Trace.read_events(trace_path)
+			os.remove(trace_path)
+			stages = dict((event['name'], event['dur'] / 1000000.0) for event in events if event['cat'] == 'stage' and event['name'] in ["geometry check", "extraction", "aggregation"])
+			megabytes = sum(event['args']['bytes_read'] for event in events if event['cat'] == 'unit') / 1048576.0
+			case = "%s (%s)" % (analysis, run)
+			rows.append(result_row("ROI_AFNI_tool", case, "geometry check", stages.get("geometry check", 0.0), spec['subjects'], "GLM folders"))
+			rows.append(result_row("ROI_AFNI_tool", case, "extraction", stages.get("extraction", 0.0), subbricks * ROI_count, "ROI values", megabytes))
+			rows.append(result_row("ROI_AFNI_tool", case, "aggregation", stages.get("aggregation", 0.0), subbricks * ROI_count, "ROI values"))
+			rows.append(result_row("ROI_AFNI_tool", case, "total", total, subbricks, "sub-bricks"))
+	return rows
+
+
+##########################################################
+# ===LME_ROI_magnitudes=== #
+##########################################################
+
+# Times what LME_ROI_magnitudes.py does for every participant: finding the trial betas in the stats file, and
+# averaging every trial within every ROI mask (a proxy: the library calls the script makes, not the script itself)
+def benchmark_LME(study, spec):
+	mask_paths = dict((x[:-10], os.path.join(study['ROIs'], x)) for x in os.listdir(study['ROIs']) if x.endswith("+tlrc.HEAD"))
+	seconds = {'trial counts': 0.0, 'ROI masks': 0.0, 'trial averages': 0.0}
+	megabytes = 0.0
+	library = None
+	for subject in study['subjects']:
+		stats_path = os.path.join(study['subject_results'], "subj." + subject, subject + ".results", "GLM_LME", "stats.%s+tlrc.HEAD" % subject)
+
+		starttime = time.time()
+		dataset = AFNI_Datasets.open_dataset(stats_path)
+		trials = Label_Index.trial_schema(dataset, "*#*_Coef")['indices']
+		seconds['trial counts'] += time.time() - starttime
+
+		if library is None:  # the masks are read once, and used for every participant
+			starttime = time.time()
+			library = ROI_Masks.binary_library(mask_paths, dataset['dims'])
+			seconds['ROI masks'] += time.time() - starttime
+
+		starttime = time.time()
+		ROI_Averages.roi_matrix(dataset, trials, library)
+		seconds['trial averages'] += time.time() - starttime
+		megabytes += len(trials) * len(ROI_Masks.library_columns(library)[0]) * 4 / 1048576.0
+
+	values = spec['subjects'] * spec['trials'] * spec['masks']
+	return [result_row("LME_ROI_magnitudes", "trials x ROIs", "trial counts", seconds['trial counts'], spec['subjects'], "participants", proxy=True),
+			result_row("LME_ROI_magnitudes", "trials x ROIs", "ROI masks", seconds['ROI masks'], spec['masks'], "masks", proxy=True),
+			result_row("LME_ROI_magnitudes", "trials x ROIs", "trial averages", seconds['trial averages'], values, "trial ROI values", megabytes, proxy=True)]
+
+
+##########################################################
+# ===cluster_and_map_vol_to_surface=== #
+##########################################################
+
+# Times the cluster correction of every t-test (p = 0.01, alpha = 0.05, NN3, bisided): reading the -Clustsim table,
+# then masking the data with the clusters (masked_data, written to a temporary folder). The cluster mask 3dclust
+# would write is made (untimed) with scipy instead, so this is a proxy: 3dclust and the surface mapping are not timed.
+def benchmark_cluster(study, spec):
+	seconds = {'Clustsim table': 0.0, 'masked data': 0.0}
+	voxels = 0
+	thresh = round(st.norm.ppf(1 - 0.01 / 2), 3)
+	output_folder = tempfile.mkdtemp(prefix="benchmark_cluster_")
+	try:
+		for ttest in sorted(x for x in os.listdir(study['ttests']) if x.endswith(".HEAD")):
+			ttest_path = os.path.join(study['ttests'], ttest)
+			starttime = time.time()
+			with open(ttest_path) as header:
+				data = header.readlines()
+			pthresholds, pthresholds_float, athresholds, numbers_lists = cluster_and_map_vol_to_surface.clustsim_table(data, "NN3", "bisided")
+			voxel_number = float(dict(zip(athresholds, numbers_lists[pthresholds_float.index(0.01)]))['0.05'])
+			seconds['Clustsim table'] += time.time() - starttime
+
+			dataset = AFNI_Datasets.open_dataset(ttest_path)
+			zscores = AFNI_Datasets.subbrick(dataset, 1).reshape(dataset['dims'][::-1])
+			mask = numpy.zeros(zscores.shape, dtype=bool)
+			for sign in [1, -1]:  # bisided: positive and negative voxels are clustered separately
+				clusters, count = scipy.ndimage.label(sign * zscores > thresh, structure=numpy.ones((3, 3, 3)))  # NN3
+				sizes = numpy.bincount(clusters.ravel())
+				keep = sizes >= voxel_number
+				keep[0] = False
+				mask |= keep[clusters]
+			name = ttest[:-len(".HEAD")]
+			mask_path = os.path.join(output_folder, "clust_mask_" + name)
+			AFNI_Datasets.write_dataset(mask_path, [mask.ravel().astype(numpy.int16)], dataset, brick_types=1)
+
+			starttime = time.time()
+			cluster_and_map_vol_to_surface.masked_data(mask_path, ttest_path, os.path.join(output_folder, "masked_" + name))
+			seconds['masked data'] += time.time() - starttime
+			voxels += dataset['nvox']
+	finally:
+		shutil.rmtree(output_folder)
+
+	return [result_row("cluster_and_map_vol_to_surface", "p=0.01 NN3 bisided", "Clustsim table", seconds['Clustsim table'], spec['cluster_files'], "files", proxy=True),
+			result_row("cluster_and_map_vol_to_surface", "p=0.01 NN3 bisided", "masked data", seconds['masked data'], voxels, "voxels", proxy=True)]
+
+
+##########################################################
+# ===Main=== #
+##########################################################
+
+# Prints the rows of one scale as a table (proxy rows are marked with *)
+def print_rows(scale, rows):
+	print("\n%-32s %-36s %-16s %10s %28s %10s" % ("pipeline (%s)" % scale, "case", "stage", "seconds", "throughput (per second)", "MB/s"))
+	for row in rows:
+		throughput = ""
+		if 'per_second' in row:
+			throughput = "%.1f %s" % (row['per_second'], row['unit'])
+		pipeline = row['pipeline'] + (" *" if row.get('proxy') else "")
+		print("%-32s %-36s %-16s %10.3f %28s %10s" % (pipeline, row['case'], row['stage'], row['seconds'], throughput, row.get('MB_per_second', "")))
+	if any(row.get('proxy') for row in rows):
+		print("\n* proxy: times the library functions this script calls, not the script itself (its AFNI/Workbench commands,\n"
+			  "  GUI and result files are left out), so it is a lower bound for the script's run time.")
+
+
+# Returns the git commit of this package, if it is a git repository
+def git_commit():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=path, stderr=open(os.devnull, 'w')).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def main():
+	arguments = {}
+	for argument in sys.argv[1:]:
+		if argument in ["help", "-h", "--help"]:
+			print(usage)
+			sys.exit()
+		if "=" not in argument:
+			sys.exit("All arguments must be provided in the form arg=value (type 'help' for the options).")
+		name, value = argument.split("=", 1)
+		arguments[name] = value
+
+	chosen_scales = arguments.get('scale', "small").split(",")
+	for scale in chosen_scales:
+		if scale not in scales:
+			sys.exit("Please provide a valid option for the argument 'scale' (small, medium or large).")
+	benchmarks = arguments.get('benchmarks', "roi,lme,cluster").lower().split(",")
+	if any(x not in ["roi", "lme", "cluster"] for x in benchmarks):
+		sys.exit("Please provide a valid option for the argument 'benchmarks' (roi, lme and/or cluster).")
+	try:
+		processes = int(arguments.get('processes', 1))
+		overrides = dict((name, int(arguments[name])) for name in ['subjects', 'trials', 'conditions', 'timepoints', 'spheres', 'masks', 'atlas_labels', 'cluster_files'] if name in arguments)
+		if 'grid' in arguments:
+			overrides['grid'] = [int(x) for x in arguments['grid'].split("x")]
+			if len(overrides['grid']) != 3:
+				raise ValueError
+	except ValueError:
+		sys.exit("Please provide whole numbers for processes, grid (e.g. 64x76x64) and the scale settings.")
+	gz = arguments.get('gz', "false") == "true"
+
+	for scale in chosen_scales:
+		spec = dict(scales[scale])
+		spec.update(overrides)
+		spec['gz'] = gz
+
+		if 'folder' in arguments:
+			folder = os.path.join(os.path.abspath(arguments['folder']), scale)
+		else:
+			folder = tempfile.mkdtemp(prefix="afni_benchmark_")
+		print("\n#########################\nScale: %s (%s subjects, %s grid, %s trials)\nStudy folder: %s (about %.1f GB)\n#########################" % (
+			scale, spec['subjects'], "x".join(str(x) for x in spec['grid']), spec['trials'], folder, Synthetic_Datasets.study_bytes(spec) / 1e9))
+
+		try:
+			starttime = time.time()
+			study = Synthetic_Datasets.make_study(folder, spec)
+			rows = [result_row("synthetic data", "", "write/reuse", time.time() - starttime, megabytes=Synthetic_Datasets.study_bytes(spec) / 1048576.0)]
+
+			if "roi" in benchmarks:
+				print("timing ROI_AFNI_tool....")
+				rows += benchmark_ROI(study, spec, folder, processes)
+			if "lme" in benchmarks:
+				print("timing LME_ROI_magnitudes....")
+				rows += benchmark_LME(study, spec)
+			if "cluster" in benchmarks:
+				print("timing cluster_and_map_vol_to_surface....")
+				rows += benchmark_cluster(study, spec)
+		finally:
+			if 'folder' not in arguments:
+				shutil.rmtree(folder)
+
+		print_rows(scale, rows)
+		if 'results' in arguments:
+			with open(arguments['results'], 'a') as results_file:
+				results_file.write(json.dumps({'date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+											   'commit': git_commit(),
+											   'python': platform.python_version(),
+											   'processes': processes,
+											   'scale': scale,
+											   'spec': spec,
+											   'rows': rows}) + "\n")
+			print("Results added to: " + arguments['results'])
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+import os, sys
+import numpy
+
+path = os.path.dirname(os.path.realpath(__file__))  # this script's directory path
+sys.path.append(os.path.join(os.path.dirname(path), "AFNI_Data_Bundle"))
+import AFNI_Datasets, ROI_Masks, ROI_Averages
+
+# This script checks the ROI averages of this package against AFNI (3dmaskave), on a tiny dataset kept in Reference/:
+#   data+tlrc - a 4x3x2 grid with 3 sub-bricks (a scaled short sub-brick and two float sub-bricks)
+#   mask+tlrc - a byte mask with 6 nonzero voxels (not all of them 1, as 3dmaskave -mask counts every nonzero voxel)
+#   data_maskave.txt - the output of 3dmaskave for them, one "average [n voxels]" line per sub-brick:
+#       3dmaskave -mask Reference/mask+tlrc Reference/data+tlrc > Reference/data_maskave.txt
+#   data_weighted_mean.txt - the mean of every sub-brick weighted by the mask values (a weighted mask), one per line,
+#       which is the 3dmaskave average of data*mask divided by the 3dmaskave average of the mask:
+#       3dcalc -a Reference/data+tlrc -b Reference/mask+tlrc -expr 'a*b' -prefix weighted
+#       3dmaskave -quiet -mask Reference/mask+tlrc weighted+tlrc    (then divide by)
+#       3dmaskave -quiet -mask Reference/mask+tlrc Reference/mask+tlrc
+# Both ways the scripts average ROIs are checked: ROI_Averages.stacked_roi_averages (ROI_AFNI_tool) and
+# ROI_Averages.roi_matrix (LME_ROI_magnitudes), with a binary mask (ROI_Masks.binary_library) and with a weighted
+# mask (ROI_Masks.probabilistic_library). It needs no AFNI install, and stops with an error on any difference.
+
+
+reference = os.path.join(path, "Reference")
+
+
+# Returns the averages and voxel count of a 3dmaskave output file
+def read_maskave(maskave_path):
+	averages = []
+	voxel_counts = set()
+	with open(maskave_path, 'r') as maskave_file:
+		for line in maskave_file:
+			if line.strip():
+				average, voxels = line.split("[")
+				averages.append(float(average))
+				voxel_counts.add(int(voxels.split()[0]))
+	return numpy.array(averages), voxel_counts.pop()
+
+
+# Returns {name: (averages, voxel count)} of the mask's ROI in a library, from both ways of averaging
+def library_averages(dataset, library):
+	averages, voxel_count, statistics = ROI_Averages.stacked_roi_averages([dataset], [None], library)['mask']
+	return {'stacked_roi_averages': (averages[0], voxel_count),
+			'roi_matrix': (ROI_Averages.roi_matrix(dataset, range(dataset['nvals']), library)[:, 0], int(library['voxels'][0]))}
+
+
+dataset = AFNI_Datasets.open_dataset(os.path.join(reference, "data+tlrc"))
+mask_paths = {'mask': os.path.join(reference, "mask+tlrc")}
+expected, expected_voxels = read_maskave(os.path.join(reference, "data_maskave.txt"))
+weighted_expected = numpy.loadtxt(os.path.join(reference, "data_weighted_mean.txt"))
+checks = [("binary", ROI_Masks.binary_library(mask_paths, dataset['dims']), expected),
+		  ("weighted", ROI_Masks.probabilistic_library(mask_paths, dataset['dims']), weighted_expected)]
+
+failed = []
+for mask_type, library, mask_expected in checks:
+	results = library_averages(dataset, library)
+	for name in sorted(results):
+		averages, voxel_count = results[name]
+		# the reference values have 6 significant digits (%g, as 3dmaskave prints them)
+		if voxel_count != expected_voxels or len(averages) != len(mask_expected) or not numpy.allclose(averages, mask_expected, rtol=1e-5, atol=1e-6):
+			failed.append("%s mask, %s: %s [%s voxels], reference: %s [%s voxels]" % (mask_type, name, " ".join("%g" % x for x in averages), voxel_count,
+																					 " ".join("%g" % x for x in mask_expected), expected_voxels))
+		else:
+			print("%s mask, %s matches the reference (%s sub-bricks, %s voxels)" % (mask_type, name, len(mask_expected), expected_voxels))
+
+if failed:
+	sys.exit("XXXXX\nROI averages do not match the reference:\n%s\nXXXXX" % "\n".join(failed))
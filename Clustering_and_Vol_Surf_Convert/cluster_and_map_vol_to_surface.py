@@ -1,8 +1,12 @@
 #!/usr/bin/python
-import os, sys, operator, subprocess, string
+import os, sys, operator, string
+import numpy
 import scipy.stats as st
 # Written by N. Anderson 3/1/2018
 
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "AFNI_Data_Bundle"))
+import AFNI_Datasets, Command_Runner, Run_Trace
+
 # This script is meant to be used on the output of 3dttest++ when used with the -Clustsim option. This script will:
 
 # 1. Perform the equivalent of the AFNI GUI "Clusterize" function (using 3dclust)
@@ -15,6 +19,59 @@ import scipy.stats as st
 
 
 
+# Reads the -Clustsim table that 3dttest++ saved in a dataset's header, for NN_level ("NN1", "NN2" or "NN3") and
+# sided ("bisided" or "1sided"). data holds the lines of the .HEAD file.
+# Returns (p-value strings, p-values, alpha strings, minimum cluster sizes - one list per p-value, one size per alpha)
+def clustsim_table(data, NN_level, sided):
+	name = "AFNI_CLUSTSIM_%s_%s" % (NN_level, sided)
+
+	pthresholds = None
+	athresholds = None
+	numbers = []
+
+	start = False
+	numbers_start = False
+	for line in data:
+		if ("name = %s" % name) in line:
+			start = True
+		if start and "pthr=" in line:
+			pthresholds = line
+		if start and "athr=" in line:
+			athresholds = line
+		if start and "mask_count=" in line:
+			numbers_start = True
+			pass
+		if numbers_start and ("</3dClustSim_%s>~" % NN_level) in line:
+			break
+		if numbers_start and "mask_count" not in line:
+			numbers.append(line)
+
+	if not numbers:
+		sys.exit("Make sure that you have run your t-test with the -Clustsim option, and that the results were added to the your file's header.")
+
+
+	pthresholds = pthresholds[8:-2].split(",")
+	pthresholds_float = [float(x) for x in pthresholds]
+	athresholds = athresholds[8:-2].split(",")
+
+	numbers_lists = []
+
+	for item in numbers:
+		numbers_lists.append(item[1:-1].split(" "))
+
+	return pthresholds, pthresholds_float, athresholds, numbers_lists
+
+
+# Writes the first sub-brick of a dataset, set to 0 outside of a cluster mask, as a new dataset
+# (the equivalent of 3dcalc -a mask -b data'[0]' -expr 'step(a)*b', without starting 3dcalc)
+def masked_data(mask_path, data_path, output_path):
+	mask = AFNI_Datasets.open_dataset(mask_path)
+	data = AFNI_Datasets.open_dataset(data_path)
+	values = AFNI_Datasets.subbrick(data, 0)
+	values = numpy.where(AFNI_Datasets.subbrick(mask, 0) > 0, values, numpy.float32(0))
+	AFNI_Datasets.write_dataset(output_path, [values], data, labels=[data['labels'][0]])
+
+
 def main():
 
 	FNULL = open(os.devnull, 'w')  # used to suppress terminal command output
@@ -65,7 +122,10 @@ def main():
 			  "   keepnifti 	= when converting volume to surface, determines if the intermediate NIfTI file is kept or deleted - valid options are 'true' or 'false'.\n"
 			  "		  Default is 'false'.\n\n"
 			  "   keepafni     = when performing cluster correction, determines if the intermediate AFNI file is kept (the original data, with voxels outside surviving clusters removed).\n"
-			  "		  Valid options are 'true' or 'false'. Default is 'false'.\n\n\n"
+			  "		  Valid options are 'true' or 'false'. Default is 'false'.\n\n"
+			  "   workers	= with loop=true, the number of files processed at the same time. Default is '4'.\n\n"
+			  "   timeout	= minutes a command (3dclust, or mapping one file to the surface) may run before it is stopped\n"
+			  "		  (0 for no limit). Default is '30'.\n\n\n"
 			  "All arguments must be provided in the form arg=value (e.g. NN=1 or bisided=false). Filename may be included without 'filename='. Any order is permitted.\n")
 		sys.exit()
 	if len(sys.argv) > 1:
@@ -81,6 +141,8 @@ def main():
 	suffix = ''
 	keepnifti = False
 	keepafni = False
+	workers = '4'
+	timeout = '30'
 
 	for command in commands:
 		if "p=" in command and "loop" not in command:
@@ -145,6 +207,10 @@ def main():
 				keepafni = False
 			else:
 				keepafni = keepafni_string
+		if "workers=" in command:
+			workers = command[8:]
+		if "timeout=" in command:
+			timeout = command[8:]
 		if any(x in command for x in ['.HEAD', '.BRIK']) or os.path.exists(
 				thisdir + "/" + command + ".HEAD") or os.path.exists(thisdir + "/" + command[9:] + ".HEAD"):
 			if command.startswith('filename='):
@@ -190,6 +256,19 @@ def main():
 		sys.exit("Please provide a valid option for the argument 'keepnifti'")
 	if not any(x == keepafni for x in [True, False]):
 		sys.exit("Please provide a valid option for the argument 'keepafni'")
+	try:
+		workers = int(workers)
+	except ValueError:  # if the value provided for workers is not an integer
+		workers = 0
+	if workers < 1:
+		sys.exit("Please provide a valid option for the argument 'workers'")
+	try:
+		timeout_minutes = float(timeout)
+	except ValueError:  # if the value provided for timeout is not a number
+		timeout_minutes = -1
+	if timeout_minutes < 0:
+		sys.exit("Please provide a valid option for the argument 'timeout'")
+	timeout = timeout_minutes * 60 or None  # seconds, or no limit
 	if len(commands) > 0:
 		if not loop:
 			if filename:
@@ -240,9 +319,14 @@ def main():
 
 
 
+	Run_Trace.start("cluster_and_map_vol_to_surface")  # only if the AFNI_TRACE environment variable names a trace file
+
+	cluster_commands = []  # the 3dclust and mapping commands of every file (files are processed at the same time)
+	mapping_commands = []
 	for filename in files:
-		if os.path.exists(thisdir + "/Clust_mask+tlrc.HEAD") or os.path.exists(thisdir + "/Clust_mask+tlrc.BRIK.gz"):
-			sys.exit("There are Cluster masks remaining from previous use of this script (Clust_mask+tlrc) - please delete these before continuing.")
+		mask_prefix = "%s_Clust_mask%s" % (filename[:-5], suffix)  # one mask per file, so files can be processed at the same time
+		if os.path.exists(thisdir + "/%s+tlrc.HEAD" % mask_prefix) or os.path.exists(thisdir + "/%s+tlrc.BRIK.gz" % mask_prefix):
+			sys.exit("There are Cluster masks remaining from previous use of this script (%s+tlrc) - please delete these before continuing." % mask_prefix)
 
 		if os.path.exists(thisdir + "/%s_Clust%s+tlrc.HEAD" % (filename[:-5],suffix)) or os.path.exists(thisdir + "/%s_Clust%s+tlrc.BRIK.gz" % (filename[:-5],suffix)):
 			sys.exit("There are intermediate AFNI files remaining from previous use of this script (%s_Clust%s+tlrc) - please delete these before continuing." % (filename[:-5],suffix))
@@ -277,41 +361,7 @@ def main():
 		else:
 			sided = "1sided"
 
-		name = "AFNI_CLUSTSIM_%s_%s" % (NN_level, sided)
-
-		pthresholds = None
-		athresholds = None
-		numbers = []
-
-		start = False
-		numbers_start = False
-		for line in data:
-			if ("name = %s" % name) in line:
-				start = True
-			if start and "pthr=" in line:
-				pthresholds = line
-			if start and "athr=" in line:
-				athresholds = line
-			if start and "mask_count=" in line:
-				numbers_start = True
-				pass
-			if numbers_start and ("</3dClustSim_%s>~" % NN_level) in line:
-				break
-			if numbers_start and "mask_count" not in line:
-				numbers.append(line)
-
-		if not numbers:
-			sys.exit("Make sure that you have run your t-test with the -Clustsim option, and that the results were added to the your file's header.")
-
-
-		pthresholds = pthresholds[8:-2].split(",")
-		pthresholds_float = [float(x) for x in pthresholds]
-		athresholds = athresholds[8:-2].split(",")
-
-		numbers_lists = []
-
-		for item in numbers:
-			numbers_lists.append(item[1:-1].split(" "))
+		pthresholds, pthresholds_float, athresholds, numbers_lists = clustsim_table(data, NN_level, sided)
 
 		if not float(p) in pthresholds_float:
 			sys.exit(
@@ -333,16 +383,36 @@ def main():
 		voxel_number = cluster_sizes[alpha]
 		print("\nperforming cluster correction for %s...." % filename)
 
+		cluster_commands.append("3dclust -1Dformat -nosum -1dindex 0 -1tindex 1 -2thresh -%s %s -dxyz=1 -savemask %s -%s %s %s" % (thresh, thresh, mask_prefix, NN_level, voxel_number, filename))  # create the mask; equivalent to Clusterize function in AFNI GUI
+		mapping_commands.append("python %s/map_vol_to_surface.py %s_Clust%s+tlrc keepnifti=%s timeout=%g" % (path, filename[:-5], suffix, keepnifti_input, timeout_minutes))  # use map_vol_to_surface.py to convert to Workbench format
+
+	with Run_Trace.span("clusters", files=len(files)):
+		Command_Runner.run_commands(cluster_commands, workers=workers, timeout=timeout)
 
-		subprocess.call("3dclust -1Dformat -nosum -1dindex 0 -1tindex 1 -2thresh -%s %s -dxyz=1 -savemask Clust_mask -%s %s %s" % (thresh, thresh, NN_level, voxel_number, filename), shell=True)#, stdout=FNULL, stderr=subprocess.STDOUT)  # create the mask; equivalent to Clusterize function in AFNI GUI
-		subprocess.call("3dcalc -a Clust_mask+tlrc -b %s'[0]' -expr 'step(a)*b' -prefix %s_Clust%s" % (filename, filename[:-5], suffix), shell=True)#, stdout=FNULL, stderr=subprocess.STDOUT)  # create a new dataset, comprised of the data from the input dataset but only within regions specified by the mask
-		subprocess.call("python %s/map_vol_to_surface.py %s_Clust%s+tlrc keepnifti=%s" % (path, filename[:-5], suffix, keepnifti_input), shell=True)  # use map_vol_to_surface.py to convert to Workbench format
+	# create a new dataset for each file, comprised of the data from the input dataset but only within regions specified by the mask
+	with Run_Trace.span("masked data", files=len(files)):
+		mapped_files = []
+		for filename, mapping_command in zip(files, mapping_commands):
+			mask_prefix = "%s_Clust_mask%s" % (filename[:-5], suffix)
+			if not os.path.exists(thisdir + "/%s+tlrc.HEAD" % mask_prefix):
+				print("No clusters survived in %s - it will not be mapped to the surface" % filename)
+				continue
+			masked_data(thisdir + "/%s+tlrc" % mask_prefix, thisdir + "/" + filename, thisdir + "/%s_Clust%s+tlrc" % (filename[:-5], suffix))
+			mapped_files.append(mapping_command)
+
+	with Run_Trace.span("surface mapping", files=len(mapped_files)):
+		Command_Runner.run_commands(mapped_files, workers=workers, timeout=timeout)
+
+	for filename in files:
+		mask_prefix = "%s_Clust_mask%s" % (filename[:-5], suffix)
 
 		# Delete Cluster masks
-		if os.path.exists(thisdir + "/Clust_mask+tlrc.HEAD"):
-			os.remove(thisdir + "/Clust_mask+tlrc.HEAD")
-		if os.path.exists(thisdir + "/Clust_mask+tlrc.BRIK.gz"):
-			os.remove(thisdir + "/Clust_mask+tlrc.BRIK.gz")
+		if os.path.exists(thisdir + "/%s+tlrc.HEAD" % mask_prefix):
+			os.remove(thisdir + "/%s+tlrc.HEAD" % mask_prefix)
+		if os.path.exists(thisdir + "/%s+tlrc.BRIK.gz" % mask_prefix):
+			os.remove(thisdir + "/%s+tlrc.BRIK.gz" % mask_prefix)
+		if os.path.exists(thisdir + "/%s+tlrc.BRIK" % mask_prefix):
+			os.remove(thisdir + "/%s+tlrc.BRIK" % mask_prefix)
 
 		# Delete intermediate AFNI files
 		if not keepafni:
@@ -350,7 +420,11 @@ def main():
 				os.remove(thisdir + "/%s_Clust%s+tlrc.HEAD" % (filename[:-5], suffix))
 			if os.path.exists(thisdir + "/%s_Clust%s+tlrc.BRIK.gz" % (filename[:-5], suffix)):
 				os.remove(thisdir + "/%s_Clust%s+tlrc.BRIK.gz" % (filename[:-5], suffix))
+			if os.path.exists(thisdir + "/%s_Clust%s+tlrc.BRIK" % (filename[:-5], suffix)):
+				os.remove(thisdir + "/%s_Clust%s+tlrc.BRIK" % (filename[:-5], suffix))
 
+	Command_Runner.print_command_times()
+	Run_Trace.finish()
 
 
 if __name__ == "__main__":
@@ -2,6 +2,9 @@
 import os, sys, subprocess, gzip, string
 # Written by N. Anderson 3/1/2018. Adapted from E. Gordon's Matlab script.
 
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "AFNI_Data_Bundle"))
+import AFNI_Datasets, Command_Runner, Run_Trace
+
 
 def main():
 
@@ -61,6 +64,9 @@ def main():
 			  "*Optional: only when converting AFNI .HEAD/.BRIK files:\n\n"
 			  "   subbrick		= subbrick of AFNI file that you want to convert. If your file has no subbricks, you do not need to include this argument. Default is '0'.\n\n"
 			  "   keepnifti 	= determines if the intermediate NIfTI file is kept or deleted - valid options are 'true' or 'false'. Default is 'false'.\n\n\n"
+			  "*Optional: running wb_command:\n\n"
+			  "   workers	= the number of hemispheres mapped at the same time - valid options are '1' or '2'. Default is '2'.\n\n"
+			  "   timeout	= minutes a wb_command may run before it is stopped (0 for no limit). Default is '30'.\n\n\n"
 			  "Optional arguments must be provided in the form arg=value (e.g. hem=both or space=MNI). Filename may be included without 'filename='. Any order is permitted.\n\n\n"
 			  "NOTE: This program does not yet support the conversion of 4dfp filetypes.\n"
 			  "NOTE: This program does not yet support the use of 'enclosing' or 'trilinear' mappingtype values.\n")
@@ -75,6 +81,8 @@ def main():
 	filename = None
 	subbrick = 0
 	keepnifti = False
+	workers = '2'
+	timeout = '30'
 
 	for command in commands:
 		if "hem=" in command:
@@ -111,6 +119,10 @@ def main():
 				keepnifti = False
 			else:
 				keepnifti = keepnifti_string
+		if "workers=" in command:
+			workers = command[8:]
+		if "timeout=" in command:
+			timeout = command[8:]
 		if any(x in command for x in ['4dfp.img', '.nii','.HEAD','.BRIK']) or os.path.exists(thisdir + "/" + command + ".HEAD") or os.path.exists(thisdir + "/" + command[9:] + ".HEAD"):
 			if command.startswith('filename='):
 				filename = command[9:]
@@ -130,12 +142,23 @@ def main():
 			sys.exit("Please provide a valid option for the argument 'subbrick'")
 	if not any(x == keepnifti for x in [True, False]):
 		sys.exit("Please provide a valid option for the argument 'keepnifti'")
+	if not any(x == workers for x in ['1', '2']):
+		sys.exit("Please provide a valid option for the argument 'workers'")
+	workers = int(workers)
+	try:
+		timeout = float(timeout)
+	except ValueError:  # if the value provided for timeout is not a number
+		timeout = -1
+	if timeout < 0:
+		sys.exit("Please provide a valid option for the argument 'timeout'")
+	timeout = timeout * 60 or None  # seconds, or no limit
 	if len(commands) > 0:
 		if not filename or not os.path.exists(thisdir + "/" + filename):
 			if not os.path.exists(thisdir + "/" + filename + ".HEAD"):
 				sys.exit("Please provide a valid file name (.nii, .HEAD/.BRIK, or .4dfp.img)")
 
 	print("converting volume to surface....")
+	Run_Trace.start("map_vol_to_surface")  # joins the trace of cluster_and_map_vol_to_surface.py, if it is traced
 	
 	mappingtype_orig = mappingtype
 	volume = thisdir + "/" + filename
@@ -156,8 +179,9 @@ def main():
 			volume = volume[:-5]
 		if ".BRIK.gz" in volume:
 			volume = volume[:-8]
-		subprocess.call("3dAFNItoNIFTI %s'[%s]'" % (volume, subbrick), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
+		dataset = AFNI_Datasets.open_dataset(volume)  # the sub-brick is written as NIfTI directly (as 3dAFNItoNIFTI would)
 		volume = volume[:-5] + ".nii"
+		AFNI_Datasets.write_nifti(volume, [AFNI_Datasets.subbrick(dataset, int(subbrick))], dataset)
 		if not keepnifti:
 			deletenifti = True
 	
@@ -173,22 +197,27 @@ def main():
 # 		deletenifti = True
 # 		volume = volume[:-9] + "_MNI.nii"
 
-	# Map to surface
+	# Map to surface (both hemispheres at the same time)
+	mapping_commands = []
 	if hem == 'both' or hem == 'L':
 		if mappingtype_orig == 'ribbon-constrained':
 			mappingtype = 'ribbon-constrained ' + Lwhitesurface + " " + Lpialsurface + " -voxel-subdiv 5"
-		subprocess.call('%s/wb_command -volume-to-surface-mapping %s %s %s_L.func.gii -%s' % (workbenchdir, volume, Lsurface, volume[:-4], mappingtype), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-		print("output: %s_L.func.gii" % volume[:-4])
+		mapping_commands.append('%s/wb_command -volume-to-surface-mapping %s %s %s_L.func.gii -%s' % (workbenchdir, volume, Lsurface, volume[:-4], mappingtype))
 	if hem == 'both' or hem == 'R':
 		if mappingtype_orig == 'ribbon-constrained':
 			mappingtype = 'ribbon-constrained ' + Rwhitesurface + " " + Rpialsurface + " -voxel-subdiv 5"
-		subprocess.call('%s/wb_command -volume-to-surface-mapping %s %s %s_R.func.gii -%s' % (workbenchdir, volume, Rsurface, volume[:-4], mappingtype), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
+		mapping_commands.append('%s/wb_command -volume-to-surface-mapping %s %s %s_R.func.gii -%s' % (workbenchdir, volume, Rsurface, volume[:-4], mappingtype))
+	Command_Runner.run_commands(mapping_commands, workers=workers, timeout=timeout, quiet=True)
+	if hem == 'both' or hem == 'L':
+		print("output: %s_L.func.gii" % volume[:-4])
+	if hem == 'both' or hem == 'R':
 		print("output: %s_R.func.gii" % volume[:-4])
 
 
 	# Clean up temporary files
 	if deletenifti:
 		os.remove(volume)
+	Run_Trace.finish()
 
 
 
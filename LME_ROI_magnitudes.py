@@ -1,12 +1,18 @@
 import os
-import subprocess
-import csv
+import sys
 from Tkinter import *
 import time
-import fnmatch
+import numpy
 from tkFileDialog import askdirectory
 
-FNULL = open(os.devnull, 'w')  # used to suppress terminal command output
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "AFNI_Data_Bundle"))
+import AFNI_Datasets
+import ROI_Masks
+import Label_Index
+import Job_Scheduler
+import ROI_Averages
+import ROI_Results
+import Run_Trace
 
 ####################
 # Screen Size
@@ -34,12 +40,19 @@ mainloop()
 directory = None
 masks_folder = None
 folder_name = None
+processes = None
 
 def entry_fields():
-	global directoy, masks_folder, folder_name
-	directoy = e1.get()
+	global directory, masks_folder, folder_name, processes
+	directory = e1.get()
 	masks_folder = e2.get()
 	folder_name = e3.get()
+	try:
+		processes = int(e4.get())
+	except ValueError:
+		processes = 0
+	if processes < 1:
+		sys.exit("XXXXX\nPlease enter a whole number of 1 or more for the number of participants to process at the same time.\nXXXXX")
 	master.destroy()
 
 def path_choose1():
@@ -90,9 +103,16 @@ button4 = Button(master, text="Browse", command=path_choose3).grid(row=11, colum
 
 Label(master, text='').grid(row=12)
 
-Button(master, text='Submit', command=entry_fields).grid(row=13, sticky=S,
+Label(master, text='Number of participants to process at the same time\n(e.g. the number of processors on this computer)').grid(row=13, padx=20, columnspan=2)
+e4 = Entry(master, width=10)
+e4.insert(0, "1")
+e4.grid(row=14, padx=20, columnspan=2)
+
+Label(master, text='').grid(row=15)
+
+Button(master, text='Submit', command=entry_fields).grid(row=16, sticky=S,
 														 pady=4, columnspan=2)
-Button(master, text='Cancel', command=exitscript).grid(row=14, sticky=S,
+Button(master, text='Cancel', command=exitscript).grid(row=17, sticky=S,
 														 pady=4, columnspan=2)
 
 master.update_idletasks()
@@ -112,6 +132,8 @@ for ROI_file in ROI_files:
 		ROIs.append(ROI_file[:-10])  # remove "+tlrc.HEAD" from the file name
 
 output_directory = os.path.join(directory, "LME_results")
+if not os.path.exists(output_directory):
+	os.makedirs(output_directory)
 
 
 ####################
@@ -147,80 +169,91 @@ list_all = os.listdir(directory)
 
 subject_folders = []
 
-for item in list_all:
+for item in sorted(list_all):  # participants are written to the results in this order
 	if os.path.exists(os.path.join(directory, item, (item[5:]+".results"), folder_name)):  # if this is a subject folder that has the LME GLM folder specified
 		subject_folders.append(item)
 
 
 print("\n**********\n\nFinding ROI averages\n\n**********\n")
+Run_Trace.start("LME_ROI_magnitudes")  # only if the AFNI_TRACE environment variable names a trace file (see Run_Trace)
 
+GLM_folders = {}
 for subject_folder in subject_folders:
 	subject = subject_folder[5:]
-	GLM_folder = os.path.join(directory, subject_folder, (subject_folder[5:]+".results"), folder_name)
-	print("*****Participant %s" % subject)
-	if not os.path.exists(GLM_folder + "/AllTrials_Betas_%s+tlrc.BRIK" % subject):
-		subprocess.call("3dbucket -prefix %s/AllTrials_Betas_%s %s/stats.%s+tlrc'[1..$(2)]'" % (GLM_folder, subject, GLM_folder, subject), shell=True)
-		
-	#Figure out how many trials there are for this subject
-	if os.path.exists(os.path.join(GLM_folder, "stats_info_temp.txt")):
-		os.remove(os.path.join(GLM_folder, "stats_info_temp.txt"))  # if this file remains from running the script before
-	subprocess.call(['cd %s && 3dinfo -verb stats.%s+tlrc > stats_info_temp.txt' % (GLM_folder, subject)], shell=True)
-	text_file = open(os.path.join(GLM_folder, 'stats_info_temp.txt'))
-	file_data = text_file.read()
-	splits = file_data.split(" ")
-	trials = fnmatch.filter(splits, "'*#*_Coef'")
-	trial_number =len(trials)
-		
-	for ROI in ROIs:
-		print("*ROI: %s" % ROI)
-
-		for trial in range(0, (trial_number-1)):
-			# average across voxels within ROI
-			output_file = "%s.ave.%s.trial%s.txt" % (subject, ROI, trial)
-			subprocess.call(
-				"cd %s && 3dmaskave -mask %s+tlrc 'AllTrials_Betas_%s+tlrc[%s]' > %s" % (
-				GLM_folder, ROI, subject, trial, output_file), shell=True,
-				stdout=FNULL, stderr=subprocess.STDOUT)
-
-			# relocate spherical ROI average to output folder
-			os.rename(os.path.join(GLM_folder, output_file), os.path.join(output_directory, output_file))
-
-
-print("\n**********\n\nGenerating CSV\n\n**********\n")
-
-csv_output = output_directory + "/aaa_magnitude_list.csv"
-data_dict_list = []
-
+	GLM_folders[subject] = os.path.join(directory, subject_folder, (subject_folder[5:]+".results"), folder_name)
+
+#Figure out which sub-bricks hold the trials of each subject, from the labels in the header of the stats file
+stage = Run_Trace.begin_span("trial counts")
+stats_datasets = {}
+trial_schemas = {}
+for subject in sorted(GLM_folders):
+	stats_datasets[subject] = AFNI_Datasets.open_dataset(GLM_folders[subject] + "/stats.%s+tlrc" % subject)
+	trial_schemas[subject] = Label_Index.trial_schema(stats_datasets[subject], "*#*_Coef")
+Run_Trace.end_span(stage)
+
+# Every ROI mask, as one (ROIs x voxels) matrix (see ROI_Masks)
+library = ROI_Masks.binary_library(dict((ROI, os.path.join(masks_folder, ROI + "+tlrc")) for ROI in ROIs))
+ROI_columns = dict((ROI, column) for column, ROI in enumerate(library['names']))
+
+# One unit per participant: (subject, stats file, sub-bricks of the trial betas, ROI masks)
+units = []
 for subject_folder in subject_folders:
 	subject = subject_folder[5:]
-	GLM_folder = os.path.join(directory, subject_folder, (subject_folder[5:]+".results"), folder_name)
+	stats = stats_datasets[subject]
+	if tuple(stats['dims']) != tuple(library['dims']):
+		sys.exit("XXXXX\nThe ROI masks (%s) are not on the same grid as the trial betas of participant %s (%s).\nXXXXX" % (
+			"x".join(str(x) for x in library['dims']), subject, "x".join(str(x) for x in stats['dims'])))
+	beta_indices = trial_schemas[subject]['indices'][:(len(trial_schemas[subject]['indices'])-1)]
+	units.append((subject, stats['head_path'], beta_indices, library))
+
+
+# Averages across voxels within every ROI, for every trial of a participant at once: the trial betas are read once,
+# and multiplied by the ROI masks (the same average as 3dmaskave -mask ROI, for every ROI and trial)
+# The betas are read in place from the stats file (as a strided view of the memory-mapped file when they are evenly
+# spaced, e.g. interleaved with their t-statistics), instead of being copied into an AllTrials_Betas dataset first.
+# Returns the (trials x ROIs) averages, with the ROIs in the order of library['names']
+def extract_subject(unit):
+	subject, stats_path, beta_indices, library = unit
+	with Run_Trace.span("ROI averages", 'unit', subject=subject):
+		return ROI_Averages.roi_matrix(AFNI_Datasets.open_dataset(stats_path), beta_indices, library)
+
+
+# Participants are processed at the same time (processes at once), and each one's trials are written out as soon as it
+# and every participant before it have finished, so the files are always in participant/trial order, and only a few
+# participants are held in memory at any time. Two files are written:
+#   aaa_magnitude_list.csv - one row per trial, one column per ROI
+#   aaa_magnitude_list_long.parquet - one row per trial and ROI (Participant, Trial, ROI, magnitude, voxels), with
+#   proper column types, for mixed models in R or pandas (aaa_magnitude_list_long.csv.gz if pyarrow is not installed)
+csv_output = output_directory + "/aaa_magnitude_list.csv"
+wide_table = ROI_Results.open_table(csv_output, [('Participant', 'str'), ('Trial', 'int32')] + [(ROI, 'float64') for ROI in ROIs])
+if ROI_Results.pyarrow is not None:
+	long_output = output_directory + "/aaa_magnitude_list_long.parquet"
+else:
+	long_output = output_directory + "/aaa_magnitude_list_long.csv.gz"
+long_table = ROI_Results.open_table(long_output, [('Participant', 'str'), ('Trial', 'int32'), ('ROI', 'category'), ('magnitude', 'float64'), ('voxels', 'int32')])
+
+ROI_order = [ROI_columns[ROI] for ROI in ROIs]  # the library's ROIs, in the order of the CSV columns
+ROI_voxels = numpy.asarray(library['voxels'])[ROI_order]
+stage = Run_Trace.begin_span("extraction", units=len(units), processes=processes)
+for unit, trial_matrix in Job_Scheduler.run_units_in_order(extract_subject, units, processes):
+	subject = unit[0]
 	print("*****Participant %s" % subject)
-	if os.path.exists(GLM_folder + "/AllTrials_Betas_%s+tlrc.BRIK" % subject):
-		text_file = open(os.path.join(GLM_folder, 'stats_info_temp.txt'))
-		file_data = text_file.read()
-		splits = file_data.split(" ")
-		trials = fnmatch.filter(splits, "'*#*_Coef'")
-		trial_number =len(trials)
-		os.remove(os.path.join(GLM_folder, "stats_info_temp.txt"))
-		
-		for trial in range(0, (trial_number-1)):
-			trial_dict = {}
-			trial_dict['Participant'] = subject
-			trial_dict['Trial'] = trial
-			for ROI in ROIs:
-				with open(output_directory + '/%s.ave.%s.trial%s.txt' % (subject, ROI, trial)) as magnitude_file:
-					magnitude_data = magnitude_file.readline()
-				splits = magnitude_data.split(" ")
-				trial_dict[ROI] = splits[0]
-			data_dict_list.append(trial_dict)
-
-
-columnnames = ['Participant', 'Trial'] + ROIs
-output_file_path = csv_output
-output_dict_list = data_dict_list
-write_file = open(output_file_path, 'w')  # write new file
-csvwriter = csv.DictWriter(write_file, fieldnames=columnnames)
-csvwriter.writerow(dict((fn, fn) for fn in columnnames))
-for index, item in enumerate(output_dict_list):
-	csvwriter.writerow(item)
-write_file.close()
\ No newline at end of file
+	trial_matrix = trial_matrix[:, ROI_order]
+	trials = numpy.arange(len(trial_matrix))
+
+	block = {'Participant': [subject] * len(trials), 'Trial': trials}
+	for column, ROI in enumerate(ROIs):
+		block[ROI] = trial_matrix[:, column]
+	ROI_Results.write_rows(wide_table, block)
+
+	ROI_Results.write_rows(long_table, {'Participant': [subject] * trial_matrix.size,
+										'Trial': numpy.repeat(trials, len(ROIs)),
+										'ROI': ROIs * len(trials),
+										'magnitude': trial_matrix.ravel(),
+										'voxels': numpy.tile(ROI_voxels, len(trials))})
+Run_Trace.end_span(stage)
+
+print("CSV saved to: " + ROI_Results.close_table(wide_table))
+print("Trial averages saved to: " + ROI_Results.close_table(long_table))
+
+Run_Trace.finish()
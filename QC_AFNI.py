@@ -1,10 +1,13 @@
 #!/usr/bin/python
 
-import os, glob, subprocess, shutil, sys
+import os, glob, shutil, sys
 from datetime import datetime
 from Tkinter import *
 from tkFileDialog import askdirectory
 
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "AFNI_Data_Bundle"))
+import Command_Runner, Run_Trace
+
 # The purpose of this script is to execute a number of QC (quality control) functions.
 # The output of these files will be placed in a "QC_AFNI" folder inside of the "subject_results" folder.
 
@@ -82,10 +85,27 @@ subject_results = None
 
 long_scripts_check = None
 
+command_workers = None
+
+command_timeout = None  # seconds an AFNI command may run before it is stopped (None for no limit)
+
 def entry_fields():
-	global subject_results, long_scripts_check
+	global subject_results, long_scripts_check, command_workers, command_timeout
 	subject_results = e1.get()
 	long_scripts_check = var1.get()
+	try:
+		command_workers = int(e2.get())
+	except ValueError:
+		command_workers = 0
+	if command_workers < 1:
+		sys.exit("XXXXX\nPlease enter a whole number of 1 or more for the number of AFNI commands to run at the same time.\nXXXXX")
+	try:
+		timeout_minutes = float(e3.get())
+	except ValueError:
+		timeout_minutes = -1
+	if timeout_minutes < 0:
+		sys.exit("XXXXX\nPlease enter a number of minutes of 0 or more for the time limit of each AFNI command (0 for no limit).\nXXXXX")
+	command_timeout = timeout_minutes * 60 or None
 	master.destroy()
 
 def sel1():
@@ -118,9 +138,23 @@ backup_button = Checkbutton(master, text='Do not create review tables for GLMs w
 
 Label(master, text='').grid(row=6)
 
-Button(master, text='Begin QC processing', command=entry_fields).grid(row=7, sticky=S,
+Label(master, text='Number of AFNI commands to run at the same time\n(e.g. the number of processors on this computer)').grid(row=7, padx=20, columnspan=2)
+e2 = Entry(master, width=10)
+e2.insert(0, "4")
+e2.grid(row=8, padx=20, columnspan=2)
+
+Label(master, text='').grid(row=9)
+
+Label(master, text='Time limit for each AFNI command, in minutes (0 for no limit)\n(a command still running after this is stopped, and the script moves on)').grid(row=10, padx=20, columnspan=2)
+e3 = Entry(master, width=10)
+e3.insert(0, "30")
+e3.grid(row=11, padx=20, columnspan=2)
+
+Label(master, text='').grid(row=12)
+
+Button(master, text='Begin QC processing', command=entry_fields).grid(row=13, sticky=S,
 														 pady=4, columnspan=2)
-Button(master, text='Cancel', command=exitscript).grid(row=8, sticky=S,
+Button(master, text='Cancel', command=exitscript).grid(row=14, sticky=S,
 														 pady=4, columnspan=2)
 
 master.update_idletasks()
@@ -136,12 +170,17 @@ mainloop()
 ####################
 
 
+Run_Trace.start("QC_AFNI")  # only if the AFNI_TRACE environment variable names a trace file (see Run_Trace)
+
 QC_folder = os.path.join(subject_results, "QC_AFNI")
 if not os.path.exists(QC_folder):
 	os.makedirs(QC_folder
 )  # create QC folder
 
-FNULL = open(os.devnull, 'w')  # used to suppress terminal command output
+# AFNI commands that do not depend on each other (e.g. those of different subjects) are run at the same time by
+# Command_Runner, on command_workers threads. The commands of one subject that share files in its results folder
+# still run one after another, as a single job. Any command still running after command_timeout seconds is stopped
+# (e.g. a hung @snapshot_volreg), so one stuck command cannot block the whole run.
 
 
 ########## moving files ##########
@@ -153,12 +192,12 @@ if not os.path.exists(outputs_folder):
 	os.makedirs(outputs_folder)  # create proc outputs folder
 
 print("copying proc script output files.....")
+stage = Run_Trace.begin_span("copy files")
 parent = os.path.dirname(subject_results)
 output_files_list1 = glob.glob(os.path.join(parent, "*output*"))
 output_files_list2 = glob.glob(os.path.join(parent, "output*"))
 output_files_list = output_files_list1 + output_files_list2
-for output_file in output_files_list:
-	subprocess.call("cp -n %s %s" % (output_file, outputs_folder), shell=True)  # copy all files beginning with "output" into QC folder
+Command_Runner.run_commands(["cp -n %s %s" % (output_file, outputs_folder) for output_file in output_files_list], workers=command_workers, timeout=command_timeout)  # copy all files beginning with "output" into QC folder
 
 ## move dfile_rall
 
@@ -170,16 +209,20 @@ subject_folders = os.listdir(subject_results)  # list subject folders inside sub
 subject_folders1 = [x for x in subject_folders if ("subj" in x)]  # only keep those containing "subj"
 subject_folders1 = sorted(subject_folders1)
 print("copying subject motion files.....")
+copy_commands = []
 for folder in subject_folders1:
 	results_folder = os.listdir(os.path.join(subject_results, folder))  # find each subject's results folder
 	results_folder = [x for x in results_folder if not (".DS_Store" in x)]
 	dfile = os.path.join(subject_results, folder, results_folder[0], "*.dfile_rall.1D")
-	subprocess.call("cp -n %s %s" % (dfile, Dfile_folder), shell=True)  # copy the overall movement file for each subject into the QC folder
+	copy_commands.append("cp -n %s %s" % (dfile, Dfile_folder))  # copy the overall movement file for each subject into the QC folder
+Command_Runner.run_commands(copy_commands, workers=command_workers, timeout=command_timeout)
+Run_Trace.end_span(stage)
 
 
 ########## gen_ss_review_table.py ##########
 
 print("creating review files....")
+stage = Run_Trace.begin_span("review files")
 
 all_GLM_folders = []
 
@@ -188,6 +231,7 @@ if not os.path.exists(Review_table_folder):
 	os.makedirs(Review_table_folder)  # create review table folder
 
 
+review_jobs = []  # one job per subject - the GLMs of a subject share files in its results folder
 for folder in subject_folders1:
 	subj_number = folder[5:]
 
@@ -208,28 +252,25 @@ for folder in subject_folders1:
 	GLM_folders = GLM_folders_int
 
 	if long_scripts_check:
-		for GLM_folder in GLM_folders:
-			stats_file = os.path.join(results_folder, GLM_folder, "stats.%s+tlrc.HEAD" % subj_number)
-			proc = subprocess.Popen("3dinfo -label %s" % (stats_file), shell=True, stdout=subprocess.PIPE)
-			label_names = proc.stdout.read()
-			name_list = label_names.split("|")
+		label_results = Command_Runner.run_commands(["3dinfo -label %s" % os.path.join(results_folder, GLM_folder, "stats.%s+tlrc.HEAD" % subj_number) for GLM_folder in GLM_folders],
+													workers=command_workers, timeout=command_timeout, capture=True)
+		GLM_folders_int = []
+		for GLM_folder, label_result in zip(GLM_folders, label_results):
+			name_list = label_result['stdout'].split("|")
 			stat_condition_list = [fn for fn in name_list if "Coef" in fn]
-			if len(stat_condition_list) > 50:
-				GLM_folders.remove(GLM_folder)  # if there are a large number of stimulus conditions, do not run this GLM
+			if len(stat_condition_list) <= 50:
+				GLM_folders_int.append(GLM_folder)  # if there are a large number of stimulus conditions, do not run this GLM
+		GLM_folders = GLM_folders_int
 
 	for GLM_folder in GLM_folders:
 		if GLM_folder not in all_GLM_folders:
 			all_GLM_folders.append(GLM_folder)  # create a final list of all GLM folders used, regardless of participant
 
 	if GLM_folders:
-		time1 = datetime.now()
-		time_duration(starttime, time1)
-		print("***" + subj_number + "..." + duration_string + " elapsed")
+		print("***" + subj_number + "...." + ", ".join(GLM_folders))
 
+	job = []
 	for GLM_folder in GLM_folders:
-		print(GLM_folder + "....")
-		subprocess.call('cd %s && rm out.ss_review.*' % (results_folder), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)  # delete old out.ss_review files
-		subprocess.call('cd %s && rm @ss_review*' % (results_folder), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)  # delete old @ss_review commands
 		review_files_folder = os.path.join(results_folder, GLM_folder, "review_files")
 		if not os.path.exists(review_files_folder):
 			os.makedirs(review_files_folder)
@@ -237,48 +278,68 @@ for folder in subject_folders1:
 			shutil.rmtree(review_files_folder)
 			os.makedirs(review_files_folder)
 		results_GLM_folder = os.path.join(results_folder, GLM_folder)
-		subprocess.call('cd %s && cp X.xmat.1D %s' % (results_GLM_folder, results_folder), shell=True)  # copy the X.xmat.1D file up to the main subject directory
-		subprocess.call('cd %s && cp X.stim.xmat.1D %s' % (results_GLM_folder, results_folder), shell=True)   # copy the X.stim.xmat.1D file up to the main subject directory
 		Xnocensor_file = os.path.join(GLM_folder, "X.nocensor.xmat.1D")
 		stats_file = os.path.join(GLM_folder, "stats.%s+tlrc.HEAD" % subj_number)
 		sumideal_file = os.path.join(GLM_folder, "sum_ideal.1D")
 		tsnr_file = os.path.join(GLM_folder, "TSNR.%s+tlrc.HEAD" % subj_number)
 		outgcor_file = os.path.join(GLM_folder, "out.gcor.1D")
 		errts_file = os.path.join(GLM_folder, "errts.%s+tlrc.HEAD" % subj_number)
-		subprocess.call('cd %s && gen_ss_review_scripts.py -mot_limit 0.3 -exit0 -out_limit 0.1 -uvar xmat_uncensored %s -uvar stats_dset %s -motion_dset %s.dfile_rall.1D -uvar sum_ideal %s -uvar tsnr_dset %s -uvar gcor_dset %s -xmat_regress X.xmat.1D -censor_dset motion_%s_censor.1D -errts_dset %s' % (results_folder, Xnocensor_file, stats_file, subj_number, sumideal_file, tsnr_file, outgcor_file, subj_number, errts_file), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)  # run AFNI's gen_ss_review_scripts.py
-		subprocess.call('cd %s && ./@ss_review_basic > out.ss_review.%s.%s.txt' % (results_folder, subj_number, GLM_folder), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)  # execute @ss_review_basic to get text output
-		
 		mv_out_ss_review = os.path.join(results_folder, "out.ss_review.*")
 		mv_ss_review_basic = os.path.join(results_folder, "@ss_review_basic")
 		mv_ss_review_driver = os.path.join(results_folder, "@ss_review_driver")
 		mv_ss_review_driver_commands = os.path.join(results_folder, "@ss_review_driver_commands")
-		subprocess.call('mv %s %s' % (mv_out_ss_review, review_files_folder), shell=True)  # move output to dedicated folder
-		subprocess.call('mv %s %s' % (mv_ss_review_basic, review_files_folder), shell=True)  # move output to dedicated folder
-		subprocess.call('mv %s %s' % (mv_ss_review_driver, review_files_folder), shell=True)  # move output to dedicated folder
-		subprocess.call('mv %s %s' % (mv_ss_review_driver_commands, review_files_folder), shell=True)  # move output to dedicated folder
-		subprocess.call('cd %s && rm X*xmat.1D' % (results_folder), shell=True)  # delete copied X.xmat.1D and X.stim.xmat.1D files
+		job += [('rm out.ss_review.*', results_folder),  # delete old out.ss_review files
+				('rm @ss_review*', results_folder),  # delete old @ss_review commands
+				('cp X.xmat.1D %s' % results_folder, results_GLM_folder),  # copy the X.xmat.1D file up to the main subject directory
+				('cp X.stim.xmat.1D %s' % results_folder, results_GLM_folder),  # copy the X.stim.xmat.1D file up to the main subject directory
+				('gen_ss_review_scripts.py -mot_limit 0.3 -exit0 -out_limit 0.1 -uvar xmat_uncensored %s -uvar stats_dset %s -motion_dset %s.dfile_rall.1D -uvar sum_ideal %s -uvar tsnr_dset %s -uvar gcor_dset %s -xmat_regress X.xmat.1D -censor_dset motion_%s_censor.1D -errts_dset %s' % (Xnocensor_file, stats_file, subj_number, sumideal_file, tsnr_file, outgcor_file, subj_number, errts_file), results_folder),  # run AFNI's gen_ss_review_scripts.py
+				('./@ss_review_basic > out.ss_review.%s.%s.txt' % (subj_number, GLM_folder), results_folder),  # execute @ss_review_basic to get text output
+				'mv %s %s' % (mv_out_ss_review, review_files_folder),  # move output to dedicated folder
+				'mv %s %s' % (mv_ss_review_basic, review_files_folder),  # move output to dedicated folder
+				'mv %s %s' % (mv_ss_review_driver, review_files_folder),  # move output to dedicated folder
+				'mv %s %s' % (mv_ss_review_driver_commands, review_files_folder),  # move output to dedicated folder
+				('rm X*xmat.1D', results_folder)]  # delete copied X.xmat.1D and X.stim.xmat.1D files
+	if job:
+		review_jobs.append(job)
+
+Command_Runner.run_commands(review_jobs, workers=command_workers, timeout=command_timeout, quiet=True)
+Run_Trace.end_span(stage)
+time1 = datetime.now()
+time_duration(starttime, time1)
+print("review files created..." + duration_string + " elapsed")
 
 
 print("creating review tables....")
+stage = Run_Trace.begin_span("review tables")
 
+table_commands = []
 for GLM_folder in all_GLM_folders:
 	all_out_ss_review = os.path.join("subject_results", "*", "*", GLM_folder, "review_files", "out.ss_review.*")
-	subprocess.call("cd %s && gen_ss_review_table.py -tablefile review_table.xls -overwrite -infiles %s" % (parent, all_out_ss_review), shell=True)  # run gen_ss_review_table.py
-	review_table = os.path.join(parent, "review_table.xls")
-	review_table_move = os.path.join(Review_table_folder, "review_table_%s.xls" % GLM_folder)
-	subprocess.call("mv %s %s " % (review_table, review_table_move) , shell=True)  # move the result to the QC folder
+	review_table = os.path.join(Review_table_folder, "review_table_%s.xls" % GLM_folder)  # written straight to the QC folder, so tables can be made at the same time
+	table_commands.append(("gen_ss_review_table.py -tablefile %s -overwrite -infiles %s" % (review_table, all_out_ss_review), parent))  # run gen_ss_review_table.py
+Command_Runner.run_commands(table_commands, workers=command_workers, timeout=command_timeout)
+Run_Trace.end_span(stage)
 
 
 ########## create snapshots ##########
 # loops through AFNI command @snapshot_volreg, then organizes resulting jpgs
 
 print("creating alignment snapshots....")
+stage = Run_Trace.begin_span("snapshots")
 
 snapshot_folder = QC_folder + "/snapshots"
 if not os.path.exists(snapshot_folder):
 	os.makedirs(snapshot_folder)
 
-for folder in subject_folders1:
+# search each anatomical file's history to find what template was used
+# (this is the anatomical file immediately after being warped to the template)
+warped_anat_paths = [os.path.join(subject_results, folder, folder[5:] + ".results", "anat_mprage_unif_ns_shft+tlrc.HEAD") for folder in subject_folders1]
+history_results = Command_Runner.run_commands(["3dinfo -history %s" % warped_anat_path for warped_anat_path in warped_anat_paths],
+											  workers=command_workers, timeout=command_timeout, capture=True)
+
+snapshot_jobs = []  # one job per subject, as the subject's snapshots share the copied template
+snapshot_names = []
+for folder, history_result in zip(subject_folders1, history_results):
 	subj_number = folder[5:]
 	results_folder = os.path.join(subject_results, "subj." + subj_number, subj_number + ".results")
 	result_files = os.listdir(results_folder)
@@ -288,9 +349,7 @@ for folder in subject_folders1:
 	result_files1 = sorted(result_files1)
 	number_of_runs = len(result_files1)
 
-	warped_anat_path = os.path.join(results_folder, "anat_mprage_unif_ns_shft+tlrc.HEAD")  # this is the anatomical file immediately after being warped to the template
-	proc = subprocess.Popen("3dinfo -history %s" % (warped_anat_path), shell=True, stdout=subprocess.PIPE)  # search the file's history to find what template was used
-	history = proc.stdout.read()
+	history = history_result['stdout']
 	splits = history.split(" ")
 	count = 0
 	template = None
@@ -302,9 +361,10 @@ for folder in subject_folders1:
 	if template.endswith(".HEAD"):
 		template = template[:-5]
 
+	job = []
 	#copy the necessary template file to the current directory, if not already copied
 	if not os.path.exists(os.path.join(results_folder, template + ".HEAD")):
-		subprocess.call("cp ~/abin/%s* %s" % (template, results_folder), shell=True)
+		job.append("cp ~/abin/%s* %s" % (template, results_folder))
 	
 	anat = "anat_final.%s+tlrc" % subj_number
 	
@@ -321,37 +381,36 @@ for folder in subject_folders1:
 
 	epi_files = dict(zip(run_0_list, result_files1))
 
-	time1 = datetime.now()
-	time_duration(starttime, time1)
-
-	do_snapshots = False
-	if not os.path.exists(os.path.join(snapshot_folder, subj_number + "_anat-template.jpg")):
-		do_snapshots = True
-	for run in run_0_list:
-		jpg_name = "%s_run%s-anat" % (subj_number, run)
-		if not os.path.exists(os.path.join(snapshot_folder, jpg_name + ".jpg")):
-			do_snapshots = True
-
-	if do_snapshots:
-		print("creating snapshots for " + subj_number + "..." + duration_string + " elapsed")
-
+	jpg_names = []
 	jpg_name = "%s_anat-template" % subj_number
 	if not os.path.exists(os.path.join(snapshot_folder, jpg_name + ".jpg")):
-		subprocess.call("cd %s && @snapshot_volreg %s %s %s" % (results_folder, template, anat, jpg_name), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-		print("output file:  %s.jpg" % jpg_name)
 		anat_jpg_path = os.path.join(results_folder, "*_anat-template.jpg")
-		subprocess.call("mv %s %s" % (anat_jpg_path, snapshot_folder), shell=True, stdout=FNULL, stderr=subprocess.STDOUT) # move snapshot to correct folder in QC folder
+		job += [("@snapshot_volreg %s %s %s" % (template, anat, jpg_name), results_folder),
+				"mv %s %s" % (anat_jpg_path, snapshot_folder)]  # move snapshot to correct folder in QC folder
+		jpg_names.append(jpg_name)
 
 	for run in run_0_list:
 		run_file_name = epi_files[run][:-5]  # remove .HEAD from file name
 		jpg_name = "%s_run%s-anat" % (subj_number, run)
 		if not os.path.exists(os.path.join(snapshot_folder, jpg_name + ".jpg")):
-			subprocess.call("cd %s && @snapshot_volreg %s %s %s" % (results_folder, anat, run_file_name, jpg_name), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-			print("output file:  %s.jpg" % jpg_name)
 			epi_jpg_paths = os.path.join(results_folder, "*_run*-anat.jpg")
-			subprocess.call("mv %s %s" % (epi_jpg_paths, snapshot_folder), shell=True, stdout=FNULL, stderr=subprocess.STDOUT) # move snapshots to correct folder in QC folder
-	
-	subprocess.call("rm %s*" % os.path.join(results_folder, template), shell=True)
+			job += [("@snapshot_volreg %s %s %s" % (anat, run_file_name, jpg_name), results_folder),
+					"mv %s %s" % (epi_jpg_paths, snapshot_folder)]  # move snapshots to correct folder in QC folder
+			jpg_names.append(jpg_name)
+
+	if jpg_names:
+		print("creating snapshots for " + subj_number + "....")
+	job.append("rm %s*" % os.path.join(results_folder, template))
+	snapshot_jobs.append(job)
+	snapshot_names += jpg_names
+
+Command_Runner.run_commands(snapshot_jobs, workers=command_workers, timeout=command_timeout, quiet=True)
+Run_Trace.end_span(stage)
+for jpg_name in snapshot_names:
+	print("output file:  %s.jpg" % jpg_name)
+time1 = datetime.now()
+time_duration(starttime, time1)
+print("snapshots created..." + duration_string + " elapsed")
 
 	
 	
@@ -381,10 +440,12 @@ if not os.path.exists(os.path.join(QC_folder, "radial_correlate_summary.txt")):
 
 ########## create motion and outlier plots ##########
 
+stage = Run_Trace.begin_span("motion plots")
 Mot_out_folder = QC_folder + "/motion_outlier_plots"
 if not os.path.exists(Mot_out_folder):
 	os.makedirs(Mot_out_folder)  # create motion & outlier plot folder
 
+plot_jobs = []
 for folder in subject_folders1:
 	subj_number = folder[5:]
 	results_folder = os.path.join(subject_results, "subj." + subj_number, subj_number + ".results")
@@ -396,14 +457,17 @@ for folder in subject_folders1:
 	if not os.path.exists(os.path.join(Mot_out_folder, subj_number + "_outliers.jpg")) or not os.path.exists(os.path.join(Mot_out_folder, subj_number + "_motion.jpg")):
 		print("creating motion and outlier plots for %s....." % subj_number)
 	if not os.path.exists(os.path.join(Mot_out_folder, subj_number + "_outliers.jpg")):
-		subprocess.call('cd %s && 1dplot -one -plabel %s_outliers -censor_RGB green -censor %s -jpg %s_outliers %s "1D: 2319@0.1"' % (results_folder, subj_number, censor_file, subj_number, outcount_file), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)  # use AFNI's 1dplot to create outlier plot
 		outliers = os.path.join(results_folder, "*outliers.jpg")
-		subprocess.call("mv %s %s" % (outliers, Mot_out_folder), shell=True)  # move plots to dedicated folder in QC folder
+		plot_jobs.append([('1dplot -one -plabel %s_outliers -censor_RGB green -censor %s -jpg %s_outliers %s "1D: 2319@0.1"' % (subj_number, censor_file, subj_number, outcount_file), results_folder),  # use AFNI's 1dplot to create outlier plot
+						  "mv %s %s" % (outliers, Mot_out_folder)])  # move plots to dedicated folder in QC folder
 	if not os.path.exists(os.path.join(Mot_out_folder, subj_number + "_motion.jpg")):
-		subprocess.call('cd %s && 1dplot -one -plabel %s_motion -censor_RGB green -censor %s -jpg %s_motion %s "1D: 2319@0.3"' % (results_folder, subj_number, censor_file, subj_number, motion_file), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)  # use AFNI's 1dplot to create motion plot
 		motion = os.path.join(results_folder, "*motion.jpg")
-		subprocess.call("mv %s %s" % (motion, Mot_out_folder), shell=True)  # move plots to dedicated folder in QC folder
+		plot_jobs.append([('1dplot -one -plabel %s_motion -censor_RGB green -censor %s -jpg %s_motion %s "1D: 2319@0.3"' % (subj_number, censor_file, subj_number, motion_file), results_folder),  # use AFNI's 1dplot to create motion plot
+						  "mv %s %s" % (motion, Mot_out_folder)])  # move plots to dedicated folder in QC folder
+Command_Runner.run_commands(plot_jobs, workers=command_workers, timeout=command_timeout, quiet=True)
+Run_Trace.end_span(stage)
 
+Command_Runner.print_command_times()
 
 
 endtime = datetime.now()
@@ -411,4 +475,5 @@ print_endtime = endtime.strftime("%m-%d-%Y, %I:%M:%S %p")
 print("End script execution: " + str(print_endtime))
 
 time_duration(starttime, endtime)
-print("Total script duration: " + duration_string)
\ No newline at end of file
+print("Total script duration: " + duration_string)
+Run_Trace.finish()
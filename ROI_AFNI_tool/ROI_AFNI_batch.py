@@ -0,0 +1,257 @@
+#!/usr/bin/python
+import os, sys, glob, json
+from datetime import datetime
+
+import ROI_Extraction
+from ROI_Extraction import time_duration
+
+try:
+	import yaml  # only needed for .yaml/.yml config files (pip install pyyaml)
+except ImportError:
+	yaml = None
+
+
+# The purpose of this script is to run ROI_AFNI_tool.py without any windows, so that it can be used on headless
+# cluster nodes, or to script many runs in a row. Every choice made in ROI_AFNI_tool.py's windows is read from a
+# config file (JSON, or YAML if PyYAML is installed) instead.
+
+# Example config file (JSON):
+#
+# {
+#     "subject_results": "/path/to/subject_results",
+#     "masks_path": "/path/to/ROI_files",
+#     "analyses": ["sphere magnitude", "sphere timecourse", "mask magnitude", "mask timecourse", "weighted mask magnitude", "atlas magnitude"],
+#     "coord_system": "LPI",
+#     "sphere_radius": 5,
+#     "atlas": "/path/to/atlas+tlrc.HEAD",
+#     "label_table": "/path/to/atlas_labels.txt",
+#     "processes": 8,
+#     "statistics": ["median", "trimmed_mean:10", "sd", "top:10"],
+#     "trace": "/path/to/run_trace.json",
+#     "subjects": ["01", "02", "03"],
+#     "GAM_GLMs": {"GLM_hits": "all", "GLM_memory": ["hit", "miss"]},
+#     "TENT_GLMs": {"GLM_TENT": "all"}
+# }
+
+
+usage = ("\n#########################\nThis script does the following:\n1. Reads the settings for an ROI extraction from a config file (JSON, or YAML if PyYAML is installed)\n"
+		 "2. Runs the same extraction as ROI_AFNI_tool.py, without opening any windows\n"
+		 "#########################\n\n"
+		 "Usage:  python ROI_AFNI_batch.py config.json [config2.json ...]\n\n"
+		 "Config file options:\n\n\n"
+		 "**Required:\n\n"
+		 "   subject_results	= path to your subject results folder (containing the subj.* folders)\n\n"
+		 "   analyses		= list of analyses to run - each one names an ROI type ('sphere', 'mask', 'weighted mask' or 'atlas')\n"
+		 "			  and a measure ('magnitude' or 'timecourse'), e.g. [\"sphere magnitude\", \"mask timecourse\"]\n"
+		 "			  A weighted mask weights every voxel above 0 by its value in the mask (e.g. a probability map).\n\n\n"
+		 "**Required for spherical ROIs and masks:\n\n"
+		 "   masks_path		= directory containing AFNI mask file(s) and/or text file(s) with ROI coordinates\n\n\n"
+		 "**Required for spherical ROIs:\n\n"
+		 "   coord_system	= 'LPI' (SPM order) or 'RAI' (DICOM order)\n\n"
+		 "   sphere_radius	= sphere radius (mm), as an integer\n\n\n"
+		 "**Required for a labeled atlas:\n\n"
+		 "   atlas		= path to one integer-labeled AFNI dataset (e.g. a parcellation) - every label value is an ROI\n\n\n"
+		 "*Optional:\n\n"
+		 "   coordinates		= list of coordinate files in masks_path to use (e.g. [\"precuneus.txt\"]). Default is all .txt files.\n\n"
+		 "   masks		= list of mask files in masks_path to use (e.g. [\"PCC+tlrc.HEAD\"]). Default is all +tlrc.HEAD files.\n\n"
+		 "   label_table		= text file naming the atlas labels, one \"value name\" pair per line (e.g. \"12 Left_Hippocampus\").\n"
+		 "			  Default is the atlas's own label table, or else the label values.\n\n"
+		 "   subjects		= list of subjects to include (e.g. [\"01\", \"02\"]). Default is every subj.* folder.\n\n"
+		 "   GAM_GLMs		= GLMs to use for magnitudes, and their conditions - {\"GLM_name\": \"all\"} or {\"GLM_name\": [\"hit\", \"miss\"]}.\n"
+		 "			  Default is every GAM GLM, with all of its conditions.\n\n"
+		 "   TENT_GLMs		= GLMs to use for timecourses, in the same format as GAM_GLMs.\n"
+		 "			  Default is every TENT GLM, with all of its conditions.\n\n"
+		 "   processes		= number of subject/GLM folders processed in parallel. Default is 1.\n\n"
+		 "   statistics		= other ROI statistics to add to the master file besides the mean, from: median, trimmed_mean,\n"
+		 "			  sd, count, peak, top - trimmed_mean and top take a percentage (e.g. \"trimmed_mean:20\", \"top:5\",\n"
+		 "			  default 10). Each one gets <statistic>_average and <statistic>_sem columns. Default is none.\n\n"
+		 "   trace		= file to save a timing trace of the run to: a .json path gives a Chrome trace (chrome://tracing),\n"
+		 "			  any other path gives JSON lines. Every stage and subject/GLM is timed. Default is no trace\n"
+		 "			  (or the AFNI_TRACE environment variable).\n\n"
+		 "   profile		= true/false - with a trace, also run every stage under cProfile (saved beside the trace). Default is false.\n\n"
+		 "   ignore_geometry_mismatch = true/false - continue even if a file's orientation does not match coord_system\n"
+		 "			  (spheres), or its orientation or origin does not match the masks (pre-defined or weighted masks, or atlas).\n"
+		 "			  Default is false (all mismatches are listed, and the script stops). Files whose dimensions or\n"
+		 "			  voxel size do not match the masks always stop the script.\n\n\n"
+		 "Several config files may be given; they are run one after another.\n")
+
+
+# Reads a JSON or YAML config file into a dict
+def read_config(config_path):
+	if not os.path.exists(config_path):
+		sys.exit("XXXXX\nConfig file not found: %s\nXXXXX" % config_path)
+	with open(config_path, 'r') as config_file:
+		if config_path.endswith(".yaml") or config_path.endswith(".yml"):
+			if yaml is None:
+				sys.exit("XXXXX\nPyYAML is needed to read %s (pip install pyyaml), or use a .json config file instead.\nXXXXX" % config_path)
+			return yaml.safe_load(config_file)
+		return json.load(config_file)
+
+
+# Picks the GLMs and conditions to use - selection is {GLM: "all" or [conditions]}, or None for every GLM and condition
+def choose_conditions(possible_conditions_list, selection, GLM_type):
+	if selection is None:
+		return dict((GLM, list(possible_conditions_list[GLM])) for GLM in possible_conditions_list)
+	final_list = {}
+	for GLM in selection:
+		if GLM not in possible_conditions_list:
+			sys.exit("XXXXX\nThe %s GLM '%s' was not found in any of the chosen subjects.\nXXXXX" % (GLM_type, GLM))
+		if selection[GLM] == "all":
+			final_list[GLM] = list(possible_conditions_list[GLM])
+		else:
+			missing = [x for x in selection[GLM] if x not in possible_conditions_list[GLM]]
+			if missing:
+				sys.exit("XXXXX\nThe %s GLM '%s' has no condition(s) named: %s\nAvailable conditions: %s\nXXXXX" % (GLM_type, GLM, ", ".join(missing), ", ".join(possible_conditions_list[GLM])))
+			final_list[GLM] = list(selection[GLM])
+	return final_list
+
+
+# Returns the ROI files to use ({file name: path}) - every file matching pattern, or only the ones named in the config
+def choose_ROI_files(masks_path, pattern, chosen, file_type):
+	ROI_files = {}
+	for ROI_path in glob.glob(os.path.join(masks_path, pattern)):
+		ROI_file = ROI_path.split("/")[-1]
+		if " " in ROI_file:
+			sys.exit("Please make sure that no %s have spaces in their filename." % file_type)
+		ROI_files[ROI_file] = ROI_path
+	if chosen is not None:
+		missing = [x for x in chosen if x not in ROI_files]
+		if missing:
+			sys.exit("XXXXX\nThese %s were not found in %s: %s\nXXXXX" % (file_type, masks_path, ", ".join(missing)))
+		ROI_files = dict((x, ROI_files[x]) for x in chosen)
+	if not ROI_files:
+		sys.exit("XXXXX\nNo %s were found in %s\nXXXXX" % (file_type, masks_path))
+	return ROI_files
+
+
+# Runs one config file from start to finish
+def run_config(config):
+	for required in ['subject_results', 'analyses']:
+		if required not in config:
+			sys.exit("XXXXX\nThe config file is missing '%s'.\nXXXXX" % required)
+
+	subject_results = config['subject_results']
+	masks_path = config.get('masks_path')
+	analyses = [x.lower() for x in config['analyses']]
+	for method in analyses:
+		if not ("sphere" in method or "mask" in method or "atlas" in method) or not ("magnitude" in method or "timecourse" in method):
+			sys.exit("XXXXX\nUnknown analysis '%s' - each analysis must name 'sphere', 'mask', 'weighted mask' or 'atlas', and 'magnitude' or 'timecourse'.\nXXXXX" % method)
+
+	spherical = any("sphere" in method for method in analyses)
+	predefined = any("mask" in method for method in analyses)
+	atlas = any("atlas" in method for method in analyses)
+	GAM = any("magnitude" in method for method in analyses)
+	TENT = any("timecourse" in method for method in analyses)
+
+	coord_system = config.get('coord_system')
+	sphere_radius = config.get('sphere_radius')
+	if spherical:
+		if coord_system not in ["LPI", "RAI"]:
+			sys.exit("Please make sure coord_system is either 'LPI' or 'RAI'.")
+		try:
+			sphere_radius = int(sphere_radius)
+		except:
+			sys.exit("Please make sure you provide an integer for your sphere radius.")
+
+	if (spherical or predefined) and masks_path is None:
+		sys.exit("XXXXX\nThe config file is missing 'masks_path'.\nXXXXX")
+
+	atlas_path = config.get('atlas')
+	label_table_path = config.get('label_table')
+	if atlas:
+		if atlas_path is None:
+			sys.exit("XXXXX\nThe config file is missing 'atlas' (the labeled atlas dataset).\nXXXXX")
+		if not (os.path.exists(atlas_path) or os.path.exists(atlas_path + ".HEAD")):
+			sys.exit("XXXXX\nAtlas not found: %s\nXXXXX" % atlas_path)
+
+	reducers = config.get('statistics', [])
+	ROI_Extraction.ROI_Reducers.reducer_columns(reducers)  # stops here if a statistic is unknown
+
+	try:
+		processes = int(config.get('processes', 1))
+		if processes < 1:
+			raise ValueError
+	except:
+		sys.exit("Please make sure you provide a positive integer for the number of parallel processes.")
+
+	subject_folders1 = sorted([x for x in os.listdir(subject_results) if "subj" in x and ".DS_Store" not in x])
+	if config.get('subjects') is not None:
+		chosen_subjects = ["subj." + str(x) if not str(x).startswith("subj.") else str(x) for x in config['subjects']]
+		missing = [x for x in chosen_subjects if x not in subject_folders1]
+		if missing:
+			sys.exit("XXXXX\nThese subject folders were not found in %s: %s\nXXXXX" % (subject_results, ", ".join(missing)))
+		subject_folders1 = sorted(chosen_subjects)
+
+	coord_list = {}
+	mask_list = {}
+	if spherical:
+		coord_list = choose_ROI_files(masks_path, "*.txt", config.get('coordinates'), "text files with coordinates")
+	if predefined:
+		mask_list = choose_ROI_files(masks_path, "*+tlrc.HEAD", config.get('masks'), "AFNI mask files")
+
+	GLM_GAM_folders, GLM_TENT_folders = ROI_Extraction.find_GLM_folders(subject_results, subject_folders1, GAM=GAM, TENT=TENT)
+
+	possible_GAM_conditions_list = {}
+	possible_TENT_conditions_list = {}
+	for GLM_folder in GLM_GAM_folders:
+		possible_conditions = ROI_Extraction.possible_conditions(subject_results, subject_folders1, GLM_folder, "magnitudes")
+		possible_GAM_conditions_list[GLM_folder] = ROI_Extraction.shorten_conditions(possible_conditions)
+	for GLM_folder in GLM_TENT_folders:
+		possible_conditions = ROI_Extraction.possible_conditions(subject_results, subject_folders1, GLM_folder, "timecourses")
+		possible_TENT_conditions_list[GLM_folder] = ROI_Extraction.shorten_conditions(possible_conditions)
+
+	final_GAM_list = choose_conditions(possible_GAM_conditions_list, config.get('GAM_GLMs'), "GAM")
+	final_TENT_list = choose_conditions(possible_TENT_conditions_list, config.get('TENT_GLMs'), "TENT")
+
+	starttime = datetime.now()
+	print_starttime = starttime.strftime("%m-%d-%Y, %I:%M:%S %p")
+	print("Begin script execution: " + str(print_starttime))
+	ROI_Extraction.Run_Trace.start("ROI_AFNI_batch", config.get('trace'), config.get('profile'))
+
+	for method in analyses:
+		settings = ROI_Extraction.method_settings(method, subject_results, coord_list, mask_list, sphere_radius, coord_system,
+												  final_GAM_list, final_TENT_list, starttime, atlas_path, label_table_path, reducers)
+
+		print("\n\n#########################")
+		print("Processing %s ROI(s) - %s" % (settings['method_ROI'], settings['method_type']))
+		print("#########################")
+
+		extraction_units = ROI_Extraction.extraction_units(settings, subject_folders1)
+
+		# check the geometry of every file up front, and list every mismatch at once (there is nobody to click 'Continue')
+		checked_count, mismatches, fatal = ROI_Extraction.check_geometry(settings, extraction_units)
+		print("Geometry checked for %s files" % checked_count)
+		if fatal:
+			sys.exit("XXXXX\n%s file(s) do not have the dimensions or voxel size of your masks, so the masks cannot be used with them:\n%s\nXXXXX" % (len(fatal), "\n".join(fatal)))
+		if mismatches:
+			print("\nWARNING: %s file(s) do not match your ROIs. This could result in the wrong ROI being used:\n%s\n" % (len(mismatches), "\n".join(mismatches)))
+			if not config.get('ignore_geometry_mismatch', False):
+				sys.exit("Set 'ignore_geometry_mismatch' to true in the config file to continue anyway.")
+
+		try:
+			all_GLM_condition_pairs, results = ROI_Extraction.run_extraction(settings, extraction_units, processes)
+		except ValueError as error:  # a mask that does not fit the grid of a dataset
+			sys.exit("XXXXX\n%s\nXXXXX" % error)
+
+		ROI_Extraction.write_master_file(settings, all_GLM_condition_pairs, results)
+
+	endtime = datetime.now()
+	print_endtime = endtime.strftime("%m-%d-%Y, %I:%M:%S %p")
+	print("End script execution: " + str(print_endtime))
+
+	print("Total script duration: " + time_duration(starttime, endtime))
+	ROI_Extraction.Run_Trace.finish()
+
+
+def main():
+	if len(sys.argv) < 2:
+		print(usage)
+		sys.exit()
+
+	for config_path in sys.argv[1:]:
+		print("\n#########################\nConfig file: %s\n#########################" % config_path)
+		run_config(read_config(config_path))
+
+
+if __name__ == '__main__':
+	main()
@@ -1,16 +1,16 @@
 #!/usr/bin/python
 
 import os
+import sys
 import glob
 import subprocess
-import csv
-import numpy
 from datetime import datetime
-from operator import add
-from scipy import stats
 from Tkinter import *
 import time
-from tkFileDialog import askdirectory
+from tkFileDialog import askdirectory, askopenfilename
+
+import ROI_Extraction
+from ROI_Extraction import time_duration
 
 
 # The purpose of this script is to extract averaged ROI magnitudes and timecourses in AFNI
@@ -21,48 +21,13 @@ from tkFileDialog import askdirectory
 # The file should contain 3 numbers in LPI or RAI order (based on your dataset), separated by spaces or commas (e.g. "-5 42.5 21" without quotes)
 
 # All mask files should be pairs of AFNI .HEAD/.BRIK files, comprising a masked region
+# A weighted mask (e.g. a probability map) uses the same mask files, but every voxel above 0 counts by its value in the
+# mask, so the ROI value is a weighted mean instead of a plain mean
 
+# A labeled atlas is one integer-valued AFNI dataset (e.g. a parcellation), where every label value is an ROI. Labels are
+# named from a label table text file with one "value name" pair per line (e.g. "12 Left_Hippocampus"), if one is given,
+# or else from the atlas's own label table.
 
-duration_string = ""
-# Function for printing a string with the elapsed time
-def time_duration(starttime, currenttime):
-    global duration_string
-    duration_string = ""
-    totaltime = currenttime - starttime
-    if "day" in str(totaltime):
-        time_days = int(str(totaltime)[:1])
-    else:
-        time_days = 0
-    time_minutes = (totaltime.seconds - (totaltime.seconds % 60)) / 60
-    if time_minutes > 59:
-        minutes_left = time_minutes % 60
-        time_hours = (time_minutes - minutes_left) / 60
-        time_minutes = minutes_left
-    else:
-        time_hours = 0
-    time_seconds = totaltime.seconds % 60
-    if time_days > 0:
-        duration_string = duration_string + str(time_days) + " day"
-    if time_days > 1:
-        duration_string = duration_string + "s"
-    if time_days > 0:
-        duration_string = duration_string + ", "
-    if time_days > 0 or time_hours > 0:
-        duration_string = duration_string + str(time_hours) + " hour"
-        if time_hours != 1:
-            duration_string = duration_string + "s"
-        duration_string = duration_string + ", "
-    if time_days > 0 or time_hours > 0 or time_minutes > 0:
-        duration_string = duration_string + str(time_minutes) + " minute"
-        if time_minutes != 1:
-            duration_string = duration_string + "s"
-	if time_days > 0 or time_hours > 0:
-		duration_string = duration_string + ", "
-    if duration_string:
-        duration_string = duration_string + " and "
-    duration_string = duration_string + str(time_seconds) + " second"
-    if time_seconds != 1:
-        duration_string = duration_string + "s"
 
 
 ####################
@@ -78,13 +43,17 @@ with open(presets_control_file) as control_file:
 	presets_init = control_file.read().splitlines()
 presets = {}
 for item in presets_init:
-	splits = item.split(":")
+	splits = item.split(":", 1)
 	presets[splits[0]] = splits[1]
 
 input_subject_results_path = presets['subject_results_path']
 input_masks_path = presets['masks_path']
 input_coord_system = presets['coord_system']
 input_sphere_radius = presets['sphere_radius']
+input_processes = presets.get('processes', '1')  # number of subject/GLM folders processed in parallel
+input_atlas_path = presets.get('atlas_path', '')
+input_label_table_path = presets.get('label_table_path', '')
+input_statistics = presets.get('statistics', '')  # other ROI statistics besides the mean, e.g. "median, top:10"
 
 
 ####################
@@ -113,7 +82,11 @@ mainloop()
 analysis_choices = ['Sphere from coordinate (magnitude)',
 					'Sphere from coordinate (timecourse)',
 					'Pre-defined mask (magnitude)',
-					'Pre-defined mask (timecourse)']
+					'Pre-defined mask (timecourse)',
+					'Labeled atlas (magnitude)',
+					'Labeled atlas (timecourse)',
+					'Weighted mask (magnitude)',
+					'Weighted mask (timecourse)']
 
 buttons_list = analysis_choices
 buttons = {}
@@ -172,15 +145,24 @@ subject_results = None
 masks_path = None
 coord_system = None
 sphere_radius = None
+processes = None
+atlas_path = None
+label_table_path = None
+statistics = None
 
 coord_system_selection = None
 
 def entry_fields():
-	global subject_results, masks_path, sphere_radius
+	global subject_results, masks_path, sphere_radius, processes, atlas_path, label_table_path, statistics
 	subject_results = e1.get()
 	masks_path = e2.get()
 	if analysis_choices[0] in analyses or analysis_choices[1] in analyses:
 		sphere_radius = e3.get()
+	if analysis_choices[4] in analyses or analysis_choices[5] in analyses:
+		atlas_path = e5.get()
+		label_table_path = e6.get()
+	processes = e4.get()
+	statistics = e7.get()
 	master.destroy()
 
 def sel1():
@@ -197,6 +179,16 @@ def path_choose2():
     e2.delete(0, 'end')
     e2.insert(0, filepath2)
 
+def path_choose5():
+	filepath5 = askopenfilename()
+	e5.delete(0, 'end')
+	e5.insert(0, filepath5)
+
+def path_choose6():
+	filepath6 = askopenfilename()
+	e6.delete(0, 'end')
+	e6.insert(0, filepath6)
+
 def exitscript():
 	sys.exit()
 
@@ -244,11 +236,39 @@ if analysis_choices[0] in analyses or analysis_choices[1] in analyses:
 	e3.insert(0, input_sphere_radius)
 	e3.grid(row=16, column=1, sticky=W)
 
-Label(master, text='').grid(row=17)
+if analysis_choices[4] in analyses or analysis_choices[5] in analyses:
+	Label(master, text='').grid(row=17)
+
+	Label(master, text='Labeled atlas (one integer-valued AFNI dataset, e.g. atlas+tlrc.HEAD)').grid(row=18, padx=20, columnspan=2)
+	e5 = Entry(master, width=50)
+	e5.insert(0, input_atlas_path)
+	e5.grid(row=19, padx=20, columnspan=2)
+	Button(master, text="Browse", command=path_choose5).grid(row=20, column=0, columnspan=2)
+
+	Label(master, text='Label table (optional - "value name" on each line)').grid(row=21, padx=20, columnspan=2)
+	e6 = Entry(master, width=50)
+	e6.insert(0, input_label_table_path)
+	e6.grid(row=22, padx=20, columnspan=2)
+	Button(master, text="Browse", command=path_choose6).grid(row=23, column=0, columnspan=2)
+
+Label(master, text='').grid(row=24)
+
+Label(master, text='Parallel processes:  ').grid(row=25, column=0, sticky=E)
+e4 = Entry(master, width=3)
+e4.insert(0, input_processes)
+e4.grid(row=25, column=1, sticky=W)
 
-Button(master, text='Submit', command=entry_fields).grid(row=18, sticky=S,
+Label(master, text='Other ROI statistics (optional):  ').grid(row=26, column=0, sticky=E)
+e7 = Entry(master, width=30)
+e7.insert(0, input_statistics)
+e7.grid(row=26, column=1, sticky=W)
+Label(master, text='e.g. "median, trimmed_mean:10, sd, count, peak, top:10" - each is added to the master file').grid(row=27, padx=20, columnspan=2)
+
+Label(master, text='').grid(row=28)
+
+Button(master, text='Submit', command=entry_fields).grid(row=29, sticky=S,
 														 pady=4, columnspan=2)
-Button(master, text='Cancel', command=exitscript).grid(row=19, sticky=S,
+Button(master, text='Cancel', command=exitscript).grid(row=30, sticky=S,
 														 pady=4, columnspan=2)
 
 master.update_idletasks()
@@ -273,6 +293,22 @@ if analysis_choices[0] in analyses or analysis_choices[1] in analyses:
 	except:
 		sys.exit("Please make sure you provide an integer for your sphere radius.")
 
+reducers = [x.strip() for x in statistics.split(",") if x.strip()]
+ROI_Extraction.ROI_Reducers.reducer_columns(reducers)  # stops here if a statistic is unknown
+
+if analysis_choices[4] in analyses or analysis_choices[5] in analyses:
+	if not (os.path.exists(atlas_path) or os.path.exists(atlas_path + ".HEAD")):
+		sys.exit("Please make sure the path to your labeled atlas is correct.")
+	if label_table_path and not os.path.exists(label_table_path):
+		sys.exit("Please make sure the path to your label table is correct (or leave it empty).")
+
+try:
+	processes = int(processes)
+	if processes < 1:
+		raise ValueError
+except:
+	sys.exit("Please make sure you provide a positive integer for the number of parallel processes.")
+
 
 ####################################################################################################
 ##### Updating Presets Control List #####
@@ -280,13 +316,20 @@ if analysis_choices[0] in analyses or analysis_choices[1] in analyses:
 if not analysis_choices[0] in analyses and not analysis_choices[1] in analyses:
 	coord_system = input_coord_system
 	sphere_radius = input_sphere_radius
-if not analysis_choices[2] in analyses and not analysis_choices[3] in analyses:
+if not analysis_choices[2] in analyses and not analysis_choices[3] in analyses and not analysis_choices[6] in analyses and not analysis_choices[7] in analyses:
 	masks_path = input_masks_path
+if not analysis_choices[4] in analyses and not analysis_choices[5] in analyses:
+	atlas_path = input_atlas_path
+	label_table_path = input_label_table_path
 
 new_control_list = ['subject_results_path:' + subject_results,
 					'masks_path:' + masks_path,
 					'coord_system:' + coord_system,
-					'sphere_radius:' + str(sphere_radius)]
+					'sphere_radius:' + str(sphere_radius),
+					'processes:' + str(processes),
+					'atlas_path:' + atlas_path,
+					'label_table_path:' + label_table_path,
+					'statistics:' + ", ".join(reducers)]
 
 with open(presets_control_file, 'w') as control_file:
 	control_file.writelines('\n'.join(new_control_list))
@@ -376,6 +419,9 @@ subject_folders1 = sorted(subject_folders1)  # order the folders alphabetically
 
 ####################
 
+coord_list = {}
+mask_list = {}
+
 if analysis_choices[0] in analyses or analysis_choices[1] in analyses:
 	coord_path_list = glob.glob(os.path.join(masks_path, "*.txt"))
 	coord_list = {}
@@ -399,7 +445,7 @@ if analysis_choices[0] in analyses or analysis_choices[1] in analyses:
 		files_and_coordinates[item] = coordinate_values  # resulting dict format: {'region.txt': '(x_coord, y_coord, z_coord)'}
 		
 		
-if analysis_choices[2] in analyses or analysis_choices[3] in analyses:
+if analysis_choices[2] in analyses or analysis_choices[3] in analyses or analysis_choices[6] in analyses or analysis_choices[7] in analyses:
 	masks_path_list = glob.glob(os.path.join(masks_path, "*+tlrc.HEAD"))
 	mask_list = {}
 	for mask_file in masks_path_list:
@@ -428,12 +474,19 @@ if analysis_choices[0] in analyses or analysis_choices[1] in analyses:
 		label2 = Label(root, text=file, font='helvetica 14 bold').grid(column=1)
 		label3 = Label(root, text=files_and_coordinates[file], font='helvetica 14 bold').grid(column=1)
 	label4 = Label(root,text="").grid(columnspan=3)
-if analysis_choices[2] in analyses or analysis_choices[3] in analyses:	
+if analysis_choices[2] in analyses or analysis_choices[3] in analyses or analysis_choices[6] in analyses or analysis_choices[7] in analyses:	
 	label5 = Label(root, text="The following are the files which will be used for pre-determined ROIs:").grid(columnspan=3)
 	label6 = Label(root,text="").grid(columnspan=3)
 	for file in check_files:
 		label7 = Label(root, text=file, font='helvetica 14 bold').grid(column=1)
 	label8 = Label(root,text="").grid(columnspan=3)
+if analysis_choices[4] in analyses or analysis_choices[5] in analyses:
+	Label(root, text="The following labeled atlas will be used (every label is an ROI):").grid(columnspan=3)
+	Label(root, text="").grid(columnspan=3)
+	Label(root, text=atlas_path, font='helvetica 14 bold').grid(column=1)
+	if label_table_path:
+		Label(root, text="Labels named by: " + label_table_path).grid(column=1)
+	Label(root, text="").grid(columnspan=3)
 label9 = Label(root,text="If these are correct, click 'Continue.' If not, click 'Quit' and change the files found in:").grid(columnspan=3)
 label11 = Label(root,text=masks_path).grid(columnspan=3)
 button = Button(root, text='Continue', width=25, command=root.destroy).grid(columnspan=3)  # button closes window when pressed
@@ -453,39 +506,9 @@ root.mainloop()
 #Get names of all possible GLM folders
 ####################
 
-possible_GLM_folders = []
-
-GLM_GAM_folders = []
-GLM_TENT_folders = []
-
-for folder in subject_folders1:
-	subj_number = folder[5:]
-
-	results_folders = os.listdir(os.path.join(subject_results, folder))
-	results_folders = [x for x in results_folders if (".DS_Store" not in x)]
-	results_folder = os.path.join(subject_results, folder, results_folders[0]) #results folder inside subject folder
-	GLM_folders = glob.glob(os.path.join(results_folder, "*"))
-	GLM_folders1 = []
-	for folder in GLM_folders:
-		splits = folder.split("/")
-		GLM_folders1.append(splits[-1])
-	if analysis_choices[0] in analyses or analysis_choices[2] in analyses:
-		for potential_folder in GLM_folders1:
- 			check = glob.glob(os.path.join(results_folder, potential_folder, "stats*"))  # for GAM GLMs
- 			check1 = glob.glob(os.path.join(results_folder, potential_folder, "iresp*"))  # for TENT GLMs
-			if check and not check1:  # if the folder has a stats file, but no iresp files
-				if not potential_folder in GLM_GAM_folders:
-					GLM_GAM_folders.append(potential_folder)		
-	if analysis_choices[1] in analyses or analysis_choices[3] in analyses:
-		for potential_folder in GLM_folders1:
- 			check = glob.glob(os.path.join(results_folder, potential_folder, "iresp*"))  # for TENT GLMs
-			if check:  # if the folder has any iresp files
-				if not potential_folder in GLM_TENT_folders:
-					GLM_TENT_folders.append(potential_folder)
-			
-
-GLM_GAM_folders = sorted(GLM_GAM_folders)
-GLM_TENT_folders = sorted(GLM_TENT_folders)	
+GLM_GAM_folders, GLM_TENT_folders = ROI_Extraction.find_GLM_folders(subject_results, subject_folders1,
+																	GAM=(analysis_choices[0] in analyses or analysis_choices[2] in analyses or analysis_choices[4] in analyses or analysis_choices[6] in analyses),
+																	TENT=(analysis_choices[1] in analyses or analysis_choices[3] in analyses or analysis_choices[5] in analyses or analysis_choices[7] in analyses))
 
 buttons_list_GAM = GLM_GAM_folders
 buttons_list_TENT = GLM_TENT_folders
@@ -506,19 +529,19 @@ root.wm_attributes("-topmost", 1)  # makes sure that the window appears on top o
 
 
 def end():
-	if analysis_choices[0] in analyses or analysis_choices[2] in analyses:
+	if analysis_choices[0] in analyses or analysis_choices[2] in analyses or analysis_choices[4] in analyses or analysis_choices[6] in analyses:
 		for item in buttons_GAM:
 				buttons_outcome_GAM[item] = buttons_GAM[item].get()
-	if analysis_choices[1] in analyses or analysis_choices[3] in analyses:
+	if analysis_choices[1] in analyses or analysis_choices[3] in analyses or analysis_choices[5] in analyses or analysis_choices[7] in analyses:
 		for item in buttons_TENT:
 				buttons_outcome_TENT[item] = buttons_TENT[item].get()
 	root.destroy()
 
 def selectall():
-	if analysis_choices[0] in analyses or analysis_choices[2] in analyses:
+	if analysis_choices[0] in analyses or analysis_choices[2] in analyses or analysis_choices[4] in analyses or analysis_choices[6] in analyses:
 		for item in buttons_GAM:
 			buttons_GAM[item].set(1)
-	if analysis_choices[1] in analyses or analysis_choices[3] in analyses:
+	if analysis_choices[1] in analyses or analysis_choices[3] in analyses or analysis_choices[5] in analyses or analysis_choices[7] in analyses:
 		for item in buttons_TENT:
 			buttons_TENT[item].set(1)
 
@@ -531,15 +554,15 @@ def selectall_TENT():
 		buttons_TENT[item].set(1)
 
 def unselectall():
-	if analysis_choices[0] in analyses or analysis_choices[2] in analyses:
+	if analysis_choices[0] in analyses or analysis_choices[2] in analyses or analysis_choices[4] in analyses or analysis_choices[6] in analyses:
 		for item in buttons_GAM:
 			buttons_GAM[item].set(0)
-	if analysis_choices[1] in analyses or analysis_choices[3] in analyses:
+	if analysis_choices[1] in analyses or analysis_choices[3] in analyses or analysis_choices[5] in analyses or analysis_choices[7] in analyses:
 		for item in buttons_TENT:
 			buttons_TENT[item].set(0)
 
 
-if (analysis_choices[0] in analyses or analysis_choices[2] in analyses) and (analysis_choices[1] in analyses or analysis_choices[3] in analyses):
+if (analysis_choices[0] in analyses or analysis_choices[2] in analyses or analysis_choices[4] in analyses or analysis_choices[6] in analyses) and (analysis_choices[1] in analyses or analysis_choices[3] in analyses or analysis_choices[5] in analyses or analysis_choices[7] in analyses):
 	label = Label(root, text="Please select the GLMs to use").grid(row=1, columnspan=2, padx=20, pady=5)
 	button1 = Button(root, text="Select All", command = selectall).grid(row=2, columnspan=2)
 	button2 = Button(root, text="Unselect All", command = unselectall).grid(row=3, columnspan=2)
@@ -554,8 +577,8 @@ else:
 
 row = start_row
 tent_row = start_row
-if analysis_choices[0] in analyses or analysis_choices[2] in analyses:
-	if analysis_choices[1] in analyses or analysis_choices[3] in analyses:
+if analysis_choices[0] in analyses or analysis_choices[2] in analyses or analysis_choices[4] in analyses or analysis_choices[6] in analyses:
+	if analysis_choices[1] in analyses or analysis_choices[3] in analyses or analysis_choices[5] in analyses or analysis_choices[7] in analyses:
 		columnspan = 2
 		for button in buttons_list_GAM:
 			buttons_GAM[button] = IntVar()
@@ -617,84 +640,14 @@ use_GLM_folders = use_GAM + use_TENT
 
 possible_GAM_conditions_list = {}
 possible_TENT_conditions_list = {}
-	
+
 for GLM_folder in use_GAM:
-	possible_conditions = []
-	for folder in subject_folders1:  # find a subject who has this GLM, to extract info about it
-		subj_number = folder[5:]
-		results_folders = os.listdir(os.path.join(subject_results, folder))
-		results_folders = [x for x in results_folders if (".DS_Store" not in x)]
-		results_folder = os.path.join(subject_results, folder, results_folders[0])
-		if os.path.exists(os.path.join(results_folder, GLM_folder)):
-			GLM_folder_path = os.path.join(results_folder, GLM_folder)
-			break
-	GLM_conditions = []		
-	stats_files = glob.glob(os.path.join(GLM_folder_path, "stats*.HEAD"))
-	stat_splits = stats_files[0].split("/")
-	stats_file = stat_splits[-1]
-	stats_path = os.path.join(GLM_folder_path, stats_file)
-	proc = subprocess.Popen("3dinfo -label %s" % (stats_path), shell=True, stdout=subprocess.PIPE)
-	label_names = proc.stdout.read()
-	name_list = label_names.split("|")
-	stat_condition_list = [fn for fn in name_list if "#0_Coef" in fn]
-	for condition in stat_condition_list:
-		possible_conditions.append(condition[:-7])
-	possible_GAM_conditions_list[GLM_folder] = possible_conditions
+	possible_conditions = ROI_Extraction.possible_conditions(subject_results, subject_folders1, GLM_folder, "magnitudes")
+	possible_GAM_conditions_list[GLM_folder] = ROI_Extraction.shorten_conditions(possible_conditions)
 
 for GLM_folder in use_TENT:
-	possible_conditions = []
-	for folder in subject_folders1:  # find a subject who has this GLM, to extract info about it
-		subj_number = folder[5:]
-		results_folders = os.listdir(os.path.join(subject_results, folder))
-		results_folders = [x for x in results_folders if (".DS_Store" not in x)]
-		results_folder = os.path.join(subject_results, folder, results_folders[0])
-		if os.path.exists(os.path.join(results_folder, GLM_folder)):
-			GLM_folder_path = os.path.join(results_folder, GLM_folder)
-			break
-	GLM_conditions = []		
-	iresp_files = glob.glob(os.path.join(GLM_folder_path, "iresp*.HEAD"))
-	iresp_files1 = []
-	for iresp_file in iresp_files:
-		splits = iresp_file.split("/")
-		iresp_files1.append(splits[-1])
-	for iresp_file in iresp_files1:	
-		iresp = iresp_file[:-10]  # remove the '+tlrc.HEAD' from iresp file
-		iresp_split = iresp[6:].split(".")  # remove "iresp" from filename, split at '.' (lose participant number)
-		condition = iresp_split[0]  # keeps only the user-specified condition name
-		possible_conditions.append(condition)
-	possible_TENT_conditions_list[GLM_folder] = possible_conditions
-
-
-
-
-def long_substr(data):
-    substr = ''
-    if len(data) > 1 and len(data[0]) > 0:
-        for i in range(len(data[0])):
-            for j in range(len(data[0])-i+1):
-                if j > len(substr) and is_substr(data[0][i:i+j], data) and len(data[0][i:i+j]) > 2:
-                    substr = data[0][i:i+j]
-    return substr
-
-def is_substr(find, data):
-    if len(data) < 1 and len(find) < 1:
-        return False
-    for i in range(len(data)):
-        if find not in data[i]:
-            return False
-    return True
-
-for item in possible_GAM_conditions_list:
-	for i in range(0,5):
-		long_substring = long_substr(possible_GAM_conditions_list[item])
-		possible_GAM_conditions_list[item] = [x.replace(long_substring, '') for x in possible_GAM_conditions_list[item]]
-		possible_GAM_conditions_list[item] = sorted(possible_GAM_conditions_list[item])
-
-for item in possible_TENT_conditions_list:
-	for i in range(0,5):
-		long_substring = long_substr(possible_TENT_conditions_list[item])
-		possible_TENT_conditions_list[item] = [x.replace(long_substring, '') for x in possible_TENT_conditions_list[item]]
-		possible_TENT_conditions_list[item] = sorted(possible_TENT_conditions_list[item])
+	possible_conditions = ROI_Extraction.possible_conditions(subject_results, subject_folders1, GLM_folder, "timecourses")
+	possible_TENT_conditions_list[GLM_folder] = ROI_Extraction.shorten_conditions(possible_conditions)
 
 
 root = Tk()
@@ -715,19 +668,8 @@ for GLM in possible_TENT_conditions_list:
 	buttons_TENT[GLM] = new_GLM_dict
 
 
-shortened_GAM_responses = []
-for GLM in buttons_GAM:
-	for response in buttons_GAM[GLM]:
-		if response not in shortened_GAM_responses:
-			shortened_GAM_responses.append(response)
-shortened_GAM_responses = sorted(shortened_GAM_responses)
-	
-shortened_TENT_responses = []
-for GLM in buttons_TENT:
-	for response in buttons_TENT[GLM]:
-		if response not in shortened_TENT_responses:
-			shortened_TENT_responses.append(response)
-shortened_TENT_responses = sorted(shortened_TENT_responses)	
+shortened_GAM_responses = ROI_Extraction.shortened_responses(possible_GAM_conditions_list)
+shortened_TENT_responses = ROI_Extraction.shortened_responses(possible_TENT_conditions_list)
 	
 
 buttons_GAM_outcome = {}
@@ -818,8 +760,8 @@ def TENT_short_button(key):
 
 TENT_condition_column = 0
 columnspan = 1
-if analysis_choices[0] in analyses or analysis_choices[2] in analyses:
-	if analysis_choices[1] in analyses or analysis_choices[3] in analyses:
+if analysis_choices[0] in analyses or analysis_choices[2] in analyses or analysis_choices[4] in analyses or analysis_choices[6] in analyses:
+	if analysis_choices[1] in analyses or analysis_choices[3] in analyses or analysis_choices[5] in analyses or analysis_choices[7] in analyses:
 		columnspan = 2
 		TENT_condition_column = 1
 
@@ -933,400 +875,81 @@ for item in buttons_TENT_outcome:
 	final_TENT_list[item] = checked_options
 
 
+##########
+# Make sure the geometry of the files matches the ROIs (the coordinate system for spheres, the grid for masks)
+##########
+def check_geometry(mismatches):
+	print("\nWARNING: %s file(s) do not match your ROIs:\n%s\n" % (len(mismatches), "\n".join(mismatches)))
+
+	shown_mismatches = mismatches[:20]
+	if len(mismatches) > 20:
+		shown_mismatches = shown_mismatches + ["...and %s more (the full list is printed in the terminal)" % (len(mismatches) - 20)]
+
+	master = Tk()
+	master.title("Geometry Mismatch")
+	master.geometry('+1070+500')
+	master.wm_attributes("-topmost", 1)
+
+	Label(master, text='Error for %s file(s):\n\n%s\n\n'
+					'These files do not match your ROIs (coordinate system %s, or the orientation or origin of your masks).\n'
+					'This could result in the wrong ROI being used.\n\n'
+					'Do you wish to continue anyway?' % (len(mismatches), "\n".join(shown_mismatches), coord_system)).grid(row=1, padx=20)
+	Label(master, text='').grid(row=2)
+
+	Button(master, text='Continue', command=master.destroy).grid(row=3, sticky=S,
+															pady=4)
+	Button(master, text='Exit', command=sys.exit).grid(row=4, sticky=S,
+														pady=4)
+
+	master.update_idletasks()
+	windowheight = master.winfo_height()
+	windowwidth = master.winfo_width()
+	positionRight = screenx + int(screenwidth / 2 - windowwidth / 2)
+	positionDown = screeny + int(screenheight / 2 - windowheight / 2)
+	master.geometry("+%s+%s" % (positionRight, positionDown))
+
+	mainloop()
+
+
 starttime = datetime.now()
 print_starttime = starttime.strftime("%m-%d-%Y, %I:%M:%S %p")
 print("Begin script execution: " + str(print_starttime))
+ROI_Extraction.Run_Trace.start("ROI_AFNI_tool")  # only if the AFNI_TRACE environment variable names a trace file
 
 ########################################################################
 # CALCULATE
 ########################################################################
 for method in analyses:
 
-	all_GLM_condition_pairs = {}
-
-	if "sphere" in method:
-		method_ROI = "spherical"
-		ROI_list = coord_list
-
-	if "mask" in method:
-		method_ROI = "predefined_mask"
-		ROI_list = mask_list
-
-	if "magnitude" in method:
-		method_type = "magnitudes"
-		final_list = final_GAM_list
-		shortened_responses = shortened_GAM_responses
-		file_type = "stats"
-
-	if "timecourse" in method:
-		method_type = "timecourses"
-		final_list = final_TENT_list
-		shortened_responses = shortened_TENT_responses
-		file_type = "iresp"
-
+	settings = ROI_Extraction.method_settings(method, subject_results, coord_list, mask_list, sphere_radius, coord_system,
+											  final_GAM_list, final_TENT_list, starttime, atlas_path, label_table_path, reducers)
 
 	print("\n\n#########################")
-	print("Processing %s ROI(s) - %s" % (method_ROI, method_type))
+	print("Processing %s ROI(s) - %s" % (settings['method_ROI'], settings['method_type']))
 	print("#########################")
 
+	# break the job into independent (subject, GLM) units
+	extraction_units = ROI_Extraction.extraction_units(settings, subject_folders1)
 
-	###iterate through each subject
-	for folder in subject_folders1:
-		subj_number = folder[5:]
-
-		time1 = datetime.now()
-		time_duration(starttime, time1)
-		print("***" + subj_number + "..." + duration_string + " elapsed")
-
-		results_folders = os.listdir(os.path.join(subject_results, folder))
-		results_folders = [x for x in results_folders if (".DS_Store" not in x)]
-		results_folder = os.path.join(subject_results, folder, results_folders[0]) #results folder inside subject folder
-			
-			
-		###iterate through each GLM	
-		for GLM_folder in final_list:
-			print(GLM_folder + "....")
-			GLM_folder_path = os.path.join(results_folder, GLM_folder)
-			if not os.path.exists(GLM_folder_path):
-				break
-			average_folder = os.path.join(GLM_folder_path, "%s_ROI_averages_%s" % (method_ROI, method_type))
-			if not os.path.exists(average_folder):
-				os.makedirs(average_folder)
-
-
-
-			GLM_conditions = []		
-		
-			# import spherical ROI coordinate text files
-			if method_ROI == "spherical":				
-				for spherical_ROI_coord in coord_list:
-					# If the coordinates have not been provided in the format required by AFNI, fix the text file
-					coord_file = open(coord_list[spherical_ROI_coord], 'r')
-					file_data = coord_file.readline()
-					coord_file.close()
-					if "," in file_data:
-						if not " " in file_data:  # values are 'a,b,c'
-							file_data = file_data.replace(",", " ")
-						else:  # values are 'a, b, c'
-							file_data = file_data.replace(", ", " ")
-						new_coord_file = open(coord_list[spherical_ROI_coord], 'w')
-						new_coord_file.writelines(file_data)
-						new_coord_file.close()
-
-					spherical_coord_path = os.path.join(GLM_folder_path, spherical_ROI_coord)
-					temp_spherical_coord_path = os.path.join(GLM_folder_path, "temp_" + spherical_ROI_coord)
-					if os.path.exists(spherical_coord_path):
-						subprocess.call("rm %s" % (spherical_coord_path), shell=True)
-					subprocess.call("cp %s %s" % (coord_list[spherical_ROI_coord], GLM_folder_path), shell=True)
-					subprocess.call("mv %s %s" % (spherical_coord_path, temp_spherical_coord_path), shell=True)
-
-			#import predefined ROI mask AFNI files
-			elif method_ROI == "predefined_mask":
-				temp_mask_paths = os.path.join(GLM_folder_path, "temp_*")
-				subprocess.call("rm %s" % temp_mask_paths, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)  # if there are any lingering masks from previous analyses, delete them
-				for Predef_ROI_mask in mask_list:
-					mask_path = os.path.join(GLM_folder_path, Predef_ROI_mask)
-					temp_head_mask_path = os.path.join(GLM_folder_path, "temp_" + Predef_ROI_mask)
-					brik_mask_path = os.path.join(GLM_folder_path, Predef_ROI_mask[:-5] + ".BRIK.gz")
-					temp_brik_mask_path = os.path.join(GLM_folder_path, "temp_" + Predef_ROI_mask[:-5] + ".BRIK.gz")
-
-					subprocess.call("cp %s* %s" % (mask_list[Predef_ROI_mask][:-5], GLM_folder_path), shell=True)
-					subprocess.call("mv %s %s" % (mask_path, temp_head_mask_path), shell=True)
-					subprocess.call("mv %s %s" % (brik_mask_path, temp_brik_mask_path), shell=True)
-			
-
-
-
-			analysis_files = glob.glob(os.path.join(GLM_folder_path, "%s*.HEAD" % file_type))
-
-			if method_type == "magnitudes":
-				proc = subprocess.Popen("3dinfo -label %s" % (analysis_files[0]), shell=True, stdout=subprocess.PIPE)
-				label_names = proc.stdout.read()
-				name_list = label_names.split("|")
-				condition_list = [fn for fn in name_list if "#0_Coef" in fn]
-				iterate = condition_list
-			elif method_type == "timecourses":
-				iterate = analysis_files
-
-
-			# this section prevents repeated filenames from being included wrong (i.e. you want 'hit', but that is contained in 'hit-cr_GLT')
-			use_list = []
-			for option in iterate:  # for each condition in the stats file (magnitude), or each iresp file in this folder (timecourse)
-				for condition in final_list[GLM_folder]:  # for each condition selected in the pop-up window
-					if condition in option:
-						unique = True
-						quick_list = [x for x in shortened_responses if x != condition]  
-						for other_option in quick_list:  # for each shortened_response option that isn't this one
-							if (other_option not in option) or (other_option in condition):
-								continue
-							else:
-								unique = False
-						if unique:
-							use_list.append(option)
-
-
-			##########
-			# Make sure the geometry of the file matches the coordinate system provided
-			##########
-			def check_geometry(input_file):
-				input_filepath = os.path.join(GLM_folder_path, input_file)
-				check = subprocess.Popen("3dinfo -orient %s" % (input_filepath), shell=True, stdout=subprocess.PIPE)
-				orient_check = check.stdout.read()
-				if not coord_system in orient_check:
-
-					master = Tk()
-					master.title("Coordinate System Mismatch")
-					master.geometry('+1070+500')
-					master.wm_attributes("-topmost", 1)
-
-					Label(master, text='Error for file:\n%s\n\n'
-									'The coordinate system you provided (%s) does not match your file (%s).\n'
-									'This could result in the wrong ROI being used.\n\n'
-									'Do you wish to continue anyway?' % ((input_filepath),
-																			coord_system,
-																			orient_check[:3])).grid(row=1, padx=20)
-					Label(master, text='').grid(row=2)
-
-					Button(master, text='Continue', command=master.destroy).grid(row=3, sticky=S,
-																			pady=4)
-					Button(master, text='Exit', command=sys.exit).grid(row=4, sticky=S,
-																		pady=4)
-
-					master.update_idletasks()
-					windowheight = master.winfo_height()
-					windowwidth = master.winfo_width()
-					positionRight = screenx + int(screenwidth / 2 - windowwidth / 2)
-					positionDown = screeny + int(screenheight / 2 - windowheight / 2)
-					master.geometry("+%s+%s" % (positionRight, positionDown))
-
-					mainloop()
-
-
-			if method_type == "timecourses":
-				iresp_files = []
-				for iresp_file in use_list:
-					splits = iresp_file.split("/")
-					iresp_files.append(splits[-1])
-					if method_ROI == "spherical":
-						check_geometry(splits[-1])
-				use_list = iresp_files
-			elif method_type == "magnitudes":
-				splits = analysis_files[0].split("/")
-				stats_file = splits[-1]
-				if method_ROI == "spherical":
-					check_geometry(stats_file)
-
-
-			###iterate through each condition/event type for this GLM		
-			for condition in use_list:
-				if method_type == "magnitudes":
-					condition_name = condition[:-7]
-					use_file = stats_file[:-5]
-				elif method_type == "timecourses":
-					condition = condition[:-5]   # remove the .HEAD from iresp file
-					split = condition[6:].split(".")  # remove "iresp" from filename, split at "."
-					condition_name = split[0]  # keeps only the user-specified condition name
-					use_file = condition
-				if method_ROI == "spherical":
-					for spherical_ROI_coord in coord_list:
-						spherical_ROI_name = spherical_ROI_coord[:-4] # remove ".txt" at the end of the file name
-						print(spherical_ROI_name)
-
-						# create spherical ROIs
-						# print("cd %s && 3dUndump -prefix temp_%s_mask_%s -master %s -srad %s -xyz temp_%s" % (GLM_folder_path, spherical_ROI_name, condition_name, use_file, sphere_radius, spherical_ROI_coord))
-						subprocess.call("cd %s && 3dUndump -prefix temp_%s_mask_%s -master %s -srad %s -xyz temp_%s" % (GLM_folder_path, spherical_ROI_name, condition_name, use_file, sphere_radius, spherical_ROI_coord), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-						# average across voxels within spherical ROIs
-						if method_type == "magnitudes":
-							# print("cd %s && 3dmaskave -mask temp_%s_mask_%s+tlrc '%s[%s]' > %s.ave.%s.%s.txt" % (GLM_folder_path, spherical_ROI_name, condition_name, use_file, condition, spherical_ROI_name, subj_number, condition_name))
-							subprocess.call("cd %s && 3dmaskave -mask temp_%s_mask_%s+tlrc '%s[%s]' > %s.ave.%s.%s.txt" % (GLM_folder_path, spherical_ROI_name, condition_name, use_file, condition, spherical_ROI_name, subj_number, condition_name), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-						elif method_type == "timecourses":
-							# print("cd %s && 3dmaskave -mask temp_%s_mask_%s+tlrc %s > %s.ave.%s.txt" % (GLM_folder_path, spherical_ROI_name, condition_name, use_file, spherical_ROI_name, condition_name))
-							subprocess.call("cd %s && 3dmaskave -mask temp_%s_mask_%s+tlrc %s > %s.ave.%s.%s.txt" % (GLM_folder_path, spherical_ROI_name, condition_name, use_file, spherical_ROI_name, subj_number, condition_name), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-				elif method_ROI == "predefined_mask":
-					for Predef_ROI_mask in mask_list:
-						Predef_ROI_name = Predef_ROI_mask[:-5] # remove ".HEAD" at the end of the file name
-						print(Predef_ROI_name[:-5])
-						
-						# average across voxels within predefined ROI
-						if method_type == "magnitudes":
-							# print("cd %s && 3dmaskave -mask temp_%s '%s[%s]' > %s.ave.%s.%s.txt" % (GLM_folder_path, Predef_ROI_name, stats_file[:-5], condition, Predef_ROI_name, subj_number, condition_name))
-							subprocess.call("cd %s && 3dmaskave -mask temp_%s '%s[%s]' > %s.ave.%s.%s.txt" % (GLM_folder_path, Predef_ROI_name, stats_file[:-5], condition, Predef_ROI_name, subj_number, condition_name), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-						elif method_type == "timecourses":
-							# print("cd %s && 3dmaskave -mask temp_%s %s > %s.ave.%s.txt" % (GLM_folder_path, Predef_ROI_name, use_file, Predef_ROI_name, condition_name))
-							subprocess.call("cd %s && 3dmaskave -mask temp_%s %s > %s.ave.%s.%s.txt" % (GLM_folder_path, Predef_ROI_name, use_file, Predef_ROI_name, subj_number, condition_name), shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-				# relocate output ROI averages
-				average_file = os.path.join(GLM_folder_path, "*ave*txt")
-				subprocess.call("mv %s %s" % (average_file, average_folder), shell=True)
-
-				GLM_conditions.append(condition_name)
-
-			# delete temp masks and temp coordinate files
-			temp_files = os.path.join(GLM_folder_path, "temp_*")
-			subprocess.call("rm %s" % temp_files, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-
-				
-
-			all_GLM_condition_pairs[GLM_folder] = sorted(GLM_conditions)
-			
-	output_averages_folder = os.path.join(subject_results, "Average_%s_ROI_%s" % (method_ROI, method_type))
-	if not os.path.exists(output_averages_folder):
-		os.makedirs(output_averages_folder)
-
-	avg_count = 0
-	master_list = {}
-	for folder in all_GLM_condition_pairs:
-		for condition in all_GLM_condition_pairs[folder]:
-			print("\n" + folder + " : " + condition)
-			for ROI in ROI_list:
-				if method_ROI == "spherical":
-					ROI_name = ROI[:-4]
-				elif method_ROI == "predefined_mask":
-					ROI_name = ROI[:-10]
-				ROI_conditions = glob.glob(os.path.join(subject_results, "*", "*", folder, "%s_ROI_averages_%s" % (method_ROI, method_type), "%s*%s.txt" % (ROI_name, condition)))
-
-				ROI_conditions = sorted(ROI_conditions)
-
-				count = 0
-
-				for subject in ROI_conditions:
-					subject_number = subject.split(os.path.join(subject_results, "subj."))
-					subject_number = subject_number[1].split("/")
-					subject_number = subject_number[0]
-
-					count = count + 1
-
-					with open(subject, 'r') as in_file:
-						lines1=[]
-						for line in in_file:
-							newlines = line.split(" ")
-							lines1.append(newlines[0])
-						if method_type == "magnitudes":
-							act_data = float(lines1[0])
-						elif method_type == "timecourses":
-							act_data = []
-							for item in lines1:
-								act_data.append(float(item))
-						key_name = ROI_name + "_" + condition
-						if key_name in master_list:
-							if method_type == "magnitudes":
-								master_list[key_name] = master_list[key_name] + act_data
-							elif method_type == "timecourses":
-								master_list[key_name] = map(add, master_list[key_name], act_data)
-							master_list[key_name + "_count"] = master_list[key_name + "_count"] + 1
-							master_list[key_name + "_sem"].append(act_data)
-						else:
-							master_list[key_name] = act_data
-							master_list[key_name + "_count"] = 1
-							master_list[key_name + "_sem"] = [act_data]
-				avg_count = avg_count + 1
-
-	if method_type == "timecourses":
-		timepoint_number = None
-		for item in master_list:
-			if "count" not in item and "sem" not in item:
-				timepoint_number = len(master_list[item])
-				break
-
-
-	master_file_path = os.path.join(output_averages_folder, "master_%s_ROI_%s_file.csv" % (method_ROI, method_type))
-	if os.path.exists(master_file_path):
-		existing_outputs = glob.glob(os.path.join(output_averages_folder, "master_%s_ROI_%s_file*" % (method_ROI, method_type)))
-		master_file_path = os.path.join(output_averages_folder, "master_%s_ROI_%s_file_%s.csv" % (method_ROI, method_type, len(existing_outputs)))
-
-	if method_type == "timecourses":
-		for item in master_list:
-			if "count" not in item and "sem" not in item:
-				master_list[item][:] = [x / master_list[item + "_count"] for x in master_list[item]]
-
-		for item in master_list:
-			sem_calc = []
-			if "sem" in item:
-				for j in range(0, timepoint_number):
-					sem_list = []
-					for participant in master_list[item]:
-						sem_list.append(participant[j])
-					sem = stats.sem(sem_list, ddof=1, axis=None)
-					sem_calc.append(sem)
-				master_list[item] = sem_calc
-				
-		final_list = {}	
-
-
-
-	for item in master_list:
-		if "count" not in item and "sem" not in item:
-			if method_type == "magnitudes":
-				master_list[item] = master_list[item] / master_list[item + "_count"]
-				master_list[item  + "_sem"] = stats.sem(master_list[item + "_sem"], axis=None, ddof=1)
-			elif method_type == "timecourses":
-				final_list[item] = [item, master_list[item + "_count"]]
-				for k in range(0, timepoint_number):
-					final_list[item].append(master_list[item][k])
-					final_list[item].append(master_list[item + "_sem"][k])
-
-	ordered_list = []
-	for item in master_list:
-		if "count" not in item and "sem" not in item:
-			ordered_list.append(item)
-	ordered_list = sorted(ordered_list)
-
-	if method_type == "magnitudes":
-		headers = ["activation", "subj_count", "average", "sem"]
-	elif method_type == "timecourses":
-		headers = ["timepoint", "activation", "subj_count", "average", "sem"]
-			
-	with open(master_file_path, 'w') as master_file:
-		writer = csv.writer(master_file)
-		writer.writerow(headers)
+	# check the geometry of every file up front (one pass over the headers), and show every mismatch at once
+	checked_count, mismatches, fatal = ROI_Extraction.check_geometry(settings, extraction_units)
+	print("Geometry checked for %s files" % checked_count)
+	if fatal:
+		sys.exit("XXXXX\n%s file(s) do not have the dimensions or voxel size of your masks, so the masks cannot be used with them:\n%s\nXXXXX" % (len(fatal), "\n".join(fatal)))
+	if mismatches:
+		check_geometry(mismatches)
 
+	###iterate through each subject and GLM
+	try:
+		all_GLM_condition_pairs, results = ROI_Extraction.run_extraction(settings, extraction_units, processes)
+	except ValueError as error:  # a mask that does not fit the grid of a dataset
+		sys.exit("XXXXX\n%s\nXXXXX" % error)
 
-
-
-	if method_type == "timecourses":
-		intermediate_list = {}
-		for i in range(0, timepoint_number):
-			for item in ordered_list:
-				intermediate_list[item + "_subj_count_" + str(i+1)] = master_list[item + "_count"]
-				intermediate_list[item + "_average_" + str(i+1)] = master_list[item][i]
-				intermediate_list[item + "_sem_" + str(i+1)] = master_list[item + "_sem"][i]
-
-		master_list = intermediate_list
-
-	
-	if method_type == "magnitudes":
-		for item in ordered_list:
-				with open(master_file_path, 'a') as master_file:
-					writer = csv.writer(master_file)
-					writer.writerow([item, master_list[item + "_count"], master_list[item], master_list[item + "_sem"]])
-	elif method_type == "timecourses":
-		for item in ordered_list:
-			with open(master_file_path, 'a') as master_file:
-				writer = csv.writer(master_file)
-				for i in range(1, timepoint_number + 1):
-					write_list = [str(i)]
-					write_list.append(item)
-					write_list.append(master_list[item+ "_subj_count_" + str(i)])
-					write_list.append(master_list[item+ "_average_" + str(i)])
-					write_list.append(master_list[item+ "_sem_" + str(i)])
-					writer.writerow(write_list)
-
-
-
-
-	print("\n" + str(avg_count) + " averages calculated")
-
-	# Delete remaining intermediate files
-	avg_folder_files = os.listdir(output_averages_folder)
-	for avg_file in avg_folder_files:
-		if not avg_file.startswith("master_"):
-			rm_file = os.path.join(subject_results, ("Average_" + method_ROI + "_ROI_" + method_type), avg_file)
-			subprocess.call("rm %s" % (rm_file), shell=True)
-	rm_folder = os.path.join(subject_results, "*", "*", "*", "*_ROI_averages_*")
-	subprocess.call("rm -R %s" % (rm_folder), shell=True)
+	ROI_Extraction.write_master_file(settings, all_GLM_condition_pairs, results)
 
 endtime = datetime.now()
 print_endtime = endtime.strftime("%m-%d-%Y, %I:%M:%S %p")
 print("End script execution: " + str(print_endtime))
 
-time_duration(starttime, endtime)
-print("Total script duration: " + duration_string)
\ No newline at end of file
+print("Total script duration: " + time_duration(starttime, endtime))
+ROI_Extraction.Run_Trace.finish()
@@ -0,0 +1,605 @@
+####################################################################################################################
+# ===ROI Extraction=== #
+# The calculation part of ROI_AFNI_tool.py: finding GLM folders and conditions, extracting ROI averages for every
+# subject/GLM, and writing the master files. Nothing in here opens a window, so it is shared by ROI_AFNI_tool.py
+# (interactive) and ROI_AFNI_batch.py (config file, no Tkinter).
+####################################################################################################################
+
+
+import os
+import sys
+import glob
+import csv
+import numpy
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "AFNI_Data_Bundle"))
+import AFNI_Datasets, ROI_Averages, ROI_Masks, ROI_Reducers, Sphere_Masks, Job_Scheduler, Group_Averages, ROI_Results, Extraction_Manifest, Label_Index, Geometry_Check, Run_Trace
+
+
+mask_libraries = {}  # (method, ROIs, grid) -> mask library, built once per worker process (see ROI_library)
+
+
+duration_string = ""
+# Function for printing a string with the elapsed time (also returns the string)
+def time_duration(starttime, currenttime):
+	global duration_string
+	duration_string = ""
+	totaltime = currenttime - starttime
+	if "day" in str(totaltime):
+		time_days = int(str(totaltime)[:1])
+	else:
+		time_days = 0
+	time_minutes = (totaltime.seconds - (totaltime.seconds % 60)) // 60
+	if time_minutes > 59:
+		minutes_left = time_minutes % 60
+		time_hours = (time_minutes - minutes_left) // 60
+		time_minutes = minutes_left
+	else:
+		time_hours = 0
+	time_seconds = totaltime.seconds % 60
+	if time_days > 0:
+		duration_string = duration_string + str(time_days) + " day"
+	if time_days > 1:
+		duration_string = duration_string + "s"
+	if time_days > 0:
+		duration_string = duration_string + ", "
+	if time_days > 0 or time_hours > 0:
+		duration_string = duration_string + str(time_hours) + " hour"
+		if time_hours != 1:
+			duration_string = duration_string + "s"
+		duration_string = duration_string + ", "
+	if time_days > 0 or time_hours > 0 or time_minutes > 0:
+		duration_string = duration_string + str(time_minutes) + " minute"
+		if time_minutes != 1:
+			duration_string = duration_string + "s"
+		if time_days > 0 or time_hours > 0:
+			duration_string = duration_string + ", "
+	if duration_string:
+		duration_string = duration_string + " and "
+	duration_string = duration_string + str(time_seconds) + " second"
+	if time_seconds != 1:
+		duration_string = duration_string + "s"
+	return duration_string
+
+
+# Returns the results folder inside a subject folder
+def subject_results_folder(subject_results, folder):
+	results_folders = os.listdir(os.path.join(subject_results, folder))
+	results_folders = [x for x in results_folders if (".DS_Store" not in x)]
+	return os.path.join(subject_results, folder, results_folders[0])
+
+
+####################
+# GLMs and conditions
+####################
+
+# Finds every GLM folder name used by any subject: GAM GLMs have a stats file but no iresp files, TENT GLMs have iresp files
+def find_GLM_folders(subject_results, subject_folders, GAM=True, TENT=True):
+	GLM_GAM_folders = []
+	GLM_TENT_folders = []
+
+	for folder in subject_folders:
+		results_folder = subject_results_folder(subject_results, folder) #results folder inside subject folder
+		GLM_folders = glob.glob(os.path.join(results_folder, "*"))
+		GLM_folders1 = []
+		for GLM_folder in GLM_folders:
+			splits = GLM_folder.split("/")
+			GLM_folders1.append(splits[-1])
+		if GAM:
+			for potential_folder in GLM_folders1:
+				check = glob.glob(os.path.join(results_folder, potential_folder, "stats*"))  # for GAM GLMs
+				check1 = glob.glob(os.path.join(results_folder, potential_folder, "iresp*"))  # for TENT GLMs
+				if check and not check1:  # if the folder has a stats file, but no iresp files
+					if not potential_folder in GLM_GAM_folders:
+						GLM_GAM_folders.append(potential_folder)
+		if TENT:
+			for potential_folder in GLM_folders1:
+				check = glob.glob(os.path.join(results_folder, potential_folder, "iresp*"))  # for TENT GLMs
+				if check:  # if the folder has any iresp files
+					if not potential_folder in GLM_TENT_folders:
+						GLM_TENT_folders.append(potential_folder)
+
+	return sorted(GLM_GAM_folders), sorted(GLM_TENT_folders)
+
+
+# Returns the condition name in an iresp file name ('path/to/iresp_hit.01+tlrc.HEAD' -> 'hit')
+def iresp_condition(iresp_file):
+	iresp = iresp_file.split("/")[-1][:-10]  # remove the '+tlrc.HEAD' from iresp file
+	iresp_split = iresp[6:].split(".")  # remove "iresp" from filename, split at '.' (lose participant number)
+	return iresp_split[0]  # keeps only the user-specified condition name
+
+
+# Finds the conditions in a GLM, using the first subject who has it
+# (the "#0_Coef" sub-brick labels of the stats file for GAM GLMs, the iresp file names for TENT GLMs)
+def possible_conditions(subject_results, subject_folders, GLM_folder, method_type):
+	possible_conditions = []
+	for folder in subject_folders:  # find a subject who has this GLM, to extract info about it
+		results_folder = subject_results_folder(subject_results, folder)
+		if os.path.exists(os.path.join(results_folder, GLM_folder)):
+			GLM_folder_path = os.path.join(results_folder, GLM_folder)
+			break
+
+	if method_type == "magnitudes":
+		stats_files = glob.glob(os.path.join(GLM_folder_path, "stats*.HEAD"))
+		possible_conditions = Label_Index.coefficient_conditions(AFNI_Datasets.open_dataset(stats_files[0]))
+	elif method_type == "timecourses":
+		iresp_files = glob.glob(os.path.join(GLM_folder_path, "iresp*.HEAD"))
+		for iresp_file in iresp_files:
+			possible_conditions.append(iresp_condition(iresp_file))
+	return possible_conditions
+
+
+def long_substr(data):
+	substr = ''
+	if len(data) > 1 and len(data[0]) > 0:
+		for i in range(len(data[0])):
+			for j in range(len(data[0])-i+1):
+				if j > len(substr) and is_substr(data[0][i:i+j], data) and len(data[0][i:i+j]) > 2:
+					substr = data[0][i:i+j]
+	return substr
+
+def is_substr(find, data):
+	if len(data) < 1 and len(find) < 1:
+		return False
+	for i in range(len(data)):
+		if find not in data[i]:
+			return False
+	return True
+
+
+# Removes the text that all of a GLM's conditions share (e.g. a common prefix), leaving the short condition names
+# Returns (short name, full name) pairs, sorted by short name
+def condition_names(conditions):
+	names = [(x, x) for x in conditions]
+	for i in range(0,5):
+		long_substring = long_substr([short for short, full in names])
+		names = sorted((short.replace(long_substring, ''), full) for short, full in names)
+	return names
+
+
+# Returns the short condition names of a GLM's conditions (as shown in the condition selection window)
+def shorten_conditions(conditions):
+	return [short for short, full in condition_names(conditions)]
+
+
+# Returns every short condition name used by any GLM ({GLM: [short condition names]})
+def shortened_responses(conditions_list):
+	shortened = []
+	for GLM in conditions_list:
+		for response in conditions_list[GLM]:
+			if response not in shortened:
+				shortened.append(response)
+	return sorted(shortened)
+
+
+####################
+# Extraction
+####################
+
+# Collects everything needed to extract one of the analysis methods, so that it can be handed to worker processes
+# For spherical ROIs, this also rewrites coordinate files into the format required by AFNI, and reads their centers.
+# For a labeled atlas (atlas_path), every label value is an ROI, named from the label table file (label_table_path) if
+# one is given, or else from the atlas's own label table.
+# reducers lists ROI statistics to save besides the mean (e.g. ['median', 'top:10'], see ROI_Reducers).
+def method_settings(method, subject_results, coord_list, mask_list, sphere_radius, coord_system, final_GAM_list, final_TENT_list, starttime,
+					atlas_path=None, label_table_path=None, reducers=None):
+	settings = {'subject_results': subject_results,
+				'coord_list': coord_list,
+				'mask_list': mask_list,
+				'sphere_radius': sphere_radius,
+				'coord_system': coord_system,
+				'atlas_path': atlas_path,
+				'statistics': ROI_Reducers.reducer_columns(reducers),
+				'starttime': starttime}
+
+	method = method.lower()  # e.g. 'Sphere from coordinate (magnitude)', or 'sphere magnitude' in a batch config
+	if "sphere" in method:
+		settings['method_ROI'] = "spherical"
+		settings['ROI_list'] = coord_list
+
+	if "mask" in method:
+		if "weighted" in method:  # every mask voxel weighted by its value (e.g. a probability map)
+			settings['method_ROI'] = "weighted_mask"
+		else:
+			settings['method_ROI'] = "predefined_mask"
+		settings['ROI_list'] = mask_list
+
+	if "atlas" in method:
+		settings['method_ROI'] = "atlas"
+
+	if "magnitude" in method:
+		settings['method_type'] = "magnitudes"
+		settings['final_list'] = final_GAM_list
+		settings['file_type'] = "stats"
+
+	if "timecourse" in method:
+		settings['method_type'] = "timecourses"
+		settings['final_list'] = final_TENT_list
+		settings['file_type'] = "iresp"
+
+	if settings['method_ROI'] == "spherical":
+		for spherical_ROI_coord in coord_list:
+			# If the coordinates have not been provided in the format required by AFNI, fix the text file
+			coord_file = open(coord_list[spherical_ROI_coord], 'r')
+			file_data = coord_file.readline()
+			coord_file.close()
+			if "," in file_data:
+				if not " " in file_data:  # values are 'a,b,c'
+					file_data = file_data.replace(",", " ")
+				else:  # values are 'a, b, c'
+					file_data = file_data.replace(", ", " ")
+				new_coord_file = open(coord_list[spherical_ROI_coord], 'w')
+				new_coord_file.writelines(file_data)
+				new_coord_file.close()
+
+		sphere_centers = {}
+		for spherical_ROI_coord in coord_list:
+			sphere_centers[spherical_ROI_coord] = Sphere_Masks.read_coordinates(coord_list[spherical_ROI_coord])
+		settings['sphere_centers'] = sphere_centers
+		settings['sphere_cache_folder'] = os.path.join(subject_results, "ROI_sphere_cache")  # spheres are reused across subjects and runs
+
+	if settings['method_ROI'] == "atlas":
+		label_table = None
+		if label_table_path:
+			label_table = ROI_Masks.read_label_table(label_table_path)
+		settings['label_table'] = label_table
+		library = ROI_Masks.atlas_library(atlas_path, label_table)
+		duplicates = sorted(set(x for x in library['names'] if library['names'].count(x) > 1))
+		if duplicates:
+			sys.exit("XXXXX\nSeveral labels of the atlas %s share the name(s): %s\nPlease give every label its own name.\nXXXXX" % (atlas_path, ", ".join(duplicates)))
+		settings['atlas_labels'] = dict(zip(library['names'], [int(x) for x in library['labels']]))  # {ROI name: label value}
+		settings['ROI_list'] = dict((name, atlas_path) for name in library['names'])
+
+	# what each ROI was built from, so that values from earlier runs are only reused if their ROI has not changed
+	ROI_hashes = {}
+	if settings['method_ROI'] == "atlas":
+		atlas_hash = Extraction_Manifest.mask_hash(atlas_path)  # the whole atlas is read once, for all of its labels
+	for ROI_file in settings['ROI_list']:
+		if settings['method_ROI'] == "spherical":
+			ROI_hashes[ROI_file] = Extraction_Manifest.sphere_hash(settings['sphere_centers'][ROI_file], sphere_radius, os.environ.get('AFNI_ORIENT', "RAI"))
+		elif settings['method_ROI'] in ["predefined_mask", "weighted_mask"]:
+			ROI_hashes[ROI_file] = Extraction_Manifest.mask_hash(mask_list[ROI_file])
+		elif settings['method_ROI'] == "atlas":
+			ROI_hashes[ROI_file] = Extraction_Manifest.atlas_label_hash(atlas_hash, settings['atlas_labels'][ROI_file])
+	settings['ROI_hashes'] = ROI_hashes
+	settings['manifest_path'] = os.path.join(subject_results, "Average_%s_ROI_%s" % (settings['method_ROI'], settings['method_type']), "ROI_manifest.json")
+
+	return settings
+
+
+# Returns the name an ROI file is reported under ('region.txt' or 'region+tlrc.HEAD' -> 'region', atlas labels as is)
+def ROI_name(settings, ROI_file):
+	if settings['method_ROI'] == "spherical":
+		return ROI_file[:-4]  # remove ".txt"
+	elif settings['method_ROI'] == "atlas":
+		return ROI_file
+	return ROI_file[:-10]  # remove "+tlrc.HEAD"
+
+
+# Breaks the job into independent units - (settings, subject folder, GLM folder) for every subject that has the GLM
+# This also looks up the full name of every selected (short) condition once per GLM, for all of its units to share.
+def extraction_units(settings, subject_folders):
+	settings['condition_names'] = {}  # {GLM: {short condition name: full condition name}}
+	for GLM_folder in settings['final_list']:
+		conditions = possible_conditions(settings['subject_results'], subject_folders, GLM_folder, settings['method_type'])
+		settings['condition_names'][GLM_folder] = dict(condition_names(conditions))
+
+	units = []
+	for folder in subject_folders:
+		results_folder = subject_results_folder(settings['subject_results'], folder) #results folder inside subject folder
+		for GLM_folder in settings['final_list']:
+			if os.path.exists(os.path.join(results_folder, GLM_folder)):
+				units.append((settings, folder, GLM_folder))
+	return units
+
+# Finds the stats/iresp files in a GLM folder, and which coefficient labels (magnitude) or iresp files (timecourse) to use
+# Selected conditions are matched by their exact full names, so 'hit' never picks up 'hit-cr_GLT'.
+def GLM_use_list(settings, GLM_folder_path, GLM_folder):
+	analysis_files = glob.glob(os.path.join(GLM_folder_path, "%s*.HEAD" % settings['file_type']))
+	names = settings['condition_names'][GLM_folder]
+	selected = [names[condition] for condition in settings['final_list'][GLM_folder] if condition in names]
+
+	use_list = []
+	if settings['method_type'] == "magnitudes":
+		labels = Label_Index.label_index(AFNI_Datasets.open_dataset(analysis_files[0]))
+		use_list = [condition + "#0_Coef" for condition in selected if condition + "#0_Coef" in labels]
+	elif settings['method_type'] == "timecourses":
+		iresp_files = dict((iresp_condition(iresp_file), iresp_file) for iresp_file in analysis_files)
+		use_list = [iresp_files[condition] for condition in selected if condition in iresp_files]
+
+	return analysis_files, use_list
+
+
+# Returns the mask library (see ROI_Masks) of the ROIs in ROI_files, on the grid of dataset
+# Masks, coordinates and the atlas are read where they are (nothing is copied into the GLM folders), and each library
+# is kept in mask_libraries, so every worker process builds it once and reuses it for every subject/GLM on that grid.
+def ROI_library(settings, ROI_files, dataset):
+	key = (settings['method_ROI'], settings['method_type'], tuple(sorted(ROI_files)), Sphere_Masks.geometry_key(dataset))
+	if key not in mask_libraries:
+		with Run_Trace.span("ROI library", ROIs=len(ROI_files)):
+			if settings['method_ROI'] == "spherical":
+				# spherical ROIs are built once per grid geometry, then taken from the sphere cache
+				masks = Sphere_Masks.sphere_masks(dataset, dict((ROI_file, settings['sphere_centers'][ROI_file]) for ROI_file in ROI_files), settings['sphere_radius'], settings['sphere_cache_folder'])
+				mask_libraries[key] = ROI_Masks.voxel_set_library(masks, dataset['dims'])
+			elif settings['method_ROI'] == "predefined_mask":
+				mask_libraries[key] = ROI_Masks.binary_library(dict((ROI_file, settings['mask_list'][ROI_file]) for ROI_file in ROI_files), dataset['dims'])
+			elif settings['method_ROI'] == "weighted_mask":
+				# voxels above 0 count by their value in the mask, so each ROI value is a weighted mean
+				mask_libraries[key] = ROI_Masks.probabilistic_library(dict((ROI_file, settings['mask_list'][ROI_file]) for ROI_file in ROI_files), dataset['dims'])
+			elif settings['method_ROI'] == "atlas":
+				# every label of the atlas is averaged at once, straight from the atlas (no per-ROI files)
+				mask_libraries[key] = ROI_Masks.atlas_library(settings['atlas_path'], settings['label_table'], dataset['dims'])
+	return mask_libraries[key]
+
+
+# Extracts the ROI averages for one subject's GLM folder - unit = (settings, subject folder, GLM folder, entries), where
+# entries are the manifest entries of this subject/GLM from earlier runs ({condition: {ROI: entry}}). Values whose
+# dataset and ROI are unchanged are taken from those entries; only the rest are extracted.
+# Returns the conditions found, the results table, and the manifest entries for every value in it.
+# Every unit only writes inside its own GLM folder, so units can run in parallel.
+def extract_GLM(unit):
+	settings, folder, GLM_folder, previous_entries = unit
+	with Run_Trace.span("extract GLM", 'unit', subject=folder[5:], GLM=GLM_folder):
+		return extract_GLM_values(unit)
+
+
+# Does the work of extract_GLM (see above)
+def extract_GLM_values(unit):
+	settings, folder, GLM_folder, previous_entries = unit
+	method_ROI = settings['method_ROI']
+	method_type = settings['method_type']
+	subj_number = folder[5:]
+
+	time1 = datetime.now()
+	time_duration(settings['starttime'], time1)
+	print("***" + subj_number + " - " + GLM_folder + "...." + duration_string + " elapsed")
+
+	GLM_folder_path = os.path.join(subject_results_folder(settings['subject_results'], folder), GLM_folder)
+
+	GLM_conditions = []
+	results = ROI_Results.new_results()
+	entries = {}
+
+	analysis_files, use_list = GLM_use_list(settings, GLM_folder_path, GLM_folder)
+
+	if method_type == "timecourses":
+		iresp_files = []
+		for iresp_file in use_list:
+			splits = iresp_file.split("/")
+			iresp_files.append(splits[-1])
+		use_list = iresp_files
+	elif method_type == "magnitudes":
+		splits = analysis_files[0].split("/")
+		stats_file = splits[-1]
+
+
+	###iterate through each condition/event type for this GLM
+	# every dataset needing extraction is opened once, and the datasets on the same grid (e.g. all the iresp files of a
+	# GLM) are averaged within every ROI together, in one sparse matrix product over their stacked sub-bricks
+	# (only the voxels inside the ROIs are read from the memory-mapped .BRIK files)
+	extraction_list = []  # (dataset, condition names, sub-brick indices)
+	if method_type == "magnitudes" and use_list:
+		stats_dataset = AFNI_Datasets.open_dataset(os.path.join(GLM_folder_path, stats_file))
+		labels = Label_Index.label_index(stats_dataset)
+		subbrick_indices = [labels[condition] for condition in use_list]
+		condition_names = [condition[:-7] for condition in use_list]
+		extraction_list.append((stats_file[:-5], condition_names, subbrick_indices))
+	elif method_type == "timecourses":
+		for iresp_file in use_list:
+			extraction_list.append((iresp_file[:-5], [iresp_condition(iresp_file)], None))  # remove the .HEAD from iresp file
+
+	grid_groups = {}  # grid geometry key -> [(dataset, condition names, sub-brick indices, signature, stale ROIs)]
+	stale_ROIs = set()
+	for use_file, condition_names, subbrick_indices in extraction_list:
+		GLM_conditions.extend(condition_names)
+		signature = Extraction_Manifest.dataset_signature(os.path.join(GLM_folder_path, use_file))
+
+		# reuse every ROI whose values from an earlier run are still up to date for all of this dataset's conditions
+		dataset_stale_ROIs = set()
+		for ROI_file in sorted(settings['ROI_list']):
+			ROI_hash = settings['ROI_hashes'][ROI_file]
+			output_ROI_name = ROI_name(settings, ROI_file)
+			previous = [previous_entries.get(condition, {}).get(output_ROI_name) for condition in condition_names]
+			if all(Extraction_Manifest.is_current(entry, signature, ROI_hash, settings['statistics']) for entry in previous):
+				for condition_name, entry in zip(condition_names, previous):
+					statistics = dict((column, entry['statistics'][column]) for column in settings['statistics'])
+					ROI_Results.add_averages(results, subj_number, GLM_folder, condition_name, output_ROI_name, entry['values'], entry['voxels'], statistics)
+					entries.setdefault(condition_name, {})[output_ROI_name] = entry
+			else:
+				dataset_stale_ROIs.add(ROI_file)
+
+		if dataset_stale_ROIs:
+			stale_ROIs.update(dataset_stale_ROIs)
+			dataset = AFNI_Datasets.open_dataset(os.path.join(GLM_folder_path, use_file))
+			grid_groups.setdefault(Sphere_Masks.geometry_key(dataset), []).append((dataset, condition_names, subbrick_indices, signature, dataset_stale_ROIs))
+
+	# an ROI that is stale in any dataset of a group is averaged in all of them, but only kept where it was stale
+	for key in sorted(grid_groups):
+		group = grid_groups[key]
+		if method_ROI == "atlas":
+			print("%s atlas labels" % len(stale_ROIs))
+		else:
+			for ROI_file in sorted(stale_ROIs):
+				print(ROI_name(settings, ROI_file))
+		library = ROI_library(settings, stale_ROIs, group[0][0])
+
+		# average across voxels within every ROI at once, and add the averages to this unit's results
+		# (any other ROI statistics are computed from the same voxel values)
+		with Run_Trace.span("ROI averages", datasets=len(group), ROIs=len(library['names'])):
+			if method_ROI == "atlas":
+				averages = ROI_Averages.stacked_label_averages([x[0] for x in group], [x[2] for x in group], library, settings['statistics'])
+			else:
+				averages = ROI_Averages.stacked_roi_averages([x[0] for x in group], [x[2] for x in group], library, settings['statistics'])
+		for ROI_file in sorted(averages):
+			dataset_means, voxel_count, dataset_statistics = averages[ROI_file]
+			output_ROI_name = ROI_name(settings, ROI_file)
+			if voxel_count == 0:
+				print("Warning: the mask for %s contains no voxels in %s - skipping" % (output_ROI_name, ", ".join(x[0]['prefix'].split("/")[-1] for x in group)))
+				continue
+			for position, (dataset, condition_names, subbrick_indices, signature, dataset_stale_ROIs) in enumerate(group):
+				if ROI_file not in dataset_stale_ROIs:
+					continue
+				ROI_means = dataset_means[position]
+				ROI_statistics = dict((column, dataset_statistics[column][position]) for column in dataset_statistics)
+				if method_type == "magnitudes":
+					condition_slices = [slice(i, i + 1) for i in range(len(condition_names))]
+				elif method_type == "timecourses":
+					condition_slices = [slice(None)]
+				for condition_name, condition_slice in zip(condition_names, condition_slices):
+					means = ROI_means[condition_slice]
+					statistics = dict((column, ROI_statistics[column][condition_slice]) for column in ROI_statistics)
+					ROI_Results.add_averages(results, subj_number, GLM_folder, condition_name, output_ROI_name, means, voxel_count, statistics)
+					entries.setdefault(condition_name, {})[output_ROI_name] = Extraction_Manifest.new_entry(dataset['prefix'].split("/")[-1], signature, settings['ROI_hashes'][ROI_file], means, voxel_count, statistics)
+
+	return GLM_conditions, results, entries
+
+
+# Returns the files of a unit whose orientation should match the coordinate system of the spherical ROIs
+def geometry_files(unit):
+	settings, folder, GLM_folder = unit
+	GLM_folder_path = os.path.join(subject_results_folder(settings['subject_results'], folder), GLM_folder)
+	if settings['method_type'] == "magnitudes":
+		return glob.glob(os.path.join(GLM_folder_path, "%s*.HEAD" % settings['file_type']))[:1]
+	elif settings['method_type'] == "timecourses":
+		return GLM_use_list(settings, GLM_folder_path, GLM_folder)[1]
+
+
+# Checks the grid of every file the units will read, in one pass over their headers before any extraction starts
+# (GLM folders are listed and headers are read by threads threads, and headers read by earlier runs are cached).
+# Returns (number of files checked, a message for every problem, the messages of problems that cannot be ignored):
+# spherical ROIs need files in the coordinate system of the coordinates, and masks (predefined or weighted) or an atlas
+# need files on the same grid as the masks - files whose dimensions or voxel size differ from a mask cannot be used.
+def check_geometry(settings, units, threads=8):
+	with Run_Trace.span("geometry check", units=len(units)):
+		pool = ThreadPool(max(1, min(threads, len(units))))
+		try:
+			dataset_paths = [x for unit_files in pool.map(geometry_files, units) for x in unit_files]
+		finally:
+			pool.close()
+			pool.join()
+
+		cache_path = os.path.join(settings['subject_results'], "ROI_geometry_cache.json")
+		geometries = Geometry_Check.scan_geometry(dataset_paths, cache_path, threads)
+		if settings['method_ROI'] == "spherical":
+			mismatches, fatal = Geometry_Check.orientation_mismatches(geometries, settings['coord_system']), []
+		elif settings['method_ROI'] in ["predefined_mask", "weighted_mask"]:
+			mask_geometries = Geometry_Check.scan_geometry(settings['mask_list'].values(), cache_path, threads)
+			mismatches, fatal = Geometry_Check.grid_mismatches(geometries, mask_geometries)
+		elif settings['method_ROI'] == "atlas":
+			atlas_geometries = Geometry_Check.scan_geometry([settings['atlas_path']], cache_path, threads)
+			mismatches, fatal = Geometry_Check.grid_mismatches(geometries, atlas_geometries)
+		return len(geometries), mismatches, fatal
+
+
+# Runs every unit (across processes worker processes), and returns the conditions extracted for each GLM, along with
+# the results of every unit appended into one table
+# Values already in the manifest from earlier runs are reused, and the manifest is saved as units finish (at most once
+# every manifest_interval seconds, and at the end), so a run that dies part way can pick up where it left off.
+def run_extraction(settings, units, processes=1, manifest_interval=60):
+	with Run_Trace.span("extraction", units=len(units), processes=processes):
+		manifest = Extraction_Manifest.load_manifest(settings['manifest_path'])
+		units = [(settings, folder, GLM_folder, Extraction_Manifest.unit_entries(manifest, folder[5:], GLM_folder)) for settings, folder, GLM_folder in units]
+		last_save = datetime.now()
+
+		all_GLM_condition_pairs = {}
+		results = ROI_Results.new_results()
+		finished_count = 0
+		for unit, (GLM_conditions, unit_results, entries) in Job_Scheduler.run_units(extract_GLM, units, processes):
+			settings, folder, GLM_folder, previous_entries = unit
+			finished_count += 1
+			time1 = datetime.now()
+			time_duration(settings['starttime'], time1)
+			print("***%s - %s finished (%s of %s)...%s elapsed" % (folder[5:], GLM_folder, finished_count, len(units), duration_string))
+
+			all_GLM_condition_pairs[GLM_folder] = sorted(set(all_GLM_condition_pairs.get(GLM_folder, [])) | set(GLM_conditions))
+			ROI_Results.extend_results(results, unit_results)
+
+			Extraction_Manifest.update_manifest(manifest, folder[5:], GLM_folder, entries)
+			if (time1 - last_save).total_seconds() >= manifest_interval:
+				Extraction_Manifest.save_manifest(settings['manifest_path'], manifest)
+				last_save = time1
+
+		Extraction_Manifest.save_manifest(settings['manifest_path'], manifest)
+		return all_GLM_condition_pairs, results
+
+
+####################
+# Master files
+####################
+
+# Arranges the results of a run into one (ROI, condition, subject, timepoint) array, with a mask of which are present
+# The subject axis has one entry per subject per GLM folder, so a condition found in several GLMs is counted once per GLM.
+# column picks the value to arrange ('value' for the mean, or the column of another ROI statistic).
+def collect_averages(results, column='value'):
+	arrays = ROI_Results.results_arrays(results)
+	names, ROI_positions = numpy.unique(arrays['ROI'], return_inverse=True)
+	conditions, condition_positions = numpy.unique(arrays['condition'], return_inverse=True)
+	subjects = numpy.char.add(numpy.char.add(arrays['GLM'], "/"), arrays['subject'])
+	subjects, subject_positions = numpy.unique(subjects, return_inverse=True)
+	timepoint_number = max([1] + list(arrays['timepoint']))
+
+	data, present = Group_Averages.empty_group_array(len(names), len(conditions), len(subjects), timepoint_number)
+	data[ROI_positions, condition_positions, subject_positions, arrays['timepoint'] - 1] = arrays[column]
+	present[ROI_positions, condition_positions, subject_positions, arrays['timepoint'] - 1] = True
+
+	return [str(x) for x in names], [str(x) for x in conditions], data, present
+
+
+# Averages every ROI/condition across subjects and writes the master file, with the subject values saved beside it
+def write_master_file(settings, all_GLM_condition_pairs, results):
+	with Run_Trace.span("aggregation", rows=len(results['value'])):
+		subject_results = settings['subject_results']
+		method_ROI = settings['method_ROI']
+		method_type = settings['method_type']
+
+		output_averages_folder = os.path.join(subject_results, "Average_%s_ROI_%s" % (method_ROI, method_type))
+		if not os.path.exists(output_averages_folder):
+			os.makedirs(output_averages_folder)
+
+		names, conditions, data, present = collect_averages(results)
+		count, mean, sem = Group_Averages.group_statistics(data, present)
+
+		# every other ROI statistic is averaged across subjects the same way, and gets its own average/sem columns
+		statistics = []
+		statistic_headers = []
+		for column in settings['statistics']:
+			statistic_data, statistic_present = collect_averages(results, column)[2:]
+			statistics.append(Group_Averages.group_statistics(statistic_data, statistic_present)[1:])
+			statistic_headers.extend([column + "_average", column + "_sem"])
+
+		master_file_path = os.path.join(output_averages_folder, "master_%s_ROI_%s_file.csv" % (method_ROI, method_type))
+		if os.path.exists(master_file_path):
+			existing_outputs = glob.glob(os.path.join(output_averages_folder, "master_%s_ROI_%s_file*.csv" % (method_ROI, method_type)))
+			master_file_path = os.path.join(output_averages_folder, "master_%s_ROI_%s_file_%s.csv" % (method_ROI, method_type, len(existing_outputs)))
+
+		# every subject's values, saved beside the master file they were averaged into
+		results_path, table_path = ROI_Results.save_results(master_file_path[:-4] + "_averages.npz", results)
+
+		# one row per ROI/condition that any subject has, in the order of their "ROI_condition" names
+		ordered_list = []
+		for ROI_position in range(len(names)):
+			for condition_position in range(len(conditions)):
+				if count[ROI_position, condition_position].any():
+					ordered_list.append((names[ROI_position] + "_" + conditions[condition_position], ROI_position, condition_position))
+		ordered_list = sorted(ordered_list)
+
+		with open(master_file_path, 'w') as master_file:
+			writer = csv.writer(master_file)
+			if method_type == "magnitudes":
+				writer.writerow(["activation", "subj_count", "average", "sem"] + statistic_headers)
+				for item, ROI_position, condition_position in ordered_list:
+					writer.writerow([item, int(count[ROI_position, condition_position, 0]), float(mean[ROI_position, condition_position, 0]), float(sem[ROI_position, condition_position, 0])]
+									+ [float(x[ROI_position, condition_position, 0]) for pair in statistics for x in pair])
+			elif method_type == "timecourses":
+				writer.writerow(["timepoint", "activation", "subj_count", "average", "sem"] + statistic_headers)
+				for item, ROI_position, condition_position in ordered_list:
+					for i in numpy.flatnonzero(count[ROI_position, condition_position]):
+						writer.writerow([str(i + 1), item, int(count[ROI_position, condition_position, i]), float(mean[ROI_position, condition_position, i]), float(sem[ROI_position, condition_position, i])]
+										+ [float(x[ROI_position, condition_position, i]) for pair in statistics for x in pair])
+
+		avg_count = sum(len(all_GLM_condition_pairs[folder]) for folder in all_GLM_condition_pairs) * len(settings['ROI_list'])
+		print("\n" + str(avg_count) + " averages calculated")
+		print("Subject averages saved to: " + results_path)
+		print("Subject averages table saved to: " + table_path)